@@ -40,20 +40,57 @@ import os
 import sys
 import re
 import datetime
+import time
+import array
+import bisect
+import gc
 import mx.DateTime
 import logging
 import StringIO
+import hashlib
+import struct
+import types
 import zipfile
 import math
+import mmap
+import collections
+import multiprocessing
+import threading
+import Queue
+import ctypes
+import csv
+import zlib
+import bz2
 import progressbar
+try:
+    import numpy
+except ImportError:
+    numpy = None # only needed by ATCO.read_arrays
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None # only needed for .xz files
 
 ###########################################################
 # Main class
 
 class ATCO(object):
-    def __init__(self, assume_no_holidays = True, show_progress = False):
+    def __init__(self, assume_no_holidays = True, show_progress = False, compact_hops = False, share_patterns = False, index_while_loading = False, collect_statistics = False):
         '''Assume_no_holidays assumes there are no school or bank holidays on the days
-        you are quering for.'''
+        you are quering for. Compact_hops stores the hops of journeys in a
+        HopStore, which uses much less memory. Share_patterns instead stores
+        each different sequence of stops once, in a PatternStore, which uses
+        even less when many journeys follow the same route. Index_while_loading
+        keeps the indexes made by index_by_short_codes up to date as each item
+        is loaded, which is quicker than making them again after each file
+        when reading several, but costs time and memory if they aren't used.
+        Collect_statistics counts what is loaded as it goes by, in a
+        LoadStatistics in self.load_statistics.'''
+        if compact_hops and share_patterns:
+            raise Exception("Can't use both compact_hops and share_patterns")
         self.journeys = []
         self.locations = []
         self.vehicle_types = []
@@ -68,6 +105,42 @@ class ATCO(object):
         self.restrict_date_range_end = None
         self.file_loading_number = 0
 
+        # dense integer ids of location short codes, shared by the indexes
+        self.location_ids = LocationIds()
+        self.hop_store = None
+        if compact_hops:
+            self.hop_store = HopStore(self.location_ids)
+        self.pattern_store = None
+        if share_patterns:
+            self.pattern_store = PatternStore(self.location_ids)
+        self.snapshot_cache_directory = None
+        self.snapshot_cache_hash_contents = True
+        self.skipped_records = {} # by record identity, see read
+        self.load_profile = None
+        self.load_profile_callback = None
+        self.load_profile_interval = None
+        self.quarantine = None
+
+        # the lists, lengths and last items of self.journeys and self.locations
+        # when they were indexed, or None if the indexes are out of date
+        self.index_while_loading = index_while_loading
+        self._indexed_journeys = None
+        self._indexed_locations = None
+        if index_while_loading:
+            self.journeys_visiting_location = LocationIndex(self.location_ids)
+            self.location_from_id = LocationIndex(self.location_ids)
+            self.journey_from_id = {}
+            self._indexed_journeys = (self.journeys, 0, None)
+            self._indexed_locations = (self.locations, 0, None)
+
+        # the same for self.journeys when compile_calendar was last called,
+        # or None if the calendar is out of date
+        self._calendar_journeys = None
+        self.journeys_running_on_date = {}
+        self.load_statistics = None
+        if collect_statistics:
+            self.load_statistics = LoadStatistics(self.vehicle_type_to_code)
+
     def restrict_to_date_range(self, restrict_date_range_start, restrict_date_range_end):
         '''Ignore exceptional date ranges outside this range. Use this, e.g. for
         NPTDR data where it is only valid in a week. This will avoid worrying
@@ -103,6 +176,176 @@ class ATCO(object):
 
         self.locations_to_ignore = locations_to_ignore
 
+    def register_snapshot_cache(self, snapshot_cache_directory, hash_contents = True):
+        '''Makes read keep a snapshot of what it loads from each file in the
+        directory, and load that rather than parsing the file again next time.
+        Snapshots are only used if the file's name, size, modification time
+        and contents, and the line patches, locations to ignore and date range
+        restriction, are all the same. Checking the contents means reading the
+        whole file, which is much quicker than parsing it; if hash_contents is
+        False they aren't checked, and a file changed without changing its
+        size or modification time (for example one unpacked from an archive,
+        which keeps the time it was packed) will load a stale snapshot.
+
+        >>> import tempfile, shutil
+        >>> n = tempfile.NamedTemporaryFile()
+        >>> n.write("""ATCO-CIF0510                       70 - RAIL        ATCORAIL20080124115909
+        ... QSNGW    6B1820070521200712071111100  2B02P10452TRAIN           I
+        ... QO9100MDNHEAD 0549URLT1  
+        ... QT9100MARLOW  0612   T1  
+        ... """)
+        >>> n.flush()
+        >>> cache_directory = tempfile.mkdtemp()
+        >>> for i in range(2):
+        ...     atco = ATCO()
+        ...     atco.register_snapshot_cache(cache_directory)
+        ...     atco.read(n.name)
+        ...     print len(os.listdir(cache_directory)), atco.journeys[0].id, len(atco.journeys[0].hops)
+        1 GW-6B18 2
+        1 GW-6B18 2
+
+        A different date range restriction needs a different snapshot.
+        >>> atco.restrict_to_date_range(datetime.date(2007, 6, 1), datetime.date(2007, 6, 7))
+        >>> atco.read(n.name)
+        >>> len(os.listdir(cache_directory)), len(atco.journeys)
+        (2, 2)
+
+        A file changed without changing its size or modification time is still
+        noticed.
+        >>> stat = os.stat(n.name)
+        >>> n.seek(0)
+        >>> n.write(open(n.name).read().replace('6B18', '6B19'))
+        >>> n.flush()
+        >>> os.utime(n.name, (stat.st_atime, stat.st_mtime))
+        >>> atco = ATCO()
+        >>> atco.register_snapshot_cache(cache_directory)
+        >>> atco.read(n.name)
+        >>> len(os.listdir(cache_directory)), atco.journeys[0].id
+        (3, 'GW-6B19')
+        >>> shutil.rmtree(cache_directory)
+        '''
+        self.snapshot_cache_directory = snapshot_cache_directory
+        self.snapshot_cache_hash_contents = hash_contents
+
+    def register_load_profile(self, callback = None, interval = 1.0):
+        '''Makes loading measure where its time goes, in a LoadProfile in
+        self.load_profile: how many records of each type there were, how long
+        they took to parse and to add to their journey or location, how long
+        was spent reading lines, in item_loaded and the filters, and bytes and
+        lines per second. If callback is given, it is called with the
+        LoadProfile while loading, at most once every interval seconds, and at
+        the end of each file.
+
+        >>> atco = ATCO()
+        >>> calls = []
+        >>> atco.register_load_profile(lambda profile: calls.append(profile.lines), interval = 0)
+        >>> atco.read_string("""ATCO-CIF0510                       70 - RAIL        ATCORAIL20080124115909
+        ... QSNGW    6B1820070521200712071111100  2B02P10452TRAIN           I
+        ... QO9100MDNHEAD 0549URLT1  
+        ... QT9100MARLOW  0612   T1  
+        ... QLN9100MARLOW  Marlow Rail Station                              RE0057285
+        ... """)
+        >>> report = atco.load_profile.report()
+        >>> sorted(report['records_by_type'].items()), report['lines'], report['bytes'], calls
+        ([('QL', 1), ('QO', 1), ('QS', 1), ('QT', 1)], 4, 192, [4])
+        >>> sorted(report['add_seconds_by_type']), report['callback_seconds'] > 0
+        (['QO', 'QT'], True)
+        '''
+        self.load_profile = LoadProfile()
+        self.load_profile_callback = callback
+        self.load_profile_interval = interval
+
+    def register_quarantine(self, quarantine_file):
+        '''Makes loading carry on past records which can't be loaded, rather
+        than raising an exception. Each bad record, and the rest of the records
+        of the journey, location or vehicle type it is part of, are instead
+        written to quarantine_file (a file name, or a handle), each with its
+        line number, under a comment line giving the reason. A record which
+        isn't part of anything, such as one of an unknown type, goes on its
+        own. The Quarantine is kept in self.quarantine, and its summary()
+        describes everything put in it so far.
+
+        >>> atco = ATCO()
+        >>> quarantine_file = StringIO.StringIO()
+        >>> atco.register_quarantine(quarantine_file)
+        >>> atco.read_string("""ATCO-CIF0510                       70 - RAIL        ATCORAIL20080124115909
+        ... QSNGW    6B1820070521200712071111100  2B02P10452TRAIN           I
+        ... QO9100MDNHEAD 0549URLT1  
+        ... QI9100FURZEP  99539953T   T1  
+        ... QT9100MARLOW  0612   T1  
+        ... QXsomething new
+        ... QSNGW    6B1A20070521200712071111100  2B04P10456TRAIN           I
+        ... QO9100MDNHEAD 0608URLT1  
+        ... QT9100BORNEND 0620   T1  
+        ... """)
+        >>> [ journey.id for journey in atco.journeys ]
+        ['GW-6B1A']
+        >>> print quarantine_file.getvalue(),
+        # file 1, line 4: ValueError: hour must be in 0..23
+        2 QSNGW    6B1820070521200712071111100  2B02P10452TRAIN           I
+        3 QO9100MDNHEAD 0549URLT1  
+        4 QI9100FURZEP  99539953T   T1  
+        5 QT9100MARLOW  0612   T1  
+        # file 1, line 6: Exception: Unknown record type 'QX'
+        6 QXsomething new
+        >>> summary = atco.quarantine.summary()
+        >>> sorted(summary['reasons'].items())
+        [("Exception: Unknown record type 'QX'", 1), ('ValueError: hour must be in 0..23', 1)]
+        >>> summary['rejected_journeys'], summary['rejected_records'], sorted(summary['rejected_records_by_type'].items())
+        (1, 5, [('QI', 1), ('QO', 1), ('QS', 1), ('QT', 1), ('QX', 1)])
+        '''
+        if not hasattr(quarantine_file, 'write'):
+            quarantine_file = open(quarantine_file, 'w')
+        self.quarantine = Quarantine(quarantine_file)
+
+    def save_snapshot(self, snapshot_file):
+        '''Saves the loaded journeys, locations and vehicle types in a
+        binary file, which load_snapshot can load much more quickly than
+        parsing the original ATCO-CIF files. The file holds flat columns of
+        values, which are mapped into memory when it is loaded; nothing is
+        pickled, so loading a snapshot can't run code.
+
+        >>> import tempfile
+        >>> atco = ATCO(compact_hops = True)
+        >>> atco.read_string("""ATCO-CIF0510                       70 - RAIL        ATCORAIL20080124115909
+        ... QSNGW    6B1820070521200712071111100  2B02P10452TRAIN           I
+        ... QE20071225200712250
+        ... QO9100MDNHEAD 0549URLT1  
+        ... QI9100COOKHAM 05560000D   T1  
+        ... QT9100MARLOW  0612   T1  
+        ... QLN9100COOKHAM Cookham Rail Station                             RE0057284
+        ... QBN9100COOKHAM 488690  185060                                                  
+        ... QVNTRAIN   Heavy Rail              
+        ... """)
+        >>> n = tempfile.NamedTemporaryFile()
+        >>> atco.save_snapshot(n.name)
+        >>> atco2 = ATCO()
+        >>> atco2.load_snapshot(n.name)
+        >>> atco2.journeys[0].hops[1].location, atco2.journeys[0].hops[1].published_departure_time
+        ('9100COOKHAM', datetime.time(5, 56))
+        >>> atco2.journeys[0].hops[0].line, atco2.journeys[0].hops[0].bay_number
+        ('QO9100MDNHEAD 0549URLT1  ', 'URL')
+        >>> atco2.journeys[0].is_valid_on_date(datetime.date(2007, 12, 25))
+        BoolWithReason(False, '2007-12-25 not in range of exceptional date records')
+        >>> atco2.locations[0].long_description(), atco2.file_loading_number
+        ('Cookham Rail Station', 1)
+        >>> atco2.locations[0].additional.grid_reference_easting, atco2.vehicle_types[0].vehicle_long_type
+        (488690, 'Heavy Rail')
+        >>> open(n.name, 'wb').write('something else')
+        >>> atco2.load_snapshot(n.name) # doctest: +ELLIPSIS
+        Traceback (most recent call last):
+            ...
+        Exception: Not an ATCO-CIF snapshot file: ...
+        '''
+        loaded_files = _LoadedFiles(getattr(self, 'file_header', None), self.file_loading_number,
+            self.vehicle_type_to_code, self.journeys + self.locations + self.vehicle_types)
+        _write_snapshot(snapshot_file, loaded_files)
+
+    def load_snapshot(self, snapshot_file):
+        '''Loads a file made by save_snapshot, adding its contents to what is
+        already loaded. See save_snapshot for examples.'''
+        self._merge_loaded_files(_read_snapshot(snapshot_file))
+
     def __str__(self):
         ret = str(self.file_header) + "\n"
         for journey in self.journeys:
@@ -113,12 +356,72 @@ class ATCO(object):
             ret = ret + str(vehicle_type) + "\n"
         return ret
 
-    def read_files(self, files):
-        '''Loads in multiple ATCO-CIF files.'''
-        for file in files:
-            self.read(file)
+    def read_files(self, files, processes = 1):
+        '''Loads in multiple ATCO-CIF files. If processes is more than one,
+        the files are parsed in that many worker processes. The results are
+        merged back in the order the files were given, so it ends up just as if
+        they had been loaded one after another.
 
-    def read(self, f):
+        >>> import tempfile
+        >>> files = []
+        >>> for journey_line in ['QSNGW    6B1820070521200712071111100  2B02P10452TRAIN           I',
+        ...                      'QSNCH   2933E20071008200712071111100  1H49P80092TRAIN           I']:
+        ...     n = tempfile.NamedTemporaryFile()
+        ...     n.write("ATCO-CIF0510                       70 - RAIL        ATCORAIL20080124115909\\n" + journey_line + "\\n")
+        ...     n.flush()
+        ...     files.append(n)
+        >>> atco = ATCO()
+        >>> atco.read_files([n.name for n in files], processes = 2)
+        >>> [(journey.id, journey.file_loading_number) for journey in atco.journeys]
+        [('GW-6B18', 1), ('CH-2933E', 2)]
+        >>> atco.file_loading_number
+        2
+        '''
+        if processes <= 1 or len(files) <= 1:
+            for file in files:
+                self.read(file)
+            return
+        if self.quarantine is not None:
+            raise Exception("Can't read files in parallel with a quarantine")
+
+        options = self._loading_options()
+        pool = multiprocessing.Pool(processes)
+        # Unpickling the results makes lots of objects, none of which are
+        # garbage, so stop the cyclic garbage collector repeatedly scanning them.
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for loaded_files in pool.imap(_read_file_in_worker, [ (file, options) for file in files ]):
+                self._merge_loaded_files(loaded_files)
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+            pool.close()
+            pool.join()
+
+    def _loading_options(self):
+        '''Settings which affect parsing, passed on to worker processes.'''
+        return { 'assume_no_holidays' : self.assume_no_holidays,
+                 'line_patches' : self.line_patches,
+                 'locations_to_ignore' : self.locations_to_ignore,
+                 'restrict_date_range' : (self.restrict_date_range_start, self.restrict_date_range_end) }
+
+    def _merge_loaded_files(self, loaded_files):
+        '''Adds the items from a _LoadedFiles, renumbering the files that
+        they came from to follow on from those already loaded.'''
+        offset = self.file_loading_number
+        for number in range(1, loaded_files.file_count + 1):
+            self.vehicle_type_to_code[offset + number] = loaded_files.vehicle_type_to_code.get(number, {})
+        self.file_loading_number += loaded_files.file_count
+        if loaded_files.file_header is not None:
+            self.file_header = loaded_files.file_header
+
+        for item in loaded_files.items:
+            if isinstance(item, JourneyHeader):
+                item.file_loading_number += offset
+            self.item_loaded(item)
+
+    def read(self, f, journey_filter = None, location_filter = None):
         '''Loads an ATCO-CIF file from a file.
 
         >>> import tempfile
@@ -129,48 +432,420 @@ class ATCO(object):
         >>> atco.read(n.name)
         >>> n.close()
 
-        Will also read CIF files from within a ZIP file.
+        Will also read CIF files from within a ZIP file, and CIF files compressed
+        with gzip, bzip2 or xz (if the lzma module is available). These are
+        decompressed a block at a time by another thread while the lines are
+        parsed, and progress is shown by how much of the compressed file has
+        been read.
+
+        >>> import gzip
+        >>> n = tempfile.NamedTemporaryFile(suffix = '.gz')
+        >>> g = gzip.GzipFile(fileobj = n, mode = 'wb')
+        >>> g.writelines(["""ATCO-CIF0510                       70 - RAIL        ATCORAIL20080124115909
+        ... QSNGW    6B1820070521200712071111100  2B02P10452TRAIN           I
+        ... QO9100MDNHEAD 0549URLT1  
+        ... QT9100MARLOW  0612   T1  
+        ... """])
+        >>> g.close()
+        >>> n.flush()
+        >>> atco = ATCO()
+        >>> atco.read(n.name)
+        >>> [ hop.location for hop in atco.journeys[0].hops ]
+        ['9100MDNHEAD', '9100MARLOW']
+
+        Only some of the journeys and locations can be loaded, by giving
+        functions which return whether to keep them. journey_filter is called
+        with each JourneyHeader as soon as its QS record is read, before its
+        date running exceptions or hops, and the records of those it rejects
+        are skipped without being parsed. location_filter is called with each
+        Location once its QB record has been read, so it can look at the grid
+        reference. The number of records of each type skipped is added up in
+        skipped_records. Snapshot caching isn't used when there are filters, or
+        a quarantine (see register_quarantine).
+
+        >>> atco = ATCO()
+        >>> atco.read_string("""ATCO-CIF0510                       70 - RAIL        ATCORAIL20080124115909
+        ... QSNGW    6B1820070521200712071111100  2B02P10452TRAIN           I
+        ... QO9100MDNHEAD 0549URLT1  
+        ... QT9100MARLOW  0612   T1  
+        ... QSNCH   2933E20071008200712071111100  1H49P80092TRAIN           I
+        ... QE20071225200712250
+        ... QO9100PRINRIS 16362  T1  
+        ... QI9100SUNDRTN 16401640T   T1  
+        ... QT9100MARYLBN 17286  T1  
+        ... QLN9100MARLOW  Marlow Rail Station                              RE0057285
+        ... QBN9100MARLOW  485100  186500                                                  
+        ... QLN9100COOKHAM Cookham Rail Station                             RE0057284
+        ... QBN9100COOKHAM 488690  185060                                                  
+        ... """, journey_filter = lambda journey: journey.operator == 'GW',
+        ...      location_filter = lambda location: location.additional.grid_reference_easting < 488000)
+        >>> [ journey.id for journey in atco.journeys ], [ location.location for location in atco.locations ]
+        (['GW-6B18'], ['9100MARLOW'])
+        >>> sorted(atco.skipped_records.items())
+        [('QB', 1), ('QE', 1), ('QI', 1), ('QL', 1), ('QO', 1), ('QS', 1), ('QT', 1)]
         '''
 
+        if self.snapshot_cache_directory is not None and journey_filter is None and location_filter is None and self.quarantine is None:
+            self._read_using_snapshot_cache(f)
+            return
+
+        for h, file_len in self._open_cif_files(f):
+            self.read_file_handle(h, file_len, journey_filter, location_filter)
+
+    def _read_using_snapshot_cache(self, f):
+        snapshot_file = os.path.join(self.snapshot_cache_directory, self._snapshot_cache_key(f) + '.snapshot')
+        loaded_files = None
+        if os.path.exists(snapshot_file):
+            try:
+                logging.info("reading snapshot of " + f + " from " + snapshot_file)
+                loaded_files = _read_snapshot(snapshot_file)
+            except Exception, e:
+                logging.warning("ignoring snapshot " + snapshot_file + " which can't be read: " + str(e))
+        if loaded_files is None:
+            collector = _ItemCollector(self._loading_options(), show_progress = self.show_progress)
+            collector.read(f)
+            loaded_files = collector.loaded_files()
+            _write_snapshot(snapshot_file, loaded_files)
+        self._merge_loaded_files(loaded_files)
+
+    def _snapshot_cache_key(self, f):
+        '''Returns a hash of everything which affects what is loaded from f.'''
+        stat = os.stat(f)
+        options = self._loading_options()
+        key = hashlib.sha1()
+        key.update(repr((SNAPSHOT_VERSION, os.path.abspath(f), stat.st_size, stat.st_mtime,
+            options['assume_no_holidays'], sorted(options['line_patches'].items()),
+            sorted(options['locations_to_ignore']), options['restrict_date_range'])))
+        if self.snapshot_cache_hash_contents:
+            h = open(f, 'rb')
+            try:
+                while True:
+                    data = h.read(1024 * 1024)
+                    if not data:
+                        break
+                    key.update(data)
+            finally:
+                h.close()
+        return key.hexdigest()
+
+    def _open_cif_files(self, f):
+        '''Generator which yields a handle and length for the CIF file f, or
+        for each CIF file within it if it is a ZIP file. The handles of
+        compressed files read ahead in another thread, and their tell and
+        length are of the compressed data.'''
+
         # See if it is a zip file, in which case load each file within it
         if zipfile.is_zipfile(f):
-            zf = zipfile.ZipFile(f, 'r')
-            for zipfilename in zf.namelist():
-                logging.info("reading zip file " + f + ", internal file " + zipfilename)
-                data = zf.read(zipfilename)
-                # XXX won't recurse into zip files in zip files, but so what
-                self.read_string(data)
+            archive = open(f, 'rb')
+            try:
+                zf = zipfile.ZipFile(archive, 'r')
+                for info in zf.infolist():
+                    logging.info("reading zip file " + f + ", internal file " + info.filename)
+                    # XXX won't recurse into zip files in zip files, but so what
+                    h = _ReadAhead(_zip_member_blocks(archive, zf.open(info), info))
+                    try:
+                        yield h, info.compress_size
+                    finally:
+                        h.close()
+            finally:
+                archive.close()
+            return
+
+        new_decompressor = _decompressor_for(f)
+        if new_decompressor is not None:
+            logging.info("reading compressed CIF file " + f)
+            compressed = open(f, 'rb')
+            h = _ReadAhead(_decompressed_blocks(compressed, new_decompressor))
+            try:
+                yield h, os.fstat(compressed.fileno()).st_size
+            finally:
+                h.close()
+                compressed.close()
         else:
             # Otherwise, just read it
             logging.info("reading CIF file " + f)
-            return self.read_file_handle(open(f), os.stat(f)[6])
+            yield open(f), os.stat(f)[6]
 
-    def read_string(self, s):
-        '''Loads an ATCO-CIF file from a string.
+    def read_string(self, s, journey_filter = None, location_filter = None):
+        '''Loads an ATCO-CIF file from a string. The filters are as for read.
 
         >>> atco = ATCO()
         >>> atco.read_string('ATCO-CIF0510      Buckinghamshire - COACH             ATCOPT20080126111426')
         '''
         h = StringIO.StringIO(s)
-        return self.read_file_handle(h, len(s))
+        return self.read_file_handle(h, len(s), journey_filter, location_filter)
 
     def item_loaded(self, item):
         ''' Override this function if, for example, you want to stream the
         journeys in, rather than store them all in Python in memory.'''
 
+        if self.load_statistics is not None:
+            # before the hops go into a store, while they are still records
+            self.load_statistics.item_loaded(item)
         if isinstance(item, JourneyHeader):
+            if self.hop_store is not None:
+                self.hop_store.add_journey(item)
+            elif self.pattern_store is not None:
+                self.pattern_store.add_journey(item)
             self.journeys.append(item)
+            if self._calendar_journeys is not None:
+                # journeys_running_on compiles the calendar again when next asked
+                self._calendar_journeys = None
+                self.journeys_running_on_date = {}
+            if self.index_while_loading:
+                if _indexed_all_but_last(self._indexed_journeys, self.journeys):
+                    self._index_journey(item)
+                    self._indexed_journeys = (self.journeys, len(self.journeys), item)
+                else:
+                    self._indexed_journeys = None # until index_by_short_codes
         elif isinstance(item, Location):
+            self.location_ids.add(item.location)
             self.locations.append(item)
+            if self.index_while_loading:
+                if _indexed_all_but_last(self._indexed_locations, self.locations):
+                    self.location_from_id[item.location] = item
+                    self._indexed_locations = (self.locations, len(self.locations), item)
+                else:
+                    self._indexed_locations = None
         elif isinstance(item, VehicleType):
             self.vehicle_types.append(item)
         else:
             assert False
 
-    def read_file_handle(self, h, file_len):
-        '''Loads an ATCO-CIF file from a file handle.'''
-        self.handle = h
+    def iter_items(self, f, journey_filter = None, location_filter = None):
+        '''Generator which yields each journey, location and vehicle type from
+        an ATCO-CIF file in turn, once all of its records have been read. Nothing
+        is kept in self.journeys etc., so this is useful for passing once over
+        large amounts of data without holding it all in memory. f is either a
+        file handle, or a file name (of a CIF or ZIP file, as for read). The
+        filters are also as for read.
 
+        >>> atco = ATCO()
+        >>> h = StringIO.StringIO("""ATCO-CIF0510                       70 - RAIL        ATCORAIL20080124115909
+        ... QSNGW    6B1820070521200712071111100  2B02P10452TRAIN           I
+        ... QO9100MDNHEAD 0549URLT1  
+        ... QT9100MARLOW  0612   T1  
+        ... QLN9100MARLOW  Marlow Rail Station                              RE0057285
+        ... QBN9100MARLOW  485100  186500                                                  
+        ... """)
+        >>> for item in atco.iter_items(h):
+        ...     print item.__class__.__name__, len(getattr(item, 'hops', []))
+        JourneyHeader 2
+        Location 0
+        >>> atco.journeys, atco.locations
+        ([], [])
+        '''
+        if hasattr(f, 'readline'):
+            handles = [ (f, _handle_length(f)) ]
+        else:
+            handles = self._open_cif_files(f)
+        for h, file_len in handles:
+            for item in self._parse_file_handle(h, file_len, journey_filter, location_filter):
+                yield item
+
+    def read_file_handle(self, h, file_len, journey_filter = None, location_filter = None):
+        '''Loads an ATCO-CIF file from a file handle. The filters are as for read.'''
+        for item in self._parse_file_handle(h, file_len, journey_filter, location_filter):
+            self.item_loaded(item)
+
+    def read_lazily(self, f):
+        '''Loads an ATCO-CIF file like read, except that the hops of each
+        journey are only parsed when journey.hops is first used. The file is
+        memory mapped, and one quick pass over it notes where each journey's
+        hops are and which stops they visit, so it mustn't change while the
+        journeys are in use. ZIP and compressed files can't be read lazily.
+
+        This also keeps journey_from_id, journeys_visiting_location and
+        location_from_id up to date, as index_by_short_codes makes them, so
+        journeys can be found by id or by stop without parsing any hops. If
+        the indexes didn't cover everything loaded before, calling
+        index_by_short_codes afterwards makes them again, parsing all the hops.
+
+        >>> import tempfile
+        >>> n = tempfile.NamedTemporaryFile()
+        >>> n.write("""ATCO-CIF0510                       70 - RAIL        ATCORAIL20080124115909
+        ... QSNGW    6B1820070521200712071111100  2B02P10452TRAIN           I
+        ... QO9100MDNHEAD 0549URLT1  
+        ... QI9100FURZEP  05530553T   T1  
+        ... QT9100MARLOW  0612   T1  
+        ... QSNGW    6B1A20070521200712071111100  2B04P10456TRAIN           I
+        ... QE20070523200705230
+        ... QO9100MDNHEAD 0608URLT1  
+        ... QT9100BORNEND 0620   T1  
+        ... QLN9100MARLOW  Marlow Rail Station                              RE0057285
+        ... QBN9100MARLOW  485100  186500                                                  
+        ... """)
+        >>> n.flush()
+        >>> atco = ATCO()
+        >>> atco.read_lazily(n.name)
+        >>> sorted([ journey.id for journey in atco.journeys_visiting_location['9100MDNHEAD'] ])
+        ['GW-6B18', 'GW-6B1A']
+        >>> [ journey.id for journey in atco.journeys_visiting_location['9100MARLOW'] ]
+        ['GW-6B18']
+        >>> journey = atco.journey_from_id['GW-6B1A']
+        >>> 'hops' in journey.__dict__, bool(journey.is_valid_on_date(datetime.date(2007, 5, 23)))
+        (False, False)
+        >>> [ hop.location for hop in journey.hops ], 'hops' in journey.__dict__
+        (['9100MDNHEAD', '9100BORNEND'], True)
+        >>> atco.location_from_id['9100MARLOW'].long_description()
+        'Marlow Rail Station'
+        '''
+        if self.hop_store is not None or self.pattern_store is not None:
+            raise Exception("Can't read lazily with compact_hops or share_patterns, which need all the hops")
+        if self.quarantine is not None:
+            raise Exception("Can't read lazily with a quarantine, as the hops are parsed later")
+        if zipfile.is_zipfile(f):
+            raise Exception("Can't read ZIP files lazily: " + f)
+        if _decompressor_for(f) is not None:
+            raise Exception("Can't read compressed files lazily: " + f)
+
+        h = open(f, 'rb')
+        try:
+            mapped_file = mmap.mmap(h.fileno(), 0, access = mmap.ACCESS_READ)
+        finally:
+            h.close()
+        logging.info("reading CIF file " + f + " lazily")
+
+        if not self.journeys and not self.locations:
+            self.journey_from_id = {}
+            self.journeys_visiting_location = LocationIndex(self.location_ids)
+            self.location_from_id = LocationIndex(self.location_ids)
+            self._indexed_journeys = (self.journeys, 0, None)
+            self._indexed_locations = (self.locations, 0, None)
+        indexed_before = _indexed_all(self._indexed_journeys, self.journeys) and _indexed_all(self._indexed_locations, self.locations)
+        for name in ('journey_from_id', 'journeys_visiting_location', 'location_from_id'):
+            if not hasattr(self, name):
+                setattr(self, name, name == 'journey_from_id' and {} or LocationIndex(self.location_ids))
+        locations_to_ignore = self.locations_to_ignore
+        source = _LazyHops(mapped_file, self.line_patches, locations_to_ignore)
+        scanner = _LazyScanner(mapped_file, self.line_patches)
+        stop_ids = {} # from stops as they are in the file, None for those ignored
+        for item in self._parse_file_handle(scanner, len(mapped_file)):
+            if isinstance(item, JourneyHeader):
+                start, end, stops = scanner.journeys.popleft()
+                del item.hops
+                del item.hop_lines
+                item.lazy_hops = (source, start, end)
+                self.journey_from_id[item.id] = item
+                for stop in stops:
+                    location_id = stop_ids.get(stop, -1)
+                    if location_id == -1:
+                        location = _cached_location(stop)
+                        location_id = None
+                        if location not in locations_to_ignore:
+                            location_id = self.location_ids.add(location)
+                        stop_ids[stop] = location_id
+                    if location_id is not None:
+                        dict.setdefault(self.journeys_visiting_location, location_id, set()).add(item)
+            elif isinstance(item, Location):
+                self.location_from_id[item.location] = item
+            self.item_loaded(item)
+        if indexed_before:
+            self._indexed_journeys = (self.journeys, len(self.journeys), self.journeys and self.journeys[-1] or None)
+            self._indexed_locations = (self.locations, len(self.locations), self.locations and self.locations[-1] or None)
+
+    def read_arrays(self, f):
+        '''Decodes an ATCO-CIF file, or each CIF file in a ZIP file, into NumPy
+        arrays, for analysing a lot of data without making an object for every
+        record. The whole file is read into memory, and the lines of each type
+        of record are decoded a column at a time. See CIFArrays for what comes
+        back. Line patches and locations to ignore are applied, but nothing is
+        added to self.journeys etc. and the records aren't checked as
+        thoroughly as by read; only the numeric columns are checked. Needs NumPy.
+
+        >>> import tempfile
+        >>> n = tempfile.NamedTemporaryFile()
+        >>> n.write("""ATCO-CIF0510                       70 - RAIL        ATCORAIL20080124115909
+        ... QSNGW    6B1820070521200712071111100  2B02P10452TRAIN           I
+        ... QE20070523200705230
+        ... QO9100MDNHEAD 0549URLT1  
+        ... QI9100FURZEP  05530553T   T1  
+        ... QT9100MARLOW  2412   T1  
+        ... QSNGW    6B1A20070521200712071111100  2B04P10456TRAIN           I
+        ... QO9100MDNHEAD 0608URLT1  
+        ... QT9100BORNEND 0620   T1  
+        ... QLN9100MARLOW  Marlow Rail Station                              RE0057285
+        ... QBN9100MARLOW  485100  186500                                                  
+        ... """)
+        >>> n.flush()
+        >>> atco = ATCO()
+        >>> arrays = atco.read_arrays(n.name)
+        >>> len(arrays.journeys), len(arrays.hops), atco.journeys
+        (2, 5, [])
+        >>> list(arrays.journeys['unique_journey_identifier']), list(arrays.journeys['operates_on_day_of_week'])
+        (['6B18', '6B1A'], [31, 31])
+        >>> arrays.journeys[0]['first_date_of_operation'] == datetime.date(2007, 5, 21).toordinal()
+        True
+        >>> list(arrays.hops['journey']), list(arrays.hops['location'])
+        ([0, 0, 0, 1, 1], ['9100MDNHEAD', '9100FURZEP', '9100MARLOW', '9100MDNHEAD', '9100BORNEND'])
+        >>> list(arrays.hops['published_departure_time'][:3]), list(arrays.hops['published_arrival_time'][:3])
+        ([349, 353, 65535], [65535, 353, 12])
+        >>> list(arrays.hops['activity_flag']), list(arrays.hops['fare_stage_indicator'][:2])
+        (['<', 'T', '>', '<', '>'], [-1, -1])
+        >>> [ list(arrays.hops_of(journey)['location']) for journey in range(2) ][1]
+        ['9100MDNHEAD', '9100BORNEND']
+        >>> arrays.date_running_exceptions[['journey', 'operation_code']].tolist()
+        [(0, 0)]
+        >>> arrays.locations[['location', 'full_location']].tolist(), arrays.location_additionals['grid_reference_easting'].tolist()
+        ([('9100MARLOW', 'Marlow Rail Station')], [485100])
+
+        Badly formatted numbers are found.
+        >>> n.seek(0)
+        >>> n.write(n.read().replace("QO9100MDNHEAD 0549", "QO9100MDNHEAD 05X9"))
+        >>> n.flush()
+        >>> atco.read_arrays(n.name)
+        Traceback (most recent call last):
+            ...
+        Exception: JourneyOrigin line incorrectly formatted: QO9100MDNHEAD 05X9URLT1  
+        '''
+        if numpy is None:
+            raise Exception("NumPy is needed to read ATCO-CIF files into arrays")
+        arrays = []
+        for h, file_len in self._open_cif_files(f):
+            try:
+                data = h.read()
+            finally:
+                h.close()
+            if self.line_patches:
+                data = "\n".join([ self.line_patches.get(line, line) for line in data.replace("\r", "").split("\n") ])
+            arrays.append(CIFArrays.decode(data, self.locations_to_ignore))
+        return CIFArrays.concatenate(arrays)
+
+    def freeze(self):
+        '''Returns a FrozenATCO with copies of the journeys, locations and
+        indexes in flat shared memory, for a parent process to make before
+        forking worker processes which only read them. See FrozenATCO. The
+        unique memory of the process before and after is logged; to get the
+        benefit, drop this ATCO afterwards so that its objects are freed.'''
+        before = unique_set_size()
+        frozen = FrozenATCO(self)
+        logging.info("froze %d journeys, %d hops and %d locations into %d bytes of shared memory, "
+            "unique memory was %s bytes and is %s bytes" % (len(frozen.journeys), len(frozen.hop_columns),
+            len(frozen.locations), len(frozen.buffers.mapped), before, unique_set_size()))
+        return frozen
+
+    def _parse_file_handle(self, h, file_len, journey_filter = None, location_filter = None):
+        '''Generator which parses an ATCO-CIF file from a file handle, yielding
+        each item once all the records relating to it have been read, if the
+        filters (see read) want it.'''
+        items = self._parse_all_of_file_handle(h, file_len, journey_filter)
+        if self.load_profile is not None:
+            items = self.load_profile.time_callbacks(items)
+        if location_filter is None:
+            return items
+        return self._filter_locations(items, location_filter)
+
+    def _filter_locations(self, items, location_filter):
+        skipped_records = self.skipped_records
+        for item in items:
+            if isinstance(item, Location) and not location_filter(item):
+                skipped_records['QL'] = skipped_records.get('QL', 0) + 1
+                if item.additional is not None:
+                    skipped_records['QB'] = skipped_records.get('QB', 0) + 1
+                continue
+            yield item
+
+    def _parse_all_of_file_handle(self, h, file_len, journey_filter):
         self.file_loading_number += 1
         if not self.file_loading_number in self.vehicle_type_to_code:
             self.vehicle_type_to_code[self.file_loading_number] = {}
@@ -180,14 +855,45 @@ class ATCO(object):
                        ' ', progressbar.ETA(), ' ', progressbar.FileTransferSpeed()]
             pbar = progressbar.ProgressBar(widgets=widgets, maxval=file_len).start()
 
-        line = self.handle.readline().strip("\n\r")
+        line = h.readline().strip("\n\r")
         self.file_header = FileHeader(line)
 
         # Load in every record - each record is one line of the file
+        line_patches = self.line_patches
+        locations_to_ignore = self.locations_to_ignore
+        vehicle_type_to_code = self.vehicle_type_to_code[self.file_loading_number]
+        skipped_records = self.skipped_records
+        # record identities of the rest of a journey rejected by journey_filter,
+        # or of an item put in quarantine, which are passed over
+        skipping = None
+        rejecting = False # whether those are being put in quarantine
+        quarantine = self.quarantine
+        item_lines = [] # numbers and lines of the current item, when quarantining
         current_item = None
-        for line in self.handle:
-            if self.show_progress:
-                pbar.update(self.handle.tell())
+
+        # Updating the progress bar and profile on every line is slow, so
+        # only do it every so many lines
+        profile = self.load_profile
+        if profile is not None:
+            if journey_filter is not None:
+                journey_filter = profile.timed_callback(journey_filter)
+            profile.start_file(self.load_profile_callback, self.load_profile_interval)
+            finished = time.time()
+        lines_until_progress = _PROGRESS_LINES
+        for line_number, line in enumerate(h, 2):
+            lines_until_progress -= 1
+            if not lines_until_progress:
+                lines_until_progress = _PROGRESS_LINES
+                if self.show_progress:
+                    pbar.update(h.tell())
+                if profile is not None:
+                    profile.progress()
+            if profile is not None:
+                started = time.time()
+                profile.read_seconds += started - finished
+                profile.bytes += len(line)
+                callback_seconds = profile.callback_seconds
+                parsed = None
 
             line = line.strip("\n\r")
             if not line:
@@ -195,62 +901,94 @@ class ATCO(object):
             #logging.debug(line)
 
             # apply any line patches
-            if line in self.line_patches:
-                line = self.line_patches[line]
+            if line in line_patches:
+                line = line_patches[line]
 
             record_identity = line[0:2]
-            record = None
+
+            # skip over the rest of the records of journeys that aren't wanted
+            if skipping is not None:
+                if record_identity in skipping:
+                    if rejecting:
+                        quarantine.add_record(line_number, line)
+                    else:
+                        skipped_records[record_identity] = skipped_records.get(record_identity, 0) + 1
+                    continue
+                skipping = None
+                rejecting = False
+
+            if quarantine is not None:
+                if record_identity in _ITEM_RECORD_IDENTITIES:
+                    item_lines = []
+                item_lines.append((line_number, line))
 
             try:
-                # Journeys - store the clump of records relating to one journey 
-                if record_identity == 'QS':
-                    if current_item != None:
-                        self.item_loaded(current_item)
-                    current_item = JourneyHeader(line, self.file_loading_number, assume_no_holidays = True)
-                elif record_identity == 'QE':
+                # Journeys - store the clump of records relating to one journey.
+                # The hops are by far the most common records, so check them first.
+                if record_identity == 'QI':
                     assert isinstance(current_item, JourneyHeader)
-                    current_item.add_date_running_exception(JourneyDateRunning(line), self.restrict_date_range_start, self.restrict_date_range_end)
+                    ji = JourneyIntermediate(line)
+                    if profile is not None:
+                        parsed = time.time()
+                    if ji.location not in locations_to_ignore:
+                        current_item.add_hop(ji)
                 elif record_identity == 'QO':
                     assert isinstance(current_item, JourneyHeader)
                     jo = JourneyOrigin(line)
-                    if jo.location not in self.locations_to_ignore:
+                    if profile is not None:
+                        parsed = time.time()
+                    if jo.location not in locations_to_ignore:
                         current_item.add_hop(jo)
-                elif record_identity == 'QI':
-                    assert isinstance(current_item, JourneyHeader)
-                    ji = JourneyIntermediate(line)
-                    if ji.location not in self.locations_to_ignore:
-                        current_item.add_hop(ji)
                 elif record_identity == 'QT':
                     assert isinstance(current_item, JourneyHeader)
                     jd = JourneyDestination(line)
-                    if jd.location not in self.locations_to_ignore:
+                    if profile is not None:
+                        parsed = time.time()
+                    if jd.location not in locations_to_ignore:
                         current_item.add_hop(jd)
+                elif record_identity == 'QS':
+                    new_item = JourneyHeader(line, self.file_loading_number, assume_no_holidays = True)
+                    if current_item != None:
+                        yield current_item
+                    current_item = new_item
+                    if journey_filter is not None and not journey_filter(current_item):
+                        skipped_records['QS'] = skipped_records.get('QS', 0) + 1
+                        skipping = _JOURNEY_RECORD_IDENTITIES
+                        current_item = None
+                elif record_identity == 'QE':
+                    assert isinstance(current_item, JourneyHeader)
+                    date_running = JourneyDateRunning(line)
+                    if profile is not None:
+                        parsed = time.time()
+                    current_item.add_date_running_exception(date_running, self.restrict_date_range_start, self.restrict_date_range_end)
                 
                 # Locations - store the group of records relating to one location
                 elif record_identity == 'QL':
                     new_item = Location(line)
-                    if new_item.location not in self.locations_to_ignore:
+                    if new_item.location not in locations_to_ignore:
                         if current_item != None:
-                            self.item_loaded(current_item)
+                            yield current_item
                         current_item = new_item
                 elif record_identity == 'QB':
                     la = LocationAdditional(line)
-                    if la.location not in self.locations_to_ignore:
+                    if profile is not None:
+                        parsed = time.time()
+                    if la.location not in locations_to_ignore:
                         assert isinstance(current_item, Location)
                         current_item.add_additional(la)
 
                 # Vehicle types
                 elif record_identity == 'QV':
                     new_item = VehicleType(line)
-                    if current_item != None:
-                        self.item_loaded(current_item)
-                    current_item = new_item
                     # There aren't many vehicle types, just always index them
-                    if current_item.vehicle_type in self.vehicle_type_to_code[self.file_loading_number]:
-                        if self.vehicle_type_to_code[self.file_loading_number][current_item.vehicle_type] != current_item.type_code():
-                            raise Exception("Inconsistent vehicle type codes; previously had " + self.vehicle_type_to_code[self.file_loading_number][current_item.vehicle_type] + " for type " + current_item.vehicle_type + " when this line has " + current_item.type_code() + ", line is: " + line)
+                    if new_item.vehicle_type in vehicle_type_to_code:
+                        if vehicle_type_to_code[new_item.vehicle_type] != new_item.type_code():
+                            raise Exception("Inconsistent vehicle type codes; previously had " + vehicle_type_to_code[new_item.vehicle_type] + " for type " + new_item.vehicle_type + " when this line has " + new_item.type_code() + ", line is: " + line)
                     else:
-                        self.vehicle_type_to_code[self.file_loading_number][current_item.vehicle_type] = current_item.type_code()
+                        vehicle_type_to_code[new_item.vehicle_type] = new_item.type_code()
+                    if current_item != None:
+                        yield current_item
+                    current_item = new_item
                 # Other
                 elif record_identity in [
                     'QP',  # Operator record
@@ -259,19 +997,48 @@ class ATCO(object):
                 ]:
                     logging.debug("Ignoring record type '" + record_identity + "'")
                 else:
-                    import pdb;pdb.set_trace()
                     raise Exception("Unknown record type '" + record_identity + "'")
-            except:
-                # Show what line we were on, and reraise exception
-                logging.error("Exception caught reading line: " + line)
-                raise
+            except Exception, e:
+                if quarantine is None or (current_item is not None and current_item.line is line):
+                    # Show what line we were on, and reraise exception. (If the
+                    # current item is from this line, it came from journey_filter.)
+                    logging.error("Exception caught reading line " + str(line_number) + ": " + line)
+                    raise
+                if record_identity in _ITEM_RECORD_IDENTITIES:
+                    # Each item is made and checked before the one before it
+                    # is yielded, so that one is still to go
+                    if current_item is not None:
+                        yield current_item
+                    rejected = record_identity
+                elif current_item is not None and record_identity in _ITEM_RECORD_IDENTITIES[current_item.record_identity]:
+                    rejected = current_item.record_identity
+                else:
+                    # of an unknown type or out of place, so on its own
+                    rejected = None
+                    item_lines.pop()
+                if rejected is None:
+                    quarantine.reject(self.file_loading_number, line_number, e, [ (line_number, line) ], None)
+                else:
+                    quarantine.reject(self.file_loading_number, line_number, e, item_lines, rejected)
+                    current_item = None
+                    skipping = _ITEM_RECORD_IDENTITIES[rejected]
+                    rejecting = True
 
-        if current_item != None:
-            self.item_loaded(current_item)
+            if profile is not None:
+                # not counting time in item_loaded etc. while the generator yielded
+                finished = time.time()
+                profile.record_parsed(record_identity, started, parsed, finished, profile.callback_seconds - callback_seconds)
 
         if self.show_progress:
             pbar.finish()
 
+        if current_item != None:
+            yield current_item
+        if profile is not None:
+            profile.finish_file()
+        if quarantine is not None:
+            quarantine.h.flush()
+
     def index_by_short_codes(self):
         '''Make dictionaries so it is quick to look up all journeys visiting a
         particular location, and to get details about a location from its identifier.
@@ -294,19 +1061,104 @@ class ATCO(object):
         ... """)
         >>> atco.index_by_short_codes()
         >>> journeys_visiting_cookham = atco.journeys_visiting_location["9100COOKHAM"]
-        >>> [x.id for x in journeys_visiting_cookham]
-        ['GW-6B1A', 'GW-6B18']
+        >>> sorted([x.id for x in journeys_visiting_cookham])
+        ['GW-6B18', 'GW-6B1A']
         >>> atco.location_from_id["9100COOKHAM"].long_description()
         'Cookham Rail Station'
+        >>> atco.journey_from_id["GW-6B1A"].hops[-1].location
+        '9100BORNEND'
+
+        The location indexes are keyed by the location ids in atco.location_ids, which can be
+        used instead of the short codes. Iterating over them still gives the short codes.
+        >>> cookham = atco.location_ids["9100COOKHAM"]
+        >>> atco.location_ids.codes[cookham]
+        '9100COOKHAM'
+        >>> len(atco.journeys_visiting_location[cookham])
+        2
+        >>> sorted(atco.journeys_visiting_location), atco.location_from_id.keys()
+        (['9100BORNEND', '9100COOKHAM', '9100FURZEP', '9100MARLOW', '9100MDNHEAD'], ['9100COOKHAM'])
+
+        The indexes are only made again if journeys or locations have been
+        loaded or removed since. With ATCO(index_while_loading = True), they
+        are kept up to date as each journey and location is loaded, so loading
+        another file just adds its items to them. Removing items from
+        self.journeys or self.locations makes them out of date, until this is
+        called again; the change is noticed, unless it leaves each list with
+        the same length and last item.
+        >>> atco = ATCO(index_while_loading = True)
+        >>> atco.read_string("""ATCO-CIF0510                       70 - RAIL        ATCORAIL20080124115909
+        ... QSNGW    6B1820070521200712071111100  2B02P10452TRAIN           I
+        ... QO9100MDNHEAD 0549URLT1  
+        ... QT9100MARLOW  0612   T1  
+        ... """)
+        >>> atco.read_string("""ATCO-CIF0510                       70 - RAIL        ATCORAIL20080124115909
+        ... QSNGW    6B2020070521200712071111100  2B02P10452TRAIN           I
+        ... QO9100BORNEND 0630URLT1  
+        ... QT9100MARLOW  0640   T1  
+        ... """)
+        >>> sorted([ journey.id for journey in atco.journeys_visiting_location["9100MARLOW"] ])
+        ['GW-6B18', 'GW-6B20']
+        >>> atco.journey_from_id["GW-6B20"].hops[0].location
+        '9100BORNEND'
+        >>> del atco.journeys[0]
+        >>> atco.read_string("""ATCO-CIF0510                       70 - RAIL        ATCORAIL20080124115909
+        ... QSNGW    6B2220070521200712071111100  2B02P10452TRAIN           I
+        ... QO9100BORNEND 0730URLT1  
+        ... QT9100MARLOW  0740   T1  
+        ... """)
+        >>> atco.index_by_short_codes()
+        >>> sorted([ journey.id for journey in atco.journeys_visiting_location["9100MARLOW"] ])
+        ['GW-6B20', 'GW-6B22']
+        >>> sorted(atco.journey_from_id)
+        ['GW-6B20', 'GW-6B22']
+
+        That is so however the hops are stored.
+        >>> atco = ATCO(share_patterns = True)
+        >>> atco.read_string("""ATCO-CIF0510                       70 - RAIL        ATCORAIL20080124115909
+        ... QSNGW    6B1820070521200712071111100  2B02P10452TRAIN           I
+        ... QO9100MDNHEAD 0549URLT1  
+        ... QT9100MARLOW  0612   T1  
+        ... QSNGW    6B1A20070521200712071111100  2B04P10456TRAIN           I
+        ... QO9100MDNHEAD 0608URLT1  
+        ... QT9100MARLOW  0631   T1  
+        ... """)
+        >>> del atco.journeys[0]
+        >>> atco.index_by_short_codes()
+        >>> [ journey.id for journey in atco.journeys_visiting_location["9100MDNHEAD"] ]
+        ['GW-6B1A']
         '''
 
-        self.journeys_visiting_location = {}
-        for journey in self.journeys:
+        if _indexed_all(self._indexed_journeys, self.journeys) and _indexed_all(self._indexed_locations, self.locations):
+            return
+
+        # build with location ids, so each stop's code is only looked up once per hop
+        journeys_visiting_location = {}
+        journeys = self.journeys
+        if self.pattern_store is not None:
+            # each journey visits the stops of its pattern, which are found
+            # once per pattern; the patterns also have the journeys following
+            # them, but those may since have been removed from self.journeys
+            stops_of_pattern = {}
+            other_journeys = []
+            for journey in journeys:
+                pattern = journey.__dict__.get('stop_pattern')
+                if pattern is None:
+                    other_journeys.append(journey)
+                    continue
+                stops = stops_of_pattern.get(pattern)
+                if stops is None:
+                    stops = stops_of_pattern[pattern] = set(pattern.location_id)
+                for location_id in stops:
+                    journeys_visiting_location.setdefault(location_id, set()).add(journey)
+            journeys = other_journeys
+        add_location = self.location_ids.add
+        for journey in journeys:
             for hop in journey.hops:
-                if hop.location not in self.journeys_visiting_location:
-                    self.journeys_visiting_location[hop.location] = set()
+                location_id = add_location(hop.location)
+                if location_id not in journeys_visiting_location:
+                    journeys_visiting_location[location_id] = set()
 
-                if journey in self.journeys_visiting_location[hop.location]:
+                if journey in journeys_visiting_location[location_id]:
                     if hop == journey.hops[0] and hop == journey.hops[-1]:
                         # if it's a simple loop, starting and ending at same point, then that's OK
                         logging.debug("journey " + journey.id + " loops")
@@ -314,12 +1166,39 @@ class ATCO(object):
                     else:
                         assert "same location %s appears twice in one journey %s, and not at start/end" % (hop.location, journey.id)
 
-                self.journeys_visiting_location[hop.location].add(journey)
+                journeys_visiting_location[location_id].add(journey)
+        self.journeys_visiting_location = LocationIndex(self.location_ids)
+        dict.update(self.journeys_visiting_location, journeys_visiting_location)
 
-        self.location_from_id = {}
+        self.location_from_id = LocationIndex(self.location_ids)
         for location in self.locations:
             self.location_from_id[location.location] = location
 
+        self.journey_from_id = {}
+        for journey in self.journeys:
+            self.journey_from_id[journey.id] = journey
+
+        self._indexed_journeys = (self.journeys, len(self.journeys), self.journeys and self.journeys[-1] or None)
+        self._indexed_locations = (self.locations, len(self.locations), self.locations and self.locations[-1] or None)
+
+    def _index_journey(self, journey):
+        '''Adds a journey which has just been loaded to the indexes made by
+        index_by_short_codes.'''
+        self.journey_from_id[journey.id] = journey
+        if 'lazy_hops' in journey.__dict__:
+            # read_lazily indexes its stops without parsing the hops
+            return
+        if self.pattern_store is not None:
+            location_ids = journey.stop_pattern.location_id
+        elif self.hop_store is not None:
+            location_ids = self.hop_store.location_id[journey.hops.start:journey.hops.end]
+        else:
+            add_location = self.location_ids.add
+            location_ids = [ add_location(hop.location) for hop in journey.hops ]
+        journeys_visiting_location = self.journeys_visiting_location
+        for location_id in set(location_ids):
+            dict.setdefault(journeys_visiting_location, location_id, set()).add(journey)
+
     def _test_vehicle_type_to_code(self):
         ''' An index to let you look up type of a journey given its vehicle_type is
         always made. The type codes are single characters, e.g. 'B' for bus, 'T'
@@ -361,6 +1240,8 @@ class ATCO(object):
         >>> atco.index_nearby_locations(3600) # c. 2 miles
         >>> atco.nearby_locations[atco.location_from_id['9100COOKHAM']]
         {Location('9100FURZEP'): 2754.6128584612393}
+        >>> sorted([ location.location for location in atco.nearby_locations ])
+        ['9100COOKHAM', '9100FURZEP']
         >>> atco.index_nearby_locations(10)
         >>> atco.nearby_locations[atco.location_from_id['9100COOKHAM']]
         {}
@@ -370,25 +1251,149 @@ class ATCO(object):
         if nearby_max_distance == self.nearby_max_distance:
             return
         
-        # otherwise, make it
+        # otherwise, make it, only comparing locations in neighbouring grid cells
         self.nearby_max_distance = None
-        self.nearby_locations = {}
+        # keyed by Location, as it was before there were location ids
+        locations_by_id = dict([ (self.location_ids.add(location.location), location) for location in self.locations ])
+        self.nearby_locations = LocationIndex(self.location_ids, locations_by_id.__getitem__)
+        if nearby_max_distance > 0:
+            self.location_grid = LocationGrid(self.locations, nearby_max_distance)
         for location in self.locations:
-            self.nearby_locations.setdefault(location, {})
+            nearby = self.nearby_locations.setdefault(location, {})
+            if nearby_max_distance <= 0:
+                continue
             easting = location.additional.grid_reference_easting
             northing = location.additional.grid_reference_northing
-            for other_location in self.locations:
+            for other_location, dist in self.location_grid.within(easting, northing, nearby_max_distance):
                 if location == other_location:
                     continue
-                other_easting = other_location.additional.grid_reference_easting
-                other_northing = other_location.additional.grid_reference_northing
-                sqdist = (easting-other_easting)**2 + (northing-other_northing)**2
-                if sqdist < nearby_max_distance * nearby_max_distance:
-                    dist = math.sqrt(sqdist)
-                    logging.debug("index_nearby_locations: %s (%d,%d) is %d away from %s (%d,%d)" % (location, easting, northing, dist, other_location.location, other_easting, other_northing))
-                    self.nearby_locations[location].setdefault(other_location, dist)
+                nearby.setdefault(other_location, dist)
         self.nearby_max_distance = nearby_max_distance
 
+    def locations_within(self, easting, northing, distance):
+        '''Returns a dictionary from each location less than distance away from
+        the grid reference, to how far away it is.
+
+        >>> atco = ATCO()
+        >>> atco.read_string("""ATCO-CIF0510                       70 - RAIL        ATCORAIL20080124115909
+        ... QLN9100FURZEP  Furze Platt Rail Station                         RE0043271
+        ... QBN9100FURZEP  488294  182334                                                  
+        ... QLN9100COOKHAM Cookham Rail Station                             RE0057284
+        ... QBN9100COOKHAM 488690  185060                                                  
+        ... """)
+        >>> atco.locations_within(488690, 184060, 1001)
+        {Location('9100COOKHAM'): 1000.0}
+        >>> sorted(atco.locations_within(488690, 184060, 2000).values())
+        [1000.0, 1770.844996040026]
+        '''
+        grid = getattr(self, 'location_grid', None)
+        if grid is None or grid.location_count != len(self.locations):
+            # make a grid, if there isn't one of the current locations already
+            grid = self.location_grid = LocationGrid(self.locations, distance)
+        return dict(grid.within(easting, northing, distance))
+
+    def compile_calendar(self, start_date = None, end_date = None):
+        '''Works out which days each journey runs on between the two dates, so
+        journeys_running_on and JourneyHeader.runs_on_date are quick. The dates
+        default to those given to restrict_to_date_range, or if there are none
+        the range of dates of operation in the loaded journeys. Journeys whose
+        dates, days of the week and exceptions are the same share a
+        ServiceCalendar.
+
+        >>> atco = ATCO()
+        >>> atco.read_string("""ATCO-CIF0510                       70 - RAIL        ATCORAIL20080124115909
+        ... QSNGW    6B1820070521200712071111100  2B02P10452TRAIN           I
+        ... QSNGW    6B1A20070521200712071111100  2B04P10456TRAIN           I
+        ... QE20070523200705230
+        ... QSNGW    6B2020070521200712070000011  2B04P10456TRAIN           I
+        ... """)
+        >>> atco.compile_calendar(datetime.date(2007, 5, 21), datetime.date(2007, 5, 27))
+        >>> len(atco.service_calendars)
+        3
+        >>> sorted([ journey.id for journey in atco.journeys_running_on(datetime.date(2007, 5, 23)) ])
+        ['GW-6B18']
+        >>> sorted([ journey.id for journey in atco.journeys_running_on(datetime.date(2007, 5, 26)) ])
+        ['GW-6B20']
+        >>> atco.journeys[1].runs_on_date(datetime.date(2007, 5, 22)), atco.journeys[1].runs_on_date(datetime.date(2007, 5, 23))
+        (True, False)
+
+        The reason is still available from is_valid_on_date.
+        >>> atco.journeys[1].is_valid_on_date(datetime.date(2007, 5, 23))
+        BoolWithReason(False, '2007-05-23 not in range of exceptional date records')
+
+        The calendar is compiled again if the journeys change, here replacing
+        the weekend journey with one which only runs on weekdays.
+        >>> atco.journeys[2] = atco.journeys[1]
+        >>> sorted([ journey.id for journey in atco.journeys_running_on(datetime.date(2007, 5, 26)) ])
+        []
+        '''
+        if start_date is None:
+            start_date = self.restrict_date_range_start
+            end_date = self.restrict_date_range_end
+        if start_date is None:
+            start_date, end_date = self._date_range_of_journeys()
+        assert start_date <= end_date
+
+        self.service_calendars = {}
+        self.journeys_by_service_calendar = {}
+        for journey in self.journeys:
+            key = journey.service_calendar_key()
+            calendar = self.service_calendars.get(key)
+            if calendar is None:
+                calendar = ServiceCalendar(journey, start_date, end_date)
+                self.service_calendars[key] = calendar
+                self.journeys_by_service_calendar[calendar] = []
+            journey.service_calendar = calendar
+            self.journeys_by_service_calendar[calendar].append(journey)
+
+        self.calendar_start_date = start_date
+        self.calendar_end_date = end_date
+        self._calendar_journeys = (self.journeys, len(self.journeys), self.journeys and self.journeys[-1] or None)
+        self.journeys_running_on_date = {}
+
+    def _date_range_of_journeys(self):
+        '''Returns the first and last dates of operation of all the journeys,
+        ignoring open ended ones.'''
+        start_date = None
+        end_date = None
+        open_ended = datetime.date(9999, 12, 31)
+        for journey in self.journeys:
+            dates = [ journey.first_date_of_operation, journey.last_date_of_operation ]
+            for exception in journey.date_running_exceptions:
+                dates.append(exception.start_of_exceptional_period)
+                dates.append(exception.end_of_exceptional_period)
+            for d in dates:
+                if d == open_ended:
+                    continue
+                if start_date is None or d < start_date:
+                    start_date = d
+                if end_date is None or d > end_date:
+                    end_date = d
+        if start_date is None:
+            start_date = end_date = datetime.date.today()
+        return start_date, end_date
+
+    def journeys_running_on(self, d):
+        '''Returns the set of journeys which run on the date. The set is
+        shared with later calls, so don't change it. See compile_calendar for
+        examples, which is called again if journeys have been loaded, removed
+        or replaced since, as far as _indexed_all can tell.'''
+        if not _indexed_all(self._calendar_journeys, self.journeys):
+            self.compile_calendar()
+        running = self.journeys_running_on_date.get(d)
+        if running is None:
+            running = set()
+            if self.calendar_start_date <= d <= self.calendar_end_date:
+                for calendar, journeys in self.journeys_by_service_calendar.iteritems():
+                    if calendar.runs_on(d):
+                        running.update(journeys)
+            else:
+                for journey in self.journeys:
+                    if journey.is_valid_on_date(d):
+                        running.add(journey)
+            self.journeys_running_on_date[d] = running
+        return running
+
     def statistics(self):
         ''' Returns a dictionary of statistics about the loaded timetables. '''
         stats = {}
@@ -422,9 +1427,812 @@ class ATCO(object):
         return stats
 
 
+def _indexed_all(indexed, items):
+    '''Whether the indexes still cover exactly the list items, given indexed,
+    the list, its length and its last item when it was indexed. Items
+    changed in the middle of the list can't be noticed.'''
+    if indexed is None:
+        return False
+    indexed_items, length, last = indexed
+    return indexed_items is items and len(items) == length and (length == 0 or items[-1] is last)
+
+def _indexed_all_but_last(indexed, items):
+    '''Whether the indexes cover all of the list items but the one just
+    appended to it.'''
+    if indexed is None:
+        return False
+    indexed_items, length, last = indexed
+    return indexed_items is items and len(items) == length + 1 and (length == 0 or items[-2] is last)
+
+class _LoadedFiles(object):
+    '''What was loaded from one file, which may contain several CIF files if
+    it is a ZIP file. The items are kept in the order they were loaded in, and
+    the files are numbered from 1 as file_loading_number.'''
+
+    def __init__(self, file_header, file_count, vehicle_type_to_code, items):
+        self.file_header = file_header
+        self.file_count = file_count
+        self.vehicle_type_to_code = vehicle_type_to_code
+        self.items = items
+
+    # Unpickling old style class instances is several times slower than
+    # unpickling their dictionaries, which would make the parent process a
+    # bottleneck when merging files loaded in parallel. So the records are
+    # pickled as (class, attributes) pairs instead.
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['items'] = [ _record_state(item) for item in self.items ]
+        return state
+
+    def __setstate__(self, state):
+        state['items'] = [ _record_from_state(item) for item in state['items'] ]
+        self.__dict__.update(state)
+
+def _record_state(record):
+    attributes = record.__dict__.copy()
+    if isinstance(record, JourneyHeader):
+        attributes.pop('lazy_hops', None)
+        hops = record.hops
+        if isinstance(hops, HopSequence):
+            hops = [ hop.to_record() for hop in hops ]
+        attributes['hops'] = [ (hop.__class__, hop.__dict__) for hop in hops ]
+        attributes.pop('hop_lines', None) # made again from the hops, quicker than pickling
+        attributes.pop('service_calendar', None) # belongs to whatever compiled it
+        attributes.pop('date_running_exception_ranges', None) # made again from the exceptions
+        attributes.pop('hop_positions', None) # made again from the hops
+        for name in ('stop_pattern', 'pattern_timing', 'pattern_start'): # belong to a PatternStore
+            attributes.pop(name, None)
+        attributes['date_running_exceptions'] = [ (exception.__class__, exception.__dict__)
+            for exception in record.date_running_exceptions ]
+    elif isinstance(record, Location) and record.additional is not None:
+        attributes['additional'] = (record.additional.__class__, record.additional.__dict__)
+    return (record.__class__, attributes)
+
+def _record_from_state((record_class, attributes)):
+    if record_class is JourneyHeader:
+        attributes['hops'] = [ types.InstanceType(hop_class, hop_attributes)
+            for hop_class, hop_attributes in attributes['hops'] ]
+        attributes['hop_lines'] = dict.fromkeys([ hop.line for hop in attributes['hops'] ], True)
+        attributes['date_running_exceptions'] = [ types.InstanceType(exception_class, exception_attributes)
+            for exception_class, exception_attributes in attributes['date_running_exceptions'] ]
+    elif record_class is Location and attributes['additional'] is not None:
+        attributes['additional'] = types.InstanceType(*attributes['additional'])
+    return types.InstanceType(record_class, attributes)
+
+class _ItemCollector(ATCO):
+    '''Loads files just collecting the items in order, for _LoadedFiles.'''
+
+    def __init__(self, options, show_progress = False):
+        ATCO.__init__(self, assume_no_holidays = options['assume_no_holidays'], show_progress = show_progress)
+        self.register_line_patches(options['line_patches'])
+        self.register_locations_to_ignore(options['locations_to_ignore'])
+        if options['restrict_date_range'][0] is not None:
+            self.restrict_to_date_range(*options['restrict_date_range'])
+        self.file_header = None
+        self.items = []
+
+    def item_loaded(self, item):
+        self.items.append(item)
+
+    def loaded_files(self):
+        return _LoadedFiles(self.file_header, self.file_loading_number, self.vehicle_type_to_code, self.items)
+
+# Snapshot files are this header, then a directory giving the name, typecode,
+# offset and length of each column of values, then the columns, laid out as
+# for _FlatBuffers. They are mapped into memory and read in place, and the
+# records made again from the columns. Nothing in them is pickled, so reading
+# one can't run code. Change the version whenever the columns change.
+SNAPSHOT_MAGIC = 'ATCO-CIF snapshot'
+SNAPSHOT_VERSION = 3
+_SNAPSHOT_HEADER = struct.Struct('>17sII')
+_SNAPSHOT_COLUMN = struct.Struct('>64scII')
+
+# Fields of vehicle types which snapshots keep as strings, as well as the line
+_SNAPSHOT_VEHICLE_TYPE_STRINGS = ('transaction_type', 'vehicle_type', 'vehicle_long_type')
+
+def _snapshot_arrays(loaded_files):
+    '''Returns the columns of a snapshot of a _LoadedFiles, by name.'''
+    arrays = {}
+    def column(name, typecode, values):
+        arrays[name] = array.array(typecode, values)
+    strings = _StringTable([])
+    numbers = strings.numbers
+    def string(s):
+        number = numbers.get(s)
+        if number is None:
+            if isinstance(s, unicode):
+                s = s.encode('utf-8')
+            number = strings.add(s)
+        return number
+
+    items = loaded_files.items
+    # what each item is, in the order they were loaded
+    kinds = array.array('c')
+    for item in items:
+        if isinstance(item, JourneyHeader):
+            kinds.append('J')
+        elif isinstance(item, Location):
+            kinds.append('L')
+        elif isinstance(item, VehicleType):
+            kinds.append('V')
+        else:
+            assert False
+    arrays['item_kinds'] = kinds
+    file_header = loaded_files.file_header
+    column('file_header', 'i', [ file_header is None and -1 or string(file_header.line), loaded_files.file_count ])
+    vehicle_codes = [ (number, vehicle_type, code)
+        for number, codes in sorted(loaded_files.vehicle_type_to_code.items())
+        for vehicle_type, code in sorted(codes.items()) ]
+    column('vehicle_code_file', 'i', [ number for number, vehicle_type, code in vehicle_codes ])
+    column('vehicle_code_type', 'i', [ string(vehicle_type) for number, vehicle_type, code in vehicle_codes ])
+    column('vehicle_code', 'i', [ string(code) for number, vehicle_type, code in vehicle_codes ])
+
+    # the same columns as FrozenATCO, with the lines of the records, and
+    # hop locations numbered along with the other strings
+    journey_arrays, string_columns = _journey_arrays([ item for item in items if isinstance(item, JourneyHeader) ],
+        string, lines = True)
+    arrays.update(journey_arrays)
+    location_arrays, location_string_columns = _location_arrays([ item for item in items if isinstance(item, Location) ],
+        lines = True)
+    arrays.update(location_arrays)
+    string_columns.update(location_string_columns)
+    for name, values in string_columns.iteritems():
+        column(name, 'i', [ string(value) for value in values ])
+
+    vehicle_types = [ item for item in items if isinstance(item, VehicleType) ]
+    for name in ('line',) + _SNAPSHOT_VEHICLE_TYPE_STRINGS:
+        column('vehicle_type_' + name, 'i', [ string(getattr(vehicle_type, name)) for vehicle_type in vehicle_types ])
+
+    arrays['string_starts'], arrays['string_data'] = strings.arrays()
+    return arrays
+
+def _loaded_files_from_snapshot(columns):
+    '''Makes the _LoadedFiles again from the columns of a snapshot, by name.
+    The values are copied out of the columns as lists first, as reading
+    them from lists is quicker.'''
+    string_starts = columns['string_starts'][:]
+    string_data = columns['string_data'][:]
+    strings = [ string_data[start:end] for start, end in zip(string_starts, string_starts[1:]) ]
+    del string_starts, string_data
+    def string_column(name):
+        return [ strings[number] for number in columns[name] ]
+
+    file_header_line, file_count = columns['file_header'][:]
+    file_header = None
+    if file_header_line >= 0:
+        file_header = FileHeader(strings[file_header_line])
+    vehicle_type_to_code = {}
+    for number, vehicle_type, code in zip(columns['vehicle_code_file'], string_column('vehicle_code_type'), string_column('vehicle_code')):
+        vehicle_type_to_code.setdefault(number, {})[vehicle_type] = code
+
+    # None of the objects being made are garbage, so stop the cyclic
+    # garbage collector repeatedly scanning them.
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        journeys = _journeys_from_snapshot(columns, string_column)
+        locations = _locations_from_snapshot(columns, string_column)
+        vehicle_types = []
+        vehicle_type_columns = [ (name, string_column('vehicle_type_' + name)) for name in ('line',) + _SNAPSHOT_VEHICLE_TYPE_STRINGS ]
+        for index in xrange(len(vehicle_type_columns[0][1])):
+            attributes = { 'record_identity' : 'QV' }
+            for name, values in vehicle_type_columns:
+                attributes[name] = values[index]
+            vehicle_types.append(types.InstanceType(VehicleType, attributes))
+
+        items = []
+        next_item = { 'J' : iter(journeys).next, 'L' : iter(locations).next, 'V' : iter(vehicle_types).next }
+        for kind in columns['item_kinds'][:]:
+            items.append(next_item[kind]())
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    return _LoadedFiles(file_header, file_count, vehicle_type_to_code, items)
+
+def _journeys_from_snapshot(columns, string_column):
+    hop_line = string_column('hop_line')
+    hop_location = string_column('hop_location_id')
+    hop_activity = columns['hop_activity'][:]
+    hop_arrival = columns['hop_arrival'][:]
+    hop_departure = columns['hop_departure'][:]
+    hop_flags = columns['hop_flags'][:]
+    bay_numbers = dict(zip(columns['bay_hops'], string_column('bay_numbers')))
+    hop_starts = columns['hop_starts'][:]
+    exception_columns = (string_column('exception_line'), columns['exception_start'][:],
+        columns['exception_end'][:], columns['exception_operation_code'][:])
+    exception_starts = columns['exception_starts'][:]
+    journey_columns = [ (name, string_column('journey_' + name)) for name in ('line',) + _FROZEN_JOURNEY_STRINGS ]
+    first_dates = columns['journey_first_date_of_operation'][:]
+    last_dates = columns['journey_last_date_of_operation'][:]
+    days_of_week = columns['journey_operates_on_day_of_week'][:]
+    file_loading_numbers = columns['journey_file_loading_number'][:]
+    assume_no_holidays = columns['journey_assume_no_holidays'][:]
+    fromordinal = datetime.date.fromordinal
+    times = _TIME_FROM_MINUTES
+    timing_points = [ bool(flags & _TIMING_POINT) for flags in range(256) ]
+    fare_stages = [ _FARE_STAGE_FROM_FLAGS.get(flags & _FARE_STAGE_MASK) for flags in range(256) ]
+    instance = types.InstanceType
+
+    journeys = []
+    for index in xrange(len(first_dates)):
+        hops = []
+        for hop in xrange(hop_starts[index], hop_starts[index + 1]):
+            activity = hop_activity[hop]
+            flags = hop_flags[hop]
+            if activity == _ORIGIN_ACTIVITY:
+                hops.append(instance(JourneyOrigin, { 'record_identity' : 'QO',
+                    'line' : hop_line[hop], 'location' : hop_location[hop],
+                    'published_departure_time' : times[hop_departure[hop]],
+                    'bay_number' : bay_numbers.get(hop, ''), 'timing_point_indicator' : timing_points[flags],
+                    'fare_stage_indicator' : fare_stages[flags] }))
+            elif activity == _DESTINATION_ACTIVITY:
+                hops.append(instance(JourneyDestination, { 'record_identity' : 'QT',
+                    'line' : hop_line[hop], 'location' : hop_location[hop],
+                    'published_arrival_time' : times[hop_arrival[hop]],
+                    'bay_number' : bay_numbers.get(hop, ''), 'timing_point_indicator' : timing_points[flags],
+                    'fare_stage_indicator' : fare_stages[flags] }))
+            else:
+                hops.append(instance(JourneyIntermediate, { 'record_identity' : 'QI',
+                    'line' : hop_line[hop], 'location' : hop_location[hop], 'activity_flag' : activity,
+                    'published_arrival_time' : times[hop_arrival[hop]],
+                    'published_departure_time' : times[hop_departure[hop]],
+                    'bay_number' : bay_numbers.get(hop, ''), 'timing_point_indicator' : timing_points[flags],
+                    'fare_stage_indicator' : fare_stages[flags] }))
+
+        exceptions = []
+        for exception in xrange(exception_starts[index], exception_starts[index + 1]):
+            exceptions.append(types.InstanceType(JourneyDateRunning, { 'record_identity' : 'QE',
+                'line' : exception_columns[0][exception],
+                'start_of_exceptional_period' : fromordinal(exception_columns[1][exception]),
+                'end_of_exceptional_period' : fromordinal(exception_columns[2][exception]),
+                'operation_code' : bool(exception_columns[3][exception]) }))
+
+        attributes = { 'record_identity' : 'QS', 'hops' : hops,
+            'hop_lines' : dict.fromkeys([ hop.line for hop in hops ], True),
+            'date_running_exceptions' : exceptions, 'cache_valid' : None, 'cache_valid_date' : None,
+            'first_date_of_operation' : fromordinal(first_dates[index]),
+            'last_date_of_operation' : fromordinal(last_dates[index]),
+            'operates_on_day_of_week' : [ bool(days_of_week[index] & (1 << day)) for day in range(8) ],
+            'file_loading_number' : file_loading_numbers[index],
+            'assume_no_holidays' : bool(assume_no_holidays[index]) }
+        for name, values in journey_columns:
+            attributes[name] = values[index]
+        journeys.append(types.InstanceType(JourneyHeader, attributes))
+    return journeys
+
+def _locations_from_snapshot(columns, string_column):
+    location_columns = [ (name, string_column('location_' + name)) for name in ('line',) + _FROZEN_LOCATION_STRINGS ]
+    has_additional = columns['location_has_additional'][:]
+    additional_columns = [ (name, string_column('location_' + name)) for name in _FROZEN_LOCATION_ADDITIONAL_STRINGS ]
+    additional_columns += [ (name, string_column('location_additional_' + name)) for name in ('line', 'transaction_type', 'location') ]
+    for name in ('grid_reference_easting', 'grid_reference_northing'):
+        additional_columns.append((name, columns['location_' + name][:]))
+
+    locations = []
+    for index in xrange(len(has_additional)):
+        attributes = { 'record_identity' : 'QL', 'additional' : None }
+        for name, values in location_columns:
+            attributes[name] = values[index]
+        if has_additional[index]:
+            additional = { 'record_identity' : 'QB' }
+            for name, values in additional_columns:
+                additional[name] = values[index]
+            attributes['additional'] = types.InstanceType(LocationAdditional, additional)
+        locations.append(types.InstanceType(Location, attributes))
+    return locations
+
+def _write_snapshot(snapshot_file, loaded_files):
+    arrays = _snapshot_arrays(loaded_files)
+    names = sorted(arrays)
+    offsets, size = _flat_offsets(arrays, _SNAPSHOT_HEADER.size + len(names) * _SNAPSHOT_COLUMN.size)
+
+    # write to a temporary file first, so nothing ever reads half a snapshot
+    temporary_file = "%s.%d.tmp" % (snapshot_file, os.getpid())
+    h = open(temporary_file, 'wb')
+    try:
+        h.write(_SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(names)))
+        for name in names:
+            assert len(name) <= 64
+            h.write(_SNAPSHOT_COLUMN.pack(name, arrays[name].typecode, offsets[name], len(arrays[name])))
+        for name in names:
+            h.write('\0' * (offsets[name] - h.tell()))
+            h.write(arrays[name].tostring())
+    finally:
+        h.close()
+    os.rename(temporary_file, snapshot_file)
+
+def _read_snapshot(snapshot_file):
+    h = open(snapshot_file, 'rb')
+    try:
+        header = h.read(_SNAPSHOT_HEADER.size)
+        if len(header) < _SNAPSHOT_HEADER.size:
+            raise Exception("Not an ATCO-CIF snapshot file: " + snapshot_file)
+        magic, version, column_count = _SNAPSHOT_HEADER.unpack(header)
+        if magic != SNAPSHOT_MAGIC:
+            raise Exception("Not an ATCO-CIF snapshot file: " + snapshot_file)
+        if version != SNAPSHOT_VERSION:
+            raise Exception("ATCO-CIF snapshot file %s is version %d, not version %d" % (snapshot_file, version, SNAPSHOT_VERSION))
+        # a private mapping, as ctypes can only read from writable buffers
+        mapped = mmap.mmap(h.fileno(), 0, access = mmap.ACCESS_COPY)
+    finally:
+        h.close()
+
+    columns = {}
+    for column in range(column_count):
+        offset = _SNAPSHOT_HEADER.size + column * _SNAPSHOT_COLUMN.size
+        name, typecode, offset, length = _SNAPSHOT_COLUMN.unpack_from(mapped, offset)
+        if typecode not in _CTYPE_FROM_TYPECODE:
+            raise Exception("ATCO-CIF snapshot file %s has a column of unknown type: %r" % (snapshot_file, typecode))
+        columns[name.rstrip('\0')] = _flat_column(mapped, typecode, offset, length)
+    return _loaded_files_from_snapshot(columns)
+
+def _handle_length(h):
+    '''Returns the length of the file that h is a handle to, if it is known.'''
+    try:
+        return os.fstat(h.fileno()).st_size
+    except (AttributeError, IOError, OSError):
+        return getattr(h, 'len', 0) # StringIO
+
+###########################################################
+# Reading compressed files
+
+# Compressed files are read a block at a time, and up to this many blocks
+# of decompressed data are kept waiting to be parsed.
+_COMPRESSED_BLOCK_SIZE = 64 * 1024
+_READ_AHEAD_BLOCKS = 8
+
+def _decompressor_for(f):
+    '''Returns a function which makes a decompressor for the file, if its first
+    bytes show that it is compressed with gzip, bzip2 or xz, or None if not.
+
+    >>> import tempfile
+    >>> n = tempfile.NamedTemporaryFile()
+    >>> n.write(bz2.compress('ATCO-CIF0510'))
+    >>> n.flush()
+    >>> _decompressor_for(n.name)().decompress(open(n.name).read())
+    'ATCO-CIF0510'
+    '''
+    h = open(f, 'rb')
+    try:
+        magic = h.read(6)
+    finally:
+        h.close()
+    if magic.startswith('\x1f\x8b'):
+        return lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif magic.startswith('BZh'):
+        return bz2.BZ2Decompressor
+    elif magic == '\xfd7zXZ\x00':
+        if lzma is None:
+            raise Exception("Reading xz compressed files needs the lzma module: " + f)
+        return lzma.LZMADecompressor
+    return None
+
+def _decompressed_blocks(compressed, new_decompressor):
+    '''Generator which yields each block of decompressed data from the file
+    handle, and how many compressed bytes have been read so far. Files made
+    of several compressed streams one after another are read to the end.'''
+    decompressor = new_decompressor()
+    while True:
+        data = compressed.read(_COMPRESSED_BLOCK_SIZE)
+        if not data:
+            break
+        while data:
+            try:
+                block = decompressor.decompress(data)
+            except EOFError:
+                # bz2 at the end of a stream, so another one follows
+                decompressor = new_decompressor()
+                continue
+            if block:
+                yield block, compressed.tell()
+            data = decompressor.unused_data
+            if data:
+                decompressor = new_decompressor()
+
+def _zip_member_blocks(archive, member, info):
+    '''Generator which yields each block of data from a member of a ZIP file,
+    opened with ZipFile.open, and roughly how many compressed bytes of it
+    have been read so far.'''
+    while True:
+        block = member.read(_COMPRESSED_BLOCK_SIZE)
+        if not block:
+            break
+        yield block, min(archive.tell() - info.header_offset, info.compress_size)
+
+class _ReadAhead(object):
+    '''A file handle for parsing lines from blocks of data made by another
+    thread, such as by decompressing them, which keeps a few blocks ahead.
+    The blocks come from a generator which yields them along with how far
+    through the file they are, which is what tell returns.
+
+    >>> h = _ReadAhead(iter([ ('ATCO\\nQS', 3), ('N\\r\\n\\nQT', 5) ]))
+    >>> h.readline(), list(h), h.tell()
+    ('ATCO\\n', ['QSN\\r\\n', '\\n', 'QT'], 5)
+    >>> _ReadAhead(iter([ ('ATCO\\nQS', 3), ('N\\nQT', 5) ])).read()
+    'ATCO\\nQSN\\nQT'
+    '''
+
+    def __init__(self, blocks):
+        self.queue = Queue.Queue(_READ_AHEAD_BLOCKS)
+        self.lines = iter([])
+        self.partial_line = ''
+        self.position = 0
+        self.finished = False
+        self.closed = False
+        self.thread = threading.Thread(target = self._read_blocks, args = (blocks,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _read_blocks(self, blocks):
+        try:
+            for block, position in blocks:
+                self.queue.put((block, position, None))
+                if self.closed:
+                    return
+            self.queue.put((None, None, None))
+        except Exception:
+            self.queue.put((None, None, sys.exc_info()))
+
+    def _next_block(self):
+        '''Returns the next block, or None at the end.'''
+        if self.finished:
+            return None
+        block, position, error = self.queue.get()
+        if error is not None:
+            self.finished = True
+            raise error[0], error[1], error[2]
+        if block is None:
+            self.finished = True
+            return None
+        self.position = position
+        return block
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        for line in self.lines:
+            return line
+        while True:
+            block = self._next_block()
+            if block is None:
+                line = self.partial_line
+                self.partial_line = ''
+                if line:
+                    return line
+                raise StopIteration
+            lines = (self.partial_line + block).split('\n')
+            self.partial_line = lines.pop()
+            if lines:
+                self.lines = iter([ line + '\n' for line in lines ])
+                return self.lines.next()
+
+    def readline(self):
+        for line in self:
+            return line
+        return ''
+
+    def read(self):
+        data = [ ''.join(self.lines), self.partial_line ]
+        self.lines = iter([])
+        self.partial_line = ''
+        while True:
+            block = self._next_block()
+            if block is None:
+                return ''.join(data)
+            data.append(block)
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        '''Stops the other thread if it is still reading.'''
+        self.closed = True
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout = 0.1)
+            except Queue.Empty:
+                pass
+
+# Records which belong to the journey before them
+_JOURNEY_RECORD_IDENTITIES = ('QO', 'QI', 'QT', 'QE', 'QN')
+
+# the records which follow each that starts an item, and are part of it
+_ITEM_RECORD_IDENTITIES = { 'QS' : _JOURNEY_RECORD_IDENTITIES, 'QL' : ('QB',), 'QV' : () }
+
+# how many lines are read between updates of the progress bar and LoadProfile
+_PROGRESS_LINES = 1024
+
+def _read_file_in_worker((f, options)):
+    collector = _ItemCollector(options)
+    collector.read(f)
+    return collector.loaded_files()
+
+# Finds every line which isn't a hop, and the stop of each hop
+_NON_HOP_LINE = re.compile(r'^(?!Q[OIT])[^\n]*(?:\n|$)', re.M)
+_HOP_STOP = re.compile(r'^Q[OIT](.{12})', re.M)
+
+class _LazyScanner(object):
+    '''Passes the lines of a memory mapped ATCO-CIF file to the parser for
+    ATCO.read_lazily, apart from hop records, which are skipped over with
+    regular expressions. For each journey it puts the byte offsets of the
+    start and end of its hops, and the set of stops they visit (as they are in
+    the file), on the end of journeys.'''
+
+    def __init__(self, mapped_file, line_patches):
+        self.mapped_file = mapped_file
+        self.line_patches = line_patches
+        self.journeys = collections.deque()
+        self.position = 0
+
+    def readline(self):
+        line = self.mapped_file.readline()
+        self.position = self.mapped_file.tell()
+        return line
+
+    def tell(self):
+        return self.position
+
+    def __iter__(self):
+        mapped_file = self.mapped_file
+        line_patches = self.line_patches
+        journey = None
+        for match in _NON_HOP_LINE.finditer(mapped_file, self.position):
+            start = match.start()
+            if start == len(mapped_file):
+                break
+            if start > self.position and journey is not None:
+                self._hops_found(journey, self.position, start)
+            self.position = match.end()
+            line = match.group()
+            if line_patches:
+                stripped = line.strip("\n\r")
+                line = line_patches.get(stripped, stripped)
+            if line[0:2] == 'QS':
+                journey = [None, None, set()]
+                self.journeys.append(journey)
+            yield line
+        if len(mapped_file) > self.position and journey is not None:
+            self._hops_found(journey, self.position, len(mapped_file))
+
+    def _hops_found(self, journey, start, end):
+        journey[0] = start
+        journey[1] = end
+        if self.line_patches:
+            for line in self.mapped_file[start:end].splitlines():
+                line = self.line_patches.get(line, line)
+                journey[2].add(line[2:14])
+        else:
+            journey[2].update(_HOP_STOP.findall(self.mapped_file, start, end))
+
+class _LazyHops(object):
+    '''Parses the hops of journeys read by ATCO.read_lazily when they are
+    needed.'''
+
+    def __init__(self, mapped_file, line_patches, locations_to_ignore):
+        self.mapped_file = mapped_file
+        self.line_patches = line_patches
+        self.locations_to_ignore = locations_to_ignore
+
+    def add_hops(self, journey, start, end):
+        if start is None:
+            return
+        for line in self.mapped_file[start:end].splitlines():
+            if line in self.line_patches:
+                line = self.line_patches[line]
+            record_identity = line[0:2]
+            if record_identity == 'QI':
+                hop = JourneyIntermediate(line)
+            elif record_identity == 'QO':
+                hop = JourneyOrigin(line)
+            elif record_identity == 'QT':
+                hop = JourneyDestination(line)
+            else:
+                continue
+            if hop.location not in self.locations_to_ignore:
+                journey.add_hop(hop)
+
 ###########################################################
 # Helper functions and classes
 
+class LocationGrid(object):
+    '''Spatial index of locations by their grid references. The locations
+    are put into square cells, so only cells near a point need searching to
+    find locations near it. Works best when the cell size is about the same as
+    the distances searched for.
+
+    >>> la = Location('QLN9100CHLFNAL Chalfont and Latimer Rail Station                RE0044056')
+    >>> la.add_additional(LocationAdditional('QBN9100CHLFNAL 499647  197573  Chiltern                                        '))
+    >>> lb = Location('QLN9100AMERSHM Amersham Rail Station                            RE0044057')
+    >>> lb.add_additional(LocationAdditional('QBN9100AMERSHM 496400  198200  Chiltern                                        '))
+    >>> grid = LocationGrid([la, lb], 1000)
+    >>> grid.within(499647, 197000, 1000)
+    [(Location('9100CHLFNAL'), 573.0)]
+    >>> sorted([ (dist, location.location) for location, dist in grid.within(498000, 198000, 2000) ])
+    [(1612.4515496597098, '9100AMERSHM'), (1701.451733079725, '9100CHLFNAL')]
+    '''
+
+    def __init__(self, locations, cell_size):
+        assert cell_size > 0
+        self.cell_size = cell_size
+        self.location_count = len(locations)
+        self.cells = {}
+        for location in locations:
+            easting = location.additional.grid_reference_easting
+            northing = location.additional.grid_reference_northing
+            cell = (int(easting // cell_size), int(northing // cell_size))
+            self.cells.setdefault(cell, []).append((location, easting, northing))
+
+    def within(self, easting, northing, distance):
+        '''Returns a list of pairs of location and distance, for all the locations
+        less than distance away from the grid reference.'''
+        ret = []
+        cell_size = self.cell_size
+        max_sqdist = distance * distance
+        min_cell_easting = int((easting - distance) // cell_size)
+        max_cell_easting = int((easting + distance) // cell_size)
+        min_cell_northing = int((northing - distance) // cell_size)
+        max_cell_northing = int((northing + distance) // cell_size)
+        for cell_easting in xrange(min_cell_easting, max_cell_easting + 1):
+            for cell_northing in xrange(min_cell_northing, max_cell_northing + 1):
+                for location, other_easting, other_northing in self.cells.get((cell_easting, cell_northing), ()):
+                    sqdist = (easting-other_easting)**2 + (northing-other_northing)**2
+                    if sqdist < max_sqdist:
+                        ret.append((location, math.sqrt(sqdist)))
+        return ret
+
+def _intern(s):
+    '''Interns s if it is a byte string. Unicode strings, from read_string,
+    can't be interned in Python 2, so are kept as they are.'''
+    if isinstance(s, str):
+        return intern(s)
+    return s
+
+class LocationIds(dict):
+    '''Gives each location short code a dense integer id, counting from 0
+    in the order they are first seen. Look up the id of a code with
+    location_ids[code], and the code of an id with location_ids.codes[id].
+    There is one in each ATCO object, as atco.location_ids.
+
+    >>> location_ids = LocationIds()
+    >>> location_ids.add('9100COOKHAM'), location_ids.add('9100FURZEP'), location_ids.add('9100COOKHAM')
+    (0, 1, 0)
+    >>> location_ids['9100FURZEP'], location_ids.codes
+    (1, ['9100COOKHAM', '9100FURZEP'])
+
+    Codes read from unicode strings can't be interned, so are kept as they are.
+    >>> for options in ({}, { 'compact_hops' : True }, { 'share_patterns' : True }):
+    ...     atco = ATCO(**options)
+    ...     atco.read_string(u"""ATCO-CIF0510                       70 - RAIL        ATCORAIL20080124115909
+    ... QSNGW    6B1820070521200712071111100  2B02P10452TRAIN           I
+    ... QO9100MDNHEAD 0549URLT1  
+    ... QT9100MARLOW  0612   T1  
+    ... """)
+    ...     print [ str(hop.location) for hop in atco.journeys[0].hops ]
+    ['9100MDNHEAD', '9100MARLOW']
+    ['9100MDNHEAD', '9100MARLOW']
+    ['9100MDNHEAD', '9100MARLOW']
+    >>> LocationIds().add(u'9100MARLOW')
+    0
+    '''
+
+    def __init__(self):
+        dict.__init__(self)
+        self.codes = []
+
+    def add(self, code):
+        '''Returns the id of the code, giving it the next one if it hasn't
+        got one yet.'''
+        location_id = self.get(code)
+        if location_id is None:
+            code = _intern(code)
+            location_id = self[code] = len(self.codes)
+            self.codes.append(code)
+        return location_id
+
+class LocationIndex(dict):
+    '''Dictionary keyed by location id, which can also be used with the
+    location's short code, or its Location record, in place of the id.
+    Iterating over it gives the keys as key_of_id makes them from the ids,
+    which by default is the short codes; iteritems_by_id gives the ids
+    themselves. Note that dict(index) has the ids as keys.
+
+    >>> location_ids = LocationIds()
+    >>> index = LocationIndex(location_ids)
+    >>> index['9100COOKHAM'] = 'Cookham'
+    >>> index[0], index['9100COOKHAM'], '9100COOKHAM' in index, 0 in index, index.get('9100FURZEP')
+    ('Cookham', 'Cookham', True, True, None)
+    >>> index['9100FURZEP']
+    Traceback (most recent call last):
+        ...
+    KeyError: '9100FURZEP'
+    >>> index.update({ '9100FURZEP' : 'Furze Platt' })
+    >>> sorted(index.items()), sorted(index.copy()), list(index.iteritems_by_id())
+    ([('9100COOKHAM', 'Cookham'), ('9100FURZEP', 'Furze Platt')], ['9100COOKHAM', '9100FURZEP'], [(0, 'Cookham'), (1, 'Furze Platt')])
+    '''
+
+    def __init__(self, location_ids, key_of_id = None):
+        dict.__init__(self)
+        self.location_ids = location_ids
+        if key_of_id is None:
+            key_of_id = location_ids.codes.__getitem__
+        self.key_of_id = key_of_id
+
+    def _id(self, key):
+        # short codes are the most common, then ids, so try those first
+        location_id = self.location_ids.get(key)
+        if location_id is None:
+            if isinstance(key, Location):
+                return self.location_ids.get(key.location, key.location)
+            return key
+        return location_id
+
+    def _new_id(self, key):
+        if isinstance(key, Location):
+            key = key.location
+        if isinstance(key, str):
+            return self.location_ids.add(key)
+        return key
+
+    def __getitem__(self, key):
+        location_id = self.location_ids.get(key)
+        if location_id is None:
+            location_id = self._id(key)
+        return dict.__getitem__(self, location_id)
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, self._new_id(key), value)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, self._id(key))
+
+    def __contains__(self, key):
+        return dict.__contains__(self, self._id(key))
+    has_key = __contains__
+
+    def get(self, key, default = None):
+        return dict.get(self, self._id(key), default)
+
+    def setdefault(self, key, default = None):
+        return dict.setdefault(self, self._new_id(key), default)
+
+    def pop(self, key, *default):
+        return dict.pop(self, self._id(key), *default)
+
+    def update(self, other = (), **kwargs):
+        if hasattr(other, 'keys'):
+            other = [ (key, other[key]) for key in other.keys() ]
+        for key, value in other:
+            self[key] = value
+        for key, value in kwargs.iteritems():
+            self[key] = value
+
+    def copy(self):
+        ret = LocationIndex(self.location_ids, self.key_of_id)
+        dict.update(ret, self)
+        return ret
+
+    def __iter__(self):
+        key_of_id = self.key_of_id
+        for location_id in dict.__iter__(self):
+            yield key_of_id(location_id)
+    iterkeys = __iter__
+
+    def keys(self):
+        return list(self)
+
+    def iteritems(self):
+        key_of_id = self.key_of_id
+        for location_id, value in dict.iteritems(self):
+            yield key_of_id(location_id), value
+
+    def items(self):
+        return list(self.iteritems())
+
+    def iteritems_by_id(self):
+        return dict.iteritems(self)
+
 def parse_time(time_string):
     '''Converts a time string from an ATCO-CIF field into a Python time object.
 
@@ -444,10 +2252,7 @@ def parse_time(time_string):
     if hour >= 24 and hour < 28:
         hour = hour - 24
     minute = int(time_string[2:4])
-    try:
-        return datetime.time(hour, minute, 0)
-    except:
-        import pdb;pdb.set_trace()
+    return datetime.time(hour, minute, 0)
 
 def parse_date(date_string):
     '''Converts a date string from an ATCO-CIF field into a Python date object.
@@ -486,17 +2291,69 @@ def parse_date_time(date_string, time_string):
         int(time_string[0:2]), int(time_string[2:4]), int(time_string[4:6]), 0
     )
 
-def canonicalise_location(location):
-    '''Removes excess spaces, and makes the location uppercase.
+def canonicalise_location(location):
+    '''Removes excess spaces, and makes the location uppercase.
+
+    >>> canonicalise_location("TTA 2322")
+    'TTA2322'
+    >>> canonicalise_location('9300eri')
+    '9300ERI'
+    '''
+    location = location.strip().upper()
+    location = location.replace(" ", "")
+    return location
+
+class _Memo(dict):
+    '''Dictionary which fills itself in by calling a function on missing keys.
+    Used to cache conversions of field values which repeat a great deal in
+    ATCO-CIF files, such as times and location codes. As a side effect equal
+    values share the same object, which also saves memory.
+
+    >>> memo = _Memo(canonicalise_location)
+    >>> memo['9100 eri ']
+    '9100ERI'
+    >>> memo['9100 eri '] is memo['9100 eri ']
+    True
+    '''
+
+    def __init__(self, function):
+        dict.__init__(self)
+        self.function = function
+
+    def __missing__(self, key):
+        value = self.function(key)
+        self[key] = value
+        return value
+
+def _strip(s):
+    return s.strip()
+
+def _strip_upper(s):
+    return s.strip().upper()
 
-    >>> canonicalise_location("TTA 2322")
-    'TTA2322'
-    >>> canonicalise_location('9300eri')
-    '9300ERI'
+def _parse_days_of_week(days_string):
+    '''Converts the seven 0/1 flags from Monday to Sunday into a list indexed
+    by isoweekday, with Sunday filled in at both ends for convenience.
+
+    >>> _parse_days_of_week('1111100')
+    (False, True, True, True, True, True, False, False)
     '''
-    location = location.strip().upper()
-    location = location.replace(" ", "")
-    return location
+    operates_on_day_of_week = [None] * 8
+    for day_of_week in range(1, 8):
+        operates_on_day_of_week[day_of_week] = bool(int(days_string[day_of_week - 1]))
+    operates_on_day_of_week[0] = bool(int(days_string[6]))
+    return tuple(operates_on_day_of_week)
+
+def _parse_grid_reference(grid_reference_string):
+    grid_reference_string = grid_reference_string.strip()
+    return grid_reference_string and int(grid_reference_string) or -1
+
+_cached_time = _Memo(parse_time).__getitem__
+_cached_date = _Memo(parse_date).__getitem__
+_cached_location = _Memo(lambda location: _intern(canonicalise_location(location))).__getitem__
+_cached_days_of_week = _Memo(_parse_days_of_week).__getitem__
+_timing_point_indicator = { 'T0' : False, 'T1' : True }.__getitem__
+_fare_stage_indicator = { 'F0' : False, 'F1' : True, '  ' : None }.__getitem__
 
 class BoolWithReason:
     '''Behaves as a boolean, only stores an explanatory string as well.
@@ -527,6 +2384,38 @@ class BoolWithReason:
         return self.value
 
 
+class ServiceCalendar(object):
+    '''The days on which a journey runs within a range of dates, stored as
+    the bits of an integer, one for each day. Made by ATCO.compile_calendar,
+    and shared between journeys which run on the same days.
+
+    >>> jh = JourneyHeader('QSNGW    6B3920070521200712071111100  2B82P10553TRAIN           I', 1)
+    >>> calendar = ServiceCalendar(jh, datetime.date(2007, 5, 19), datetime.date(2007, 5, 27))
+    >>> bin(calendar.bits)
+    '0b1111100'
+    >>> calendar.runs_on(datetime.date(2007, 5, 21)), calendar.runs_on(datetime.date(2007, 5, 26))
+    (True, False)
+    >>> print calendar.runs_on(datetime.date(2007, 5, 28))
+    None
+    '''
+
+    def __init__(self, journey, start_date, end_date):
+        self.start_ordinal = start_date.toordinal()
+        self.day_count = end_date.toordinal() - self.start_ordinal + 1
+        self.bits = 0
+        d = start_date
+        for day in range(self.day_count):
+            if journey._internal_is_valid_on_date(d):
+                self.bits |= 1 << day
+            d += datetime.timedelta(days = 1)
+
+    def runs_on(self, d):
+        '''Returns whether it runs on the date, or None if the date is outside
+        the range the calendar was made for.'''
+        day = d.toordinal() - self.start_ordinal
+        if day < 0 or day >= self.day_count:
+            return None
+        return bool((self.bits >> day) & 1)
 
 ###########################################################
 # Base record class
@@ -564,6 +2453,55 @@ class CIFRecord:
 
         return ret
 
+class RecordLayout(object):
+    '''The fixed-width column layout of one type of ATCO-CIF record. Each field
+    is given as (attribute name, width, regular expression, converter). The
+    expressions are joined and compiled once, and used to check the format of
+    whole lines. The fields are then decoded by slicing at precomputed offsets,
+    and passed through the converter if there is one.
+
+    >>> layout = RecordLayout('QE', [
+    ...     ('start_of_exceptional_period', 8, r'\d{8}', parse_date),
+    ...     ('operation_code', 1, '[01]', None) ])
+    >>> c = CIFRecord('QE200712251', 'QE')
+    >>> layout.decode(c, c.line)
+    True
+    >>> c.start_of_exceptional_period, c.operation_code
+    (datetime.date(2007, 12, 25), '1')
+    >>> layout.decode(c, 'QE20071225X')
+    False
+
+    The trailer is a regular expression for anything permitted after the last
+    field, which isn't decoded.
+    >>> RecordLayout('QX', [('code', 2, '..', None)], trailer = ' ?').regexp.pattern
+    '^QX(?:..) ?$'
+    '''
+
+    def __init__(self, record_identity, fields, trailer = ''):
+        assert len(record_identity) == 2
+        self.record_identity = record_identity
+        self.fields = []
+        pattern = '^' + record_identity
+        offset = len(record_identity)
+        for name, width, field_pattern, converter in fields:
+            self.fields.append((name, offset, offset + width, converter))
+            pattern += '(?:' + field_pattern + ')'
+            offset += width
+        self.regexp = re.compile(pattern + trailer + '$')
+
+    def decode(self, record, line):
+        '''Sets the fields of the line as attributes of record. Returns False,
+        and sets nothing, if the line is incorrectly formatted.'''
+        if self.regexp.match(line) is None:
+            return False
+        attributes = record.__dict__
+        for name, start, end, converter in self.fields:
+            if converter is None:
+                attributes[name] = line[start:end]
+            else:
+                attributes[name] = converter(line[start:end])
+        return True
+
 class FileHeader(CIFRecord):
     """ATC-CIF files begin with a special header that cannot be nonsense.
 
@@ -587,10 +2525,12 @@ class FileHeader(CIFRecord):
     datetime.datetime(2008, 1, 24, 11, 59, 9)
     """
 
+    regexp = re.compile('^ATCO-CIF(\d\d)(\d\d)(.{32})(.{16})(\d{8})(\d{4,6})$')
+
     def __init__(self, line):
         CIFRecord.__init__(self, line, "AT")
 
-        matches = re.match('^ATCO-CIF(\d\d)(\d\d)(.{32})(.{16})(\d{8})(\d{4,6})$', line) 
+        matches = self.regexp.match(line)
         if not matches:
             raise Exception("ATCO-CIF header line incorrectly formatted: " + line)
         self.version_major = int(matches.group(1))
@@ -643,33 +2583,36 @@ class JourneyHeader(CIFRecord):
     in self.hops - see add_hop below for examples.
     '''
 
+    service_calendar = None # set by ATCO.compile_calendar
+    date_running_exception_ranges = None # DateRanges made from date_running_exceptions
+    hop_positions = None # positions in hops by location, made by positions_of_location
+
+    layout = RecordLayout('QS', [
+        ('transaction_type', 1, '[NDR]', None),
+        ('operator', 4, '.{4}', _strip),
+        ('unique_journey_identifier', 6, '.{6}', _strip),
+        ('first_date_of_operation', 8, '\d{8}', _cached_date),
+        ('last_date_of_operation', 8, '\d{8}| {8}', _cached_date),
+        # fills in Sunday at both ends for convenience, see _parse_days_of_week
+        ('operates_on_day_of_week', 7, '[01]{7}', _cached_days_of_week),
+        ('school_term_time', 1, '[ SH]', None),
+        ('bank_holidays', 1, '[ ABXG]', None),
+        ('route_number', 4, '.{4}', None),
+        ('running_board', 6, '.{6}', _strip),
+        ('vehicle_type', 8, '.{8}', _strip_upper),
+        ('registration_number', 8, '.{8}', _strip),
+        ('route_direction', 1, '.', None) ])
+
     def __init__(self, line, file_loading_number, assume_no_holidays = True):
         CIFRecord.__init__(self, line, "QS")
         self.assume_no_holidays = True
         self.file_loading_number = file_loading_number
 
-        matches = re.match('^QS([NDR])(.{4})(.{6})(\d{8})(\d{8}| {8})([01]{7})([ SH])([ ABXG])(.{4})(.{6})(.{8})(.{8})(.)$', line)
-        if not matches:
+        if not self.layout.decode(self, line):
             raise Exception("Journey header line incorrectly formatted: " + line)
 
-        self.transaction_type = matches.group(1)
         assert self.transaction_type == 'N' # code doesn't handle other types yet
-        self.operator = matches.group(2).strip()
-        self.unique_journey_identifier = matches.group(3).strip()
-        self.first_date_of_operation = parse_date(matches.group(4))
-        self.last_date_of_operation = parse_date(matches.group(5))
-        self.operates_on_day_of_week = [None] * 8
-        day_of_week_group = matches.group(6)
-        for day_of_week in range(1, 8):
-            self.operates_on_day_of_week[day_of_week] = bool(int(day_of_week_group[day_of_week - 1]))
-        self.operates_on_day_of_week[0] = bool(int(day_of_week_group[6])) # fill in Sunday at both ends for convenience
-        self.school_term_time = matches.group(7)
-        self.bank_holidays = matches.group(8)
-        self.route_number = matches.group(9)
-        self.running_board = matches.group(10).strip()
-        self.vehicle_type = matches.group(11).strip().upper()
-        self.registration_number = matches.group(12).strip()
-        self.route_direction = matches.group(13)
+        self.operates_on_day_of_week = list(self.operates_on_day_of_week)
 
         # Operator code and journey identifier are unique together
         self.id = self.operator + "-" + self.unique_journey_identifier
@@ -682,6 +2625,30 @@ class JourneyHeader(CIFRecord):
         self.cache_valid = None
         self.cache_valid_date = None
 
+    # These are only used when a journey doesn't have its own hops. Journeys
+    # in a PatternStore make a view of them when asked, and journeys from
+    # ATCO.read_lazily parse them the first time. (Properties rather than
+    # __getattr__, which would slow down hashing, as that looks up __hash__.)
+    def _get_hops(self):
+        if 'stop_pattern' in self.__dict__:
+            return self.stop_pattern.hops_of(self)
+        self._parse_lazy_hops('hops')
+        return self.__dict__['hops']
+    hops = property(_get_hops)
+
+    def _get_hop_lines(self):
+        self._parse_lazy_hops('hop_lines')
+        return self.__dict__['hop_lines']
+    hop_lines = property(_get_hop_lines)
+
+    def _parse_lazy_hops(self, name):
+        if 'lazy_hops' not in self.__dict__:
+            raise AttributeError(name)
+        source, start, end = self.__dict__.pop('lazy_hops')
+        self.hops = []
+        self.hop_lines = {}
+        source.add_hops(self, start, end)
+
     def __str__(self):
         ret = CIFRecord.__str__(self) + "\n"
         counter = 0
@@ -702,17 +2669,9 @@ class JourneyHeader(CIFRecord):
                 or exception.end_of_exceptional_period < restrict_date_range_start:
                 return
 
-        # test consistency with existing date running exceptions
-        for other in self.date_running_exceptions:
-            # see if the new one overlaps this other exception
-            if not(other.end_of_exceptional_period < exception.start_of_exceptional_period \
-                or exception.end_of_exceptional_period < other.start_of_exceptional_period):
-                # We're in trouble if it overlapped, and the operation code differed - 
-                # this is being conservative. It is possible ATCO-CIF documents what criteria
-                # causes one range to override another in this case, in which case amend
-                # this and is_valid_on_date below appropriately.
-                if other.operation_code != exception.operation_code:
-                    raise Exception("Inconsistency between date running exceptions, " + exception.line + " and " + other.line)
+        # test consistency with existing date running exceptions, which raises
+        # an exception if it isn't
+        self._date_running_exception_ranges().add(exception)
 
         # store the new date running exception
         self.date_running_exceptions.append(exception)
@@ -739,14 +2698,41 @@ class JourneyHeader(CIFRecord):
 
         return self.cache_valid
 
+    def runs_on_date(self, d):
+        '''Returns True or False according to whether the journey runs on the
+        date, the same as is_valid_on_date but without the reasoning. This is
+        quick if the date is in the range given to ATCO.compile_calendar.'''
+        if self.service_calendar is not None:
+            running = self.service_calendar.runs_on(d)
+            if running is not None:
+                return running
+        return bool(self.is_valid_on_date(d))
+
+    def service_calendar_key(self):
+        '''Returns everything that is_valid_on_date depends on, so that
+        journeys with the same key run on the same days.'''
+        return (self.first_date_of_operation, self.last_date_of_operation,
+            tuple(self.operates_on_day_of_week), self.assume_no_holidays,
+            self.school_term_time, self.bank_holidays,
+            tuple([ (exception.start_of_exceptional_period, exception.end_of_exceptional_period, exception.operation_code)
+                for exception in self.date_running_exceptions ]))
+
+    def _date_running_exception_ranges(self):
+        # made again if the list has been changed some other way, such as by
+        # unpickling, which leaves the ranges out
+        ranges = self.date_running_exception_ranges
+        if ranges is None or len(ranges) != len(self.date_running_exceptions):
+            ranges = self.date_running_exception_ranges = DateRanges()
+            for exception in self.date_running_exceptions:
+                ranges.add(exception)
+        return ranges
+
     def _internal_is_valid_on_date(self, d):
         # add_date_running_exception above tests that the exception date ranges
-        # are consistent with each other, so this naive implementation that
-        # assumes no kind of nesting will do.
+        # are consistent with each other, so only one can apply.
         excepted_state = None
-        for exception in self.date_running_exceptions:
-            if exception.start_of_exceptional_period <= d and d <= exception.end_of_exceptional_period:
-                excepted_state = exception.operation_code
+        if self.date_running_exceptions:
+            excepted_state = self._date_running_exception_ranges().operation_code_on(d)
         if excepted_state == False:
             return BoolWithReason(False, "%s not in range of exceptional date records" % (str(d)))
         if excepted_state == None:
@@ -794,6 +2780,12 @@ class JourneyHeader(CIFRecord):
         [datetime.time(16, 40)]
         >>> print jh.find_departure_times_at_location('9100MARYLBN')
         []
+        >>> jh.positions_of_location('9100HWYCOMB')
+        (2,)
+        >>> jh.segment('9100SUNDRTN', '9100GERRDSX')
+        (datetime.time(16, 40), datetime.time(16, 59))
+        >>> print jh.segment('9100GERRDSX', '9100SUNDRTN')
+        None
         '''
 
         if hop.line in self.hop_lines:
@@ -806,6 +2798,8 @@ class JourneyHeader(CIFRecord):
         self.hops.append(hop)
         self.hop_lines[hop.line] = True
         #self.hop_locations[hop.location] = True
+        if self.hop_positions is not None:
+            self.hop_positions = None
 
     def find_arrival_times_at_location(self, location):
         ''' Given a location (as a string short code), return the times this journey
@@ -814,10 +2808,11 @@ class JourneyHeader(CIFRecord):
         See add_hop above for examples.
         '''
         ret = []
-        for hop in self.hops:
-            if hop.location == location:
-                if hop.is_set_down():
-                    ret.append(hop.published_arrival_time)
+        hops = self.hops
+        for position in self.positions_of_location(location):
+            hop = hops[position]
+            if hop.is_set_down():
+                ret.append(hop.published_arrival_time)
 
         return ret
 
@@ -828,13 +2823,57 @@ class JourneyHeader(CIFRecord):
         See add_hop above for examples.
         '''
         ret = []
-        for hop in self.hops:
-            if hop.location == location:
-                if hop.is_pick_up():
-                    ret.append(hop.published_departure_time)
+        hops = self.hops
+        for position in self.positions_of_location(location):
+            hop = hops[position]
+            if hop.is_pick_up():
+                ret.append(hop.published_departure_time)
 
         return ret
 
+    def positions_of_location(self, location):
+        ''' Given a location (as a string short code), return the positions in
+        self.hops of the hops there, in order. They are indexed the first time
+        this is called, and again after add_hop; journeys in a PatternStore
+        share an index with the rest of their StopPattern.
+
+        See add_hop above for examples.
+        '''
+        return self._hop_positions().get(location, ())
+
+    def _hop_positions(self):
+        if 'stop_pattern' in self.__dict__:
+            return self.stop_pattern._hop_positions()
+        if self.hop_positions is None:
+            self.hop_positions = _positions_by_location([ hop.location for hop in self.hops ])
+        return self.hop_positions
+
+    def segment(self, from_location, to_location):
+        ''' Given two locations (as string short codes), return the departure
+        time from the first and the arrival time at the second of a trip on
+        this journey between them, or None if it doesn't pick up at the first
+        and later set down at the second. If it calls at them more than once,
+        this is the first place it can be left at to_location, boarded at the
+        last place before that it can be at from_location.
+
+        See add_hop above for examples.
+        '''
+        if 'stop_pattern' in self.__dict__:
+            return self.stop_pattern.segment(self, from_location, to_location)
+        positions = self._hop_positions()
+        boardings = positions.get(from_location)
+        alightings = positions.get(to_location)
+        if boardings is None or alightings is None:
+            return None
+        hops = self.hops
+        for alighting in alightings:
+            if not hops[alighting].is_set_down():
+                continue
+            for boarding in reversed(boardings):
+                if boarding < alighting and hops[boarding].is_pick_up():
+                    return (hops[boarding].published_departure_time, hops[alighting].published_arrival_time)
+        return None
+
     def crosses_midnight(self):
         ''' Returns whether the journey takes place across midnight. '''
         previous_departure_time = datetime.time(0, 0, 0)
@@ -908,16 +2947,105 @@ class JourneyDateRunning(CIFRecord):
     >>> jh.add_date_running_exception(jdr4) # not inconsistent, as date range doesn't overlap
     '''
 
+    layout = RecordLayout('QE', [
+        ('start_of_exceptional_period', 8, '\d{8}', _cached_date),
+        ('end_of_exceptional_period', 8, '\d{8}', _cached_date),
+        ('operation_code', 1, '[01]', { '0' : False, '1' : True }.__getitem__) ])
+
     def __init__(self, line):
         CIFRecord.__init__(self, line, "QE")
 
-        matches = re.match('^QE(\d{8})(\d{8})([01])$', line)
-        if not matches:
+        if not self.layout.decode(self, line):
             raise Exception("Journey origin line incorrectly formatted: " + line)
 
-        self.start_of_exceptional_period = parse_date(matches.group(1))
-        self.end_of_exceptional_period = parse_date(matches.group(2))
-        self.operation_code = bool(int(matches.group(3)))
+class DateRanges(object):
+    '''The date ranges of JourneyDateRunning records, kept sorted and not
+    overlapping, so that finding the range a date is in, or the ranges a new
+    record overlaps, is a binary search. Ranges with the same operation code
+    which overlap or are next to each other are merged as they are added.
+    Adding a range which overlaps one with a different operation code raises
+    the same error as JourneyHeader.add_date_running_exception always has.
+
+    >>> ranges = DateRanges()
+    >>> ranges.add(JourneyDateRunning('QE20071225200712250'))
+    >>> ranges.add(JourneyDateRunning('QE20071220200712241'))
+    >>> ranges.add(JourneyDateRunning('QE20071226200712300'))
+    >>> ranges.add(JourneyDateRunning('QE20071228200801010'))
+    >>> len(ranges), zip(ranges.starts, ranges.ends, ranges.operation_codes)
+    (4, [(datetime.date(2007, 12, 20), datetime.date(2007, 12, 24), True), (datetime.date(2007, 12, 25), datetime.date(2008, 1, 1), False)])
+    >>> [ ranges.operation_code_on(datetime.date(2007, 12, day)) for day in (19, 20, 24, 25, 31) ]
+    [None, True, True, False, False]
+    >>> ranges.add(JourneyDateRunning('QE20080101200801051'))
+    Traceback (most recent call last):
+        ...
+    Exception: Inconsistency between date running exceptions, QE20080101200801051 and QE20071228200801010
+    '''
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.operation_codes = []
+        self.records = [] # (order added, JourneyDateRunning) merged into each range
+        self.record_count = 0
+
+    def __len__(self):
+        return self.record_count
+
+    def add(self, exception):
+        start = exception.start_of_exceptional_period
+        end = exception.end_of_exceptional_period
+        operation_code = exception.operation_code
+
+        # find the ranges which overlap or are next to the new one
+        first = bisect.bisect_left(self.ends, _day_before(start))
+        last = bisect.bisect_right(self.starts, _day_after(end))
+        conflicts = []
+        for i in xrange(first, last):
+            if self.operation_codes[i] != operation_code and self.starts[i] <= end and start <= self.ends[i]:
+                conflicts += [ (order, other) for order, other in self.records[i]
+                    if other.start_of_exceptional_period <= end and start <= other.end_of_exceptional_period ]
+        if conflicts:
+            # We're in trouble if it overlapped, and the operation code differed -
+            # this is being conservative. It is possible ATCO-CIF documents what criteria
+            # causes one range to override another in this case, in which case amend
+            # this and JourneyHeader.is_valid_on_date appropriately.
+            order, other = min(conflicts)
+            raise Exception("Inconsistency between date running exceptions, " + exception.line + " and " + other.line)
+
+        # Only those at either end can be next to it with a different operation
+        # code, so merge it with the ones in between.
+        if first < last and self.operation_codes[first] != operation_code and self.ends[first] < start:
+            first += 1
+        if first < last and self.operation_codes[last - 1] != operation_code and end < self.starts[last - 1]:
+            last -= 1
+        records = [(self.record_count, exception)]
+        if first < last:
+            start = min(start, self.starts[first])
+            end = max(end, self.ends[last - 1])
+            records = sum(self.records[first:last], []) + records
+        self.starts[first:last] = [start]
+        self.ends[first:last] = [end]
+        self.operation_codes[first:last] = [operation_code]
+        self.records[first:last] = [records]
+        self.record_count += 1
+
+    def operation_code_on(self, d):
+        '''Returns the operation code of the range the date is in, or None if
+        it isn't in one.'''
+        i = bisect.bisect_right(self.starts, d) - 1
+        if i >= 0 and d <= self.ends[i]:
+            return self.operation_codes[i]
+        return None
+
+def _day_before(d):
+    if d == datetime.date.min:
+        return d
+    return d - datetime.timedelta(days = 1)
+
+def _day_after(d):
+    if d == datetime.date.max:
+        return d
+    return d + datetime.timedelta(days = 1)
 
 class JourneyOrigin(CIFRecord):
     '''Start of a journey route.
@@ -941,19 +3069,20 @@ class JourneyOrigin(CIFRecord):
     True
     '''
 
+    layout = RecordLayout('QO', [
+        ('location', 12, '.{12}', _cached_location),
+        ('published_departure_time', 4, '\d{4}', _cached_time),
+        ('bay_number', 3, '.{3}', _strip),
+        ('timing_point_indicator', 2, 'T[01]', _timing_point_indicator),
+        ('fare_stage_indicator', 2, 'F0|F1|  ', _fare_stage_indicator) ],
+        trailer = ' ?')
+
     def __init__(self, line):
         CIFRecord.__init__(self, line, "QO")
 
-        matches = re.match('^QO(.{12})(\d{4})(.{3})(T[01])(F0|F1|  ) ?$', line)
-        if not matches:
+        if not self.layout.decode(self, line):
             raise Exception("Journey origin line incorrectly formatted: " + line)
 
-        self.location = canonicalise_location(matches.group(1))
-        self.published_departure_time = parse_time(matches.group(2))
-        self.bay_number = matches.group(3).strip()
-        self.timing_point_indicator = { 'T0' : False, 'T1' : True }[matches.group(4)]
-        self.fare_stage_indicator = { 'F0' : False, 'F1' : True, '  ' : None }[matches.group(5)]
-
     def is_set_down(self):
         return False
 
@@ -987,37 +3116,40 @@ class JourneyIntermediate(CIFRecord):
     True
     '''
 
+    # BPSN are documented values for activity_flag in CIF file, other train ones are documented
+    # in http://www.atoc.org/rsp/_downloads/RJIS/20040601.pdf
+    layout = RecordLayout('QI', [
+        ('location', 12, '.{12}', _cached_location),
+        ('published_arrival_time', 4, '\d{4}', _cached_time),
+        ('published_departure_time', 4, '\d{4}', _cached_time),
+        ('activity_flag', 1, '[BPSNACDORTUKXL -]', None),
+        ('bay_number', 3, '.{3}', _strip),
+        ('timing_point_indicator', 2, 'T[01]', _timing_point_indicator),
+        ('fare_stage_indicator', 2, 'F0|F1|  ', _fare_stage_indicator) ])
+
     def __init__(self, line):
         CIFRecord.__init__(self, line, "QI")
 
-        # BPSN are documented values for activity_flag in CIF file, other train ones are documented
-        # in http://www.atoc.org/rsp/_downloads/RJIS/20040601.pdf
-        matches = re.match('^QI(.{12})(\d{4})(\d{4})([BPSNACDORTUKXL -])(.{3})(T[01])(F0|F1|  )$', line)
-        if not matches:
+        if not self.layout.decode(self, line):
             raise Exception("Journey intermediate line incorrectly formatted: " + line)
 
-        self.location = canonicalise_location(matches.group(1))
-        self.published_arrival_time = parse_time(matches.group(2))
-        self.published_departure_time = parse_time(matches.group(3))
-        self.activity_flag = matches.group(4)
-        self.bay_number = matches.group(5).strip()
-        self.timing_point_indicator = { 'T0' : False, 'T1' : True }[matches.group(6)]
-        self.fare_stage_indicator = { 'F0' : False, 'F1' : True, '  ' : None }[matches.group(7)]
-
-        # We think O means no stop for trains, and all such entries have no time marked
-        if self.activity_flag == 'O':
-            assert self.published_arrival_time == datetime.time(0, 0, 0) and self.published_departure_time == datetime.time(0, 0, 0)
-        # D is the same as S - Set Down only. Always has 0000 for departure time.
-        # Let us assume departure time = arrival.
-        if self.activity_flag == 'D':
-            assert self.published_departure_time == datetime.time(0, 0, 0)
-            assert self.published_arrival_time != datetime.time(0, 0, 0)
-            self.published_departure_time = self.published_arrival_time
-        # U appears to be the opposite, same as P (Pick Up only).
-        if self.activity_flag == 'U':
-            assert self.published_departure_time != datetime.time(0, 0, 0)
-            assert self.published_arrival_time == datetime.time(0, 0, 0)
-            self.published_arrival_time = self.published_departure_time
+        activity_flag = self.activity_flag
+        if activity_flag in 'ODU':
+            midnight = datetime.time(0, 0, 0)
+            # We think O means no stop for trains, and all such entries have no time marked
+            if activity_flag == 'O':
+                assert self.published_arrival_time == midnight and self.published_departure_time == midnight
+            # D is the same as S - Set Down only. Always has 0000 for departure time.
+            # Let us assume departure time = arrival.
+            if activity_flag == 'D':
+                assert self.published_departure_time == midnight
+                assert self.published_arrival_time != midnight
+                self.published_departure_time = self.published_arrival_time
+            # U appears to be the opposite, same as P (Pick Up only).
+            if activity_flag == 'U':
+                assert self.published_departure_time != midnight
+                assert self.published_arrival_time == midnight
+                self.published_arrival_time = self.published_departure_time
 
     # B - Both pick up and set down
     # P - Pick up only
@@ -1036,17 +3168,23 @@ class JourneyIntermediate(CIFRecord):
     # [space] - Undocumented
     # - - stop to attach/detach vehicles
     def is_set_down(self):
-        if self.activity_flag in ['B', 'S', 'T', 'D', 'R']:
-            return True
-        if self.activity_flag in ['N', 'P', 'O', 'U', 'A', 'C', 'X', '-', 'L', 'K', ' ']:
-            return False
-        assert False, "activity_flag %s not supported (location %s) " % (self.activity_flag, self.location)
+        return _activity_is_set_down(self.activity_flag, self.location)
     def is_pick_up(self):
-        if self.activity_flag in ['B', 'P', 'T', 'U', 'R']:
-            return True
-        if self.activity_flag in ['N', 'S', 'O', 'D', 'A', 'C', 'X', '-', 'L', 'K', ' ']:
-            return False
-        assert False, "activity_flag %s not supported (location %s)" % (self.activity_flag, self.location)
+        return _activity_is_pick_up(self.activity_flag, self.location)
+
+def _activity_is_set_down(activity_flag, location):
+    if activity_flag in ['B', 'S', 'T', 'D', 'R']:
+        return True
+    if activity_flag in ['N', 'P', 'O', 'U', 'A', 'C', 'X', '-', 'L', 'K', ' ']:
+        return False
+    assert False, "activity_flag %s not supported (location %s) " % (activity_flag, location)
+
+def _activity_is_pick_up(activity_flag, location):
+    if activity_flag in ['B', 'P', 'T', 'U', 'R']:
+        return True
+    if activity_flag in ['N', 'S', 'O', 'D', 'A', 'C', 'X', '-', 'L', 'K', ' ']:
+        return False
+    assert False, "activity_flag %s not supported (location %s)" % (activity_flag, location)
 
 
 class JourneyDestination(CIFRecord):
@@ -1071,25 +3209,505 @@ class JourneyDestination(CIFRecord):
     False
     '''
 
+    layout = RecordLayout('QT', [
+        ('location', 12, '.{12}', _cached_location),
+        ('published_arrival_time', 4, '\d{4}', _cached_time),
+        ('bay_number', 3, '.{3}', _strip),
+        ('timing_point_indicator', 2, 'T[01]', _timing_point_indicator),
+        ('fare_stage_indicator', 2, 'F0|F1|  ', _fare_stage_indicator) ])
+
     def __init__(self, line):
         CIFRecord.__init__(self, line, "QT")
 
-        matches = re.match('^QT(.{12})(\d{4})(.{3})(T[01])(F0|F1|  )$', line)
-        if not matches:
+        if not self.layout.decode(self, line):
             raise Exception("Journey destination line incorrectly formatted: " + line)
 
-        self.location = canonicalise_location(matches.group(1))
-        self.published_arrival_time = parse_time(matches.group(2))
-        self.bay_number = matches.group(3).strip()
-        self.timing_point_indicator = { 'T0' : False, 'T1' : True }[matches.group(4)]
-        self.fare_stage_indicator = { 'F0' : False, 'F1' : True, '  ' : None }[matches.group(5)]
-
     def is_set_down(self):
         return True
 
     def is_pick_up(self):
         return False
 
+###########################################################
+# Compact storage of hops
+
+# Activities stored for hops which aren't JourneyIntermediate records, so
+# don't have an activity_flag. Neither character is a valid activity_flag.
+_ORIGIN_ACTIVITY = '<'
+_DESTINATION_ACTIVITY = '>'
+_ACTIVITY_FROM_RECORD_IDENTITY = { 'QO' : _ORIGIN_ACTIVITY, 'QT' : _DESTINATION_ACTIVITY }
+_RECORD_IDENTITY_FROM_ACTIVITY = { _ORIGIN_ACTIVITY : 'QO', _DESTINATION_ACTIVITY : 'QT' }
+
+# Bit flags for each hop
+_TIMING_POINT = 1
+_FARE_STAGE = { None : 0, False : 2, True : 4 }
+_FARE_STAGE_MASK = 6
+_FARE_STAGE_FROM_FLAGS = { 0 : None, 2 : False, 4 : True }
+
+# Times are stored as minutes past midnight
+_NO_TIME = 0xFFFF
+_TIME_FROM_MINUTES = [ datetime.time(minutes // 60, minutes % 60) for minutes in range(24 * 60) ]
+
+def _minutes(time):
+    return time.hour * 60 + time.minute
+
+def _stored_is_set_down(activity, location):
+    if activity == _ORIGIN_ACTIVITY:
+        return False
+    if activity == _DESTINATION_ACTIVITY:
+        return True
+    return _activity_is_set_down(activity, location)
+
+def _stored_is_pick_up(activity, location):
+    if activity == _ORIGIN_ACTIVITY:
+        return True
+    if activity == _DESTINATION_ACTIVITY:
+        return False
+    return _activity_is_pick_up(activity, location)
+
+def _hop_columns(hop):
+    '''Returns the activity, arrival and departure minutes, flags and bay
+    number of a hop record, as stored by HopStore and PatternStore.'''
+    record_identity = hop.record_identity
+    if record_identity == 'QI':
+        activity = hop.activity_flag
+    else:
+        activity = _ACTIVITY_FROM_RECORD_IDENTITY[record_identity]
+    arrival = departure = _NO_TIME
+    if record_identity != 'QO':
+        arrival = _minutes(hop.published_arrival_time)
+    if record_identity != 'QT':
+        departure = _minutes(hop.published_departure_time)
+    flags = _FARE_STAGE[hop.fare_stage_indicator]
+    if hop.timing_point_indicator:
+        flags |= _TIMING_POINT
+    return activity, arrival, departure, flags, hop.bay_number
+
+class HopStore(object):
+    '''Stores the hops of journeys compactly, in flat arrays with one entry
+    per hop, rather than as a Python object each. Make ATCO use one with
+    compact_hops. Each journey's hops are then replaced with a HopSequence,
+    whose HopView items behave like the original records.
+
+    >>> atco = ATCO(compact_hops = True)
+    >>> atco.read_string("""ATCO-CIF0510                       70 - RAIL        ATCORAIL20080124115909
+    ... QSNCH   2933E20071008200712071111100  1H49P80092TRAIN           I
+    ... QO9100PRINRIS 16362  T1  
+    ... QI9100SUNDRTN 16401640T   T1  
+    ... QI9100HWYCOMB 16471647T3  T0F1
+    ... QT9100MARYLBN 17286  T1  
+    ... """)
+    >>> journey = atco.journeys[0]
+    >>> journey.hops
+    HopSequence(HopView('QO', '9100PRINRIS'), HopView('QI', '9100SUNDRTN'), HopView('QI', '9100HWYCOMB'), HopView('QT', '9100MARYLBN'))
+    >>> hop = journey.hops[2]
+    >>> hop.published_arrival_time, hop.activity_flag, hop.bay_number, hop.timing_point_indicator, hop.fare_stage_indicator
+    (datetime.time(16, 47), 'T', '3', False, True)
+    >>> journey.hops[0].published_departure_time, journey.hops[0].is_set_down(), journey.hops[-1].is_set_down()
+    (datetime.time(16, 36), False, True)
+    >>> journey.find_arrival_times_at_location('9100HWYCOMB')
+    [datetime.time(16, 47)]
+    >>> journey.find_departure_times_at_location('9100MARYLBN')
+    []
+
+    Records which don't have a field don't have it as a view either.
+    >>> journey.hops[0].published_arrival_time
+    Traceback (most recent call last):
+        ...
+    AttributeError: QO record has no published_arrival_time
+
+    The memory used per million hops is reported, which is much less than the
+    kilobyte or so used by each record object.
+    >>> atco.hop_store.bytes_per_million_hops()
+    14000000
+    '''
+
+    def __init__(self, location_ids = None):
+        self.journeys = []
+        self.journey_index = array.array('i')
+        self.location_id = array.array('i')
+        self.arrival = array.array('H')
+        self.departure = array.array('H')
+        self.activity = array.array('c')
+        self.flags = array.array('B')
+        self.bay_numbers = {} # by hop index, only for the few that have them
+
+        if location_ids is None:
+            location_ids = LocationIds()
+        self.location_ids = location_ids
+        self.location_codes = location_ids.codes
+
+    def __len__(self):
+        return len(self.location_id)
+
+    def add_journey(self, journey):
+        '''Moves the hops of the journey into the store, replacing them with
+        a HopSequence. Hops can't be added to the journey afterwards.'''
+        journey_index = len(self.journeys)
+        self.journeys.append(journey)
+        start = len(self)
+        for hop in journey.hops:
+            index = len(self)
+            activity, arrival, departure, flags, bay_number = _hop_columns(hop)
+            self.journey_index.append(journey_index)
+            self.location_id.append(self.location_ids.add(hop.location))
+            self.activity.append(activity)
+            self.arrival.append(arrival)
+            self.departure.append(departure)
+            self.flags.append(flags)
+            if bay_number:
+                self.bay_numbers[index] = bay_number
+        journey.hops = HopSequence(self, start, len(self))
+        del journey.hop_lines
+
+    def bytes_per_million_hops(self):
+        '''Memory used by the arrays per million hops. This doesn't include
+        the bay numbers, which few hops have, or the location codes.'''
+        bytes_per_hop = 0
+        for column in (self.journey_index, self.location_id, self.arrival, self.departure, self.activity, self.flags):
+            bytes_per_hop += column.itemsize
+        return bytes_per_hop * 1000000
+
+class HopSequence(object):
+    '''The hops of one journey in a HopStore, which can be used in place of
+    the list of records. See HopStore for examples.'''
+
+    __slots__ = ('store', 'start', 'end')
+
+    def __init__(self, store, start, end):
+        self.store = store
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [ self[i] for i in range(*index.indices(len(self))) ]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("hop index out of range")
+        return HopView(self.store, self.start + index)
+
+    def __iter__(self):
+        store = self.store
+        for index in xrange(self.start, self.end):
+            yield HopView(store, index)
+
+    def __repr__(self):
+        return "HopSequence(" + ", ".join([ repr(hop) for hop in self ]) + ")"
+
+class HopView(object):
+    '''One hop in a HopStore. It has the same fields and functions as the
+    JourneyOrigin, JourneyIntermediate or JourneyDestination record it was
+    made from, apart from the line itself. See HopStore for examples.'''
+
+    __slots__ = ('store', 'index')
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    def __eq__(self, other):
+        return isinstance(other, HopView) and self.store == other.store and self.index == other.index
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.index)
+
+    def __repr__(self):
+        return "HopView(" + repr(self.record_identity) + ", " + repr(self.location) + ")"
+
+    def __str__(self):
+        ret = self.__class__.__name__ + "\n"
+        for key in ('record_identity', 'location', 'published_arrival_time', 'published_departure_time',
+                    'activity_flag', 'bay_number', 'timing_point_indicator', 'fare_stage_indicator'):
+            if hasattr(self, key):
+                ret = ret + "\t" + key + ": " + repr(getattr(self, key)) + "\n"
+        return ret
+
+    def _missing(self, name):
+        raise AttributeError(self.record_identity + " record has no " + name)
+
+    def _get_record_identity(self):
+        return _RECORD_IDENTITY_FROM_ACTIVITY.get(self.store.activity[self.index], 'QI')
+    record_identity = property(_get_record_identity)
+
+    def _get_location(self):
+        return self.store.location_codes[self.store.location_id[self.index]]
+    location = property(_get_location)
+
+    def _get_published_arrival_time(self):
+        minutes = self.store.arrival[self.index]
+        if minutes == _NO_TIME:
+            self._missing('published_arrival_time')
+        return _TIME_FROM_MINUTES[minutes]
+    published_arrival_time = property(_get_published_arrival_time)
+
+    def _get_published_departure_time(self):
+        minutes = self.store.departure[self.index]
+        if minutes == _NO_TIME:
+            self._missing('published_departure_time')
+        return _TIME_FROM_MINUTES[minutes]
+    published_departure_time = property(_get_published_departure_time)
+
+    def _get_activity_flag(self):
+        activity = self.store.activity[self.index]
+        if activity in _RECORD_IDENTITY_FROM_ACTIVITY:
+            self._missing('activity_flag')
+        return activity
+    activity_flag = property(_get_activity_flag)
+
+    def _get_bay_number(self):
+        return self.store.bay_numbers.get(self.index, '')
+    bay_number = property(_get_bay_number)
+
+    def _get_timing_point_indicator(self):
+        return bool(self.store.flags[self.index] & _TIMING_POINT)
+    timing_point_indicator = property(_get_timing_point_indicator)
+
+    def _get_fare_stage_indicator(self):
+        return _FARE_STAGE_FROM_FLAGS[self.store.flags[self.index] & _FARE_STAGE_MASK]
+    fare_stage_indicator = property(_get_fare_stage_indicator)
+
+    def to_record(self):
+        '''Makes a record like the one the hop was made from. Its line has the
+        same fields as the original, but the location is in canonical form.
+
+        >>> store = HopStore()
+        >>> jh = JourneyHeader('QSNCH   2933E20071008200712071111100  1H49P80092TRAIN           I', 1)
+        >>> jh.add_hop(JourneyIntermediate('QI9100 hwycomb16471647T3  T0F1'))
+        >>> jh.add_hop(JourneyIntermediate('QI9100SUNDRTN 00001650U   T1  '))
+        >>> store.add_journey(jh)
+        >>> [ hop.to_record().line for hop in jh.hops ]
+        ['QI9100HWYCOMB 16471647T3  T0F1', 'QI9100SUNDRTN 00001650U   T1  ']
+        '''
+        record_identity = self.record_identity
+        line = record_identity + '%-12s' % self.location
+        if record_identity == 'QI':
+            activity_flag = self.activity_flag
+            # these have times of 0000 in the file, see JourneyIntermediate
+            line += activity_flag in 'OU' and '0000' or self.published_arrival_time.strftime('%H%M')
+            line += activity_flag in 'OD' and '0000' or self.published_departure_time.strftime('%H%M')
+            line += activity_flag
+        elif record_identity == 'QO':
+            line += self.published_departure_time.strftime('%H%M')
+        else:
+            line += self.published_arrival_time.strftime('%H%M')
+        line += '%-3s' % self.bay_number
+        line += self.timing_point_indicator and 'T1' or 'T0'
+        line += { None : '  ', False : 'F0', True : 'F1' }[self.fare_stage_indicator]
+        return { 'QO' : JourneyOrigin, 'QI' : JourneyIntermediate, 'QT' : JourneyDestination }[record_identity](line)
+
+    def is_set_down(self):
+        return _stored_is_set_down(self.store.activity[self.index], self.location)
+
+    def is_pick_up(self):
+        return _stored_is_pick_up(self.store.activity[self.index], self.location)
+
+class PatternStore(object):
+    '''Stores each different sequence of stops that journeys follow once, as
+    a StopPattern, with everything about the stops but the times. Make ATCO
+    use one with share_patterns. Each journey then keeps just its pattern,
+    its time of setting off, and its times relative to that, which are
+    shared with other journeys on the pattern that take the same time between
+    stops. journey.hops is made from these when it is used, and behaves like
+    the original list of records, as for HopStore.
+
+    >>> atco = ATCO(share_patterns = True)
+    >>> atco.read_string("""ATCO-CIF0510                       70 - RAIL        ATCORAIL20080124115909
+    ... QSNGW    6B1820070521200712071111100  2B02P10452TRAIN           I
+    ... QO9100MDNHEAD 0549URLT1  
+    ... QI9100FURZEP  05530553T3  T1  
+    ... QT9100MARLOW  0612   T1  
+    ... QSNGW    6B1A20070521200712071111100  2B04P10456TRAIN           I
+    ... QO9100MDNHEAD 2349URLT1  
+    ... QI9100FURZEP  23532353T3  T1  
+    ... QT9100MARLOW  0012   T1  
+    ... QSNGW    6B2020070521200712071111100  2B04P10456TRAIN           I
+    ... QO9100MDNHEAD 0608URLT1  
+    ... QT9100BORNEND 0620   T1  
+    ... """)
+    >>> len(atco.pattern_store.patterns)
+    2
+    >>> first, second, third = atco.journeys
+    >>> first.stop_pattern is second.stop_pattern, first.pattern_timing is second.pattern_timing
+    (True, True)
+    >>> first.stop_pattern.locations()
+    ('9100MDNHEAD', '9100FURZEP', '9100MARLOW')
+    >>> [ journey.id for journey in first.stop_pattern.journeys ]
+    ['GW-6B18', 'GW-6B1A']
+    >>> [ (hop.location, hop.bay_number, hop.published_departure_time) for hop in second.hops[:2] ]
+    [('9100MDNHEAD', 'URL', datetime.time(23, 49)), ('9100FURZEP', '3', datetime.time(23, 53))]
+    >>> second.hops[-1].published_arrival_time
+    datetime.time(0, 12)
+    >>> second.find_arrival_times_at_location('9100MARLOW')
+    [datetime.time(0, 12)]
+    >>> second.segment('9100MDNHEAD', '9100MARLOW'), second.stop_pattern.hop_positions is not None
+    ((datetime.time(23, 49), datetime.time(0, 12)), True)
+    >>> second.hops[0] == second.hops[0], second.hops[0] == first.hops[0]
+    (True, False)
+    >>> atco.index_by_short_codes()
+    >>> sorted([ journey.id for journey in atco.journeys_visiting_location['9100MDNHEAD'] ])
+    ['GW-6B18', 'GW-6B1A', 'GW-6B20']
+    '''
+
+    def __init__(self, location_ids = None):
+        self.patterns = []
+        self.pattern_from_key = {}
+        if location_ids is None:
+            location_ids = LocationIds()
+        self.location_ids = location_ids
+        self.location_codes = location_ids.codes
+
+    def add_journey(self, journey):
+        '''Replaces the hops of the journey with its pattern and times. Hops
+        can't be added to the journey afterwards.'''
+        stops = []
+        arrivals = []
+        departures = []
+        for hop in journey.hops:
+            activity, arrival, departure, flags, bay_number = _hop_columns(hop)
+            stops.append((self.location_ids.add(hop.location), activity, flags, bay_number))
+            arrivals.append(arrival)
+            departures.append(departure)
+        stops = tuple(stops)
+        pattern = self.pattern_from_key.get(stops)
+        if pattern is None:
+            pattern = self.pattern_from_key[stops] = StopPattern(self, stops)
+            self.patterns.append(pattern)
+        pattern.journeys.append(journey)
+
+        # times are kept relative to the first one, so journeys which take the
+        # same time between stops can share them
+        start = 0
+        if departures and departures[0] != _NO_TIME:
+            start = departures[0]
+        elif arrivals and arrivals[0] != _NO_TIME:
+            start = arrivals[0]
+        timing = (array.array('H', [ _relative_minutes(minutes, start) for minutes in arrivals ]),
+                  array.array('H', [ _relative_minutes(minutes, start) for minutes in departures ]))
+        key = timing[0].tostring() + timing[1].tostring()
+        shared_timing = pattern.timings.get(key)
+        if shared_timing is None:
+            shared_timing = pattern.timings[key] = timing
+        journey.stop_pattern = pattern
+        journey.pattern_timing = shared_timing
+        journey.pattern_start = start
+        del journey.hops
+        del journey.hop_lines
+
+def _positions_by_location(locations):
+    positions = {}
+    for position, location in enumerate(locations):
+        positions[location] = positions.get(location, ()) + (position,)
+    return positions
+
+def _relative_minutes(minutes, start):
+    if minutes == _NO_TIME:
+        return minutes
+    return (minutes - start) % (24 * 60)
+
+class StopPattern(object):
+    '''A sequence of stops, and what happens at each, shared by all the
+    journeys in journeys. See PatternStore for examples.'''
+
+    def __init__(self, pattern_store, stops):
+        self.location_codes = pattern_store.location_codes
+        self.location_id = array.array('i', [ stop[0] for stop in stops ])
+        self.activity = array.array('c', [ stop[1] for stop in stops ])
+        self.flags = array.array('B', [ stop[2] for stop in stops ])
+        self.bay_numbers = dict([ (index, stop[3]) for index, stop in enumerate(stops) if stop[3] ])
+        self.journeys = []
+        self.timings = {} # shared arrays of relative arrival and departure minutes, by their bytes
+        self.hop_positions = None # made by positions_of_location
+
+    def __len__(self):
+        return len(self.location_id)
+
+    def locations(self):
+        '''Returns the short codes of the stops in order.'''
+        return tuple([ self.location_codes[location_id] for location_id in self.location_id ])
+
+    def positions_of_location(self, location):
+        '''Returns the positions of the stops at a location (as a short code),
+        as for JourneyHeader.positions_of_location.'''
+        return self._hop_positions().get(location, ())
+
+    def _hop_positions(self):
+        if self.hop_positions is None:
+            self.hop_positions = _positions_by_location(self.locations())
+        return self.hop_positions
+
+    def segment(self, journey, from_location, to_location):
+        '''As JourneyHeader.segment, for a journey on this pattern, without
+        making its hops.'''
+        positions = self._hop_positions()
+        boardings = positions.get(from_location)
+        alightings = positions.get(to_location)
+        if boardings is None or alightings is None:
+            return None
+        activity = self.activity
+        for alighting in alightings:
+            if not _stored_is_set_down(activity[alighting], to_location):
+                continue
+            for boarding in reversed(boardings):
+                if boarding < alighting and _stored_is_pick_up(activity[boarding], from_location):
+                    arrivals, departures = journey.pattern_timing
+                    start = journey.pattern_start
+                    return (_TIME_FROM_MINUTES[(departures[boarding] + start) % (24 * 60)],
+                            _TIME_FROM_MINUTES[(arrivals[alighting] + start) % (24 * 60)])
+        return None
+
+    def hops_of(self, journey):
+        '''Returns a HopSequence of the hops of a journey on this pattern.'''
+        return HopSequence(_PatternHops(self, journey.pattern_timing, journey.pattern_start), 0, len(self))
+
+class _PatternHops(object):
+    '''Has the same columns as a HopStore for the hops of one journey on a
+    StopPattern, so HopView can be used to look at them.'''
+
+    __slots__ = ('pattern', 'location_codes', 'location_id', 'activity', 'flags', 'bay_numbers', 'arrival', 'departure')
+
+    def __init__(self, pattern, timing, start):
+        self.pattern = pattern
+        self.location_codes = pattern.location_codes
+        self.location_id = pattern.location_id
+        self.activity = pattern.activity
+        self.flags = pattern.flags
+        self.bay_numbers = pattern.bay_numbers
+        self.arrival = _ShiftedMinutes(timing[0], start)
+        self.departure = _ShiftedMinutes(timing[1], start)
+
+    def __eq__(self, other):
+        return isinstance(other, _PatternHops) and self.pattern is other.pattern and \
+            self.arrival == other.arrival and self.departure == other.departure
+
+    def __ne__(self, other):
+        return not self == other
+
+class _ShiftedMinutes(object):
+    '''Minutes relative to a start, looked up as minutes past midnight.'''
+
+    __slots__ = ('minutes', 'start')
+
+    def __init__(self, minutes, start):
+        self.minutes = minutes
+        self.start = start
+
+    def __getitem__(self, index):
+        minutes = self.minutes[index]
+        if minutes == _NO_TIME:
+            return minutes
+        return (minutes + self.start) % (24 * 60)
+
+    def __eq__(self, other):
+        return self.minutes is other.minutes and self.start == other.start
+
 ###########################################################
 # Location record classes
  
@@ -1122,20 +3740,21 @@ class Location(CIFRecord):
     'Chalfont and Latimer Rail Station, Chiltern'
     '''
 
+    layout = RecordLayout('QL', [
+        ('transaction_type', 1, '[NDR]', None),
+        ('location', 12, '.{12}', _cached_location),
+        ('full_location', 48, '.{48}', _strip),
+        ('gazetteer_code', 1, '.', None),
+        ('point_type', 1, '[BSPRID ]', None),
+        ('national_gazetteer_id', 8, '.{8}', None) ])
+
     def __init__(self, line):
         CIFRecord.__init__(self, line, "QL")
 
-        matches = re.match('^QL([NDR])(.{12})(.{48})(.)([BSPRID ])(.{8})$', line)
-        if not matches:
+        if not self.layout.decode(self, line):
             raise Exception("Location line incorrectly formatted: " + line)
 
-        self.transaction_type = matches.group(1)
         assert self.transaction_type == 'N' # code doesn't handle other types yet
-        self.location = canonicalise_location(matches.group(2))
-        self.full_location = matches.group(3).strip()
-        self.gazetteer_code = matches.group(4)
-        self.point_type = matches.group(5)
-        self.national_gazetteer_id = matches.group(6)
         self.additional = None
 
     def __str__(self):
@@ -1187,22 +3806,20 @@ class LocationAdditional(CIFRecord):
     -1
     '''
 
+    layout = RecordLayout('QB', [
+        ('transaction_type', 1, '[NDR]', None),
+        ('location', 12, '.{12}', _cached_location),
+        ('grid_reference_easting', 8, '.{8}', _parse_grid_reference),
+        ('grid_reference_northing', 8, '.{8}', _parse_grid_reference),
+        ('district_name', 24, '.{24}', _strip),
+        ('town_name', 24, '.{24}', _strip) ])
+
     def __init__(self, line):
         CIFRecord.__init__(self, line, "QB")
 
-        matches = re.match('^QB([NDR])(.{12})(.{8})(.{8})(.{24})(.{24})$', line)
-        if not matches:
+        if not self.layout.decode(self, line):
             raise Exception("Location additional line incorrectly formatted: " + line)
 
-        self.transaction_type = matches.group(1)
-        self.location = canonicalise_location(matches.group(2))
-        easting = matches.group(3).strip()
-        northing = matches.group(4).strip()
-        self.grid_reference_easting = easting and int(easting) or -1
-        self.grid_reference_northing = northing and int(northing) or -1
-        self.district_name = matches.group(5).strip()
-        self.town_name = matches.group(6).strip()
-
 ###########################################################
 # Vehicle type classes
  
@@ -1234,22 +3851,1946 @@ class VehicleType(CIFRecord):
               'Heavy Rail' : 'T', 
               'Air' : 'A' }
 
+    layout = RecordLayout('QV', [
+        ('transaction_type', 1, '[NDR]', None),
+        ('vehicle_type', 8, '.{8}', _strip_upper),
+        ('vehicle_long_type', 24, '.{24}', _strip) ])
+
     def __init__(self, line):
         CIFRecord.__init__(self, line, "QV")
 
-        matches = re.match('^QV([NDR])(.{8})(.{24})$', line)
-        if not matches:
+        if not self.layout.decode(self, line):
             raise Exception("Vehicle type line incorrectly formatted: " + line)
 
-        self.transaction_type = matches.group(1)
         assert self.transaction_type == 'N' # code doesn't handle other types yet
-        self.vehicle_type = matches.group(2).strip().upper()
-        self.vehicle_long_type = matches.group(3).strip()
         assert self.vehicle_long_type in VehicleType.types
 
     def type_code(self):
         return VehicleType.types[self.vehicle_long_type]
 
+###########################################################
+# Timetable queries
+
+class DepartureBoard(object):
+    '''Answers which journeys leave or arrive at a stop during a period of
+    time on a date, like a departure board. It is made from the journeys in an
+    ATCO object, and keeps the departure and arrival times at each stop in
+    sorted arrays, so that queries are a binary search. Only times where the
+    journey picks up (for departures) or sets down (for arrivals) are used.
+
+    >>> atco = ATCO()
+    >>> atco.read_string("""ATCO-CIF0510                       70 - RAIL        ATCORAIL20080124115909
+    ... QSNGW    6B1820070521200712071111100  2B02P10452TRAIN           I
+    ... QO9100MDNHEAD 0549URLT1  
+    ... QI9100FURZEP  05530553T   T1  
+    ... QT9100MARLOW  0612   T1  
+    ... QSNGW    6B1A20070521200712071111100  2B04P10456TRAIN           I
+    ... QO9100MDNHEAD 0608URLT1  
+    ... QI9100FURZEP  06120612S   T1  
+    ... QT9100BORNEND 0620   T1  
+    ... QSNGW    6B2020070521200712071111100  2B04P10456TRAIN           I
+    ... QO9100MDNHEAD 2355   T1  
+    ... QT9100FURZEP  2402   T1  
+    ... """)
+    >>> board = DepartureBoard(atco)
+    >>> monday = datetime.date(2007, 5, 21)
+    >>> def show(times_and_journeys):
+    ...     return [ (str(t), journey.id) for t, journey in times_and_journeys ]
+    >>> show(board.departures('9100MDNHEAD', monday, datetime.time(5, 0), datetime.time(7, 0)))
+    [('05:49:00', 'GW-6B18'), ('06:08:00', 'GW-6B1A')]
+    >>> show(board.departures('9100MDNHEAD', monday, datetime.time(5, 0), limit = 1))
+    [('05:49:00', 'GW-6B18')]
+    >>> show(board.departures('9100FURZEP', monday))
+    [('05:53:00', 'GW-6B18')]
+    >>> show(board.arrivals('9100FURZEP', monday, datetime.time(6, 0)))
+    [('06:12:00', 'GW-6B1A')]
+    >>> show(board.departures('9100MDNHEAD', datetime.date(2007, 5, 26)))
+    []
+
+    Times after midnight on journeys which started the day before are counted
+    on the following day.
+    >>> show(board.arrivals('9100FURZEP', monday, datetime.time(0, 0), datetime.time(1, 0)))
+    []
+    >>> show(board.arrivals('9100FURZEP', datetime.date(2007, 5, 26), datetime.time(0, 0), datetime.time(1, 0)))
+    [('00:02:00', 'GW-6B20')]
+    '''
+
+    def __init__(self, atco):
+        self.journeys = list(atco.journeys)
+        self.location_ids = atco.location_ids
+        add_location = self.location_ids.add
+        departures = {}
+        arrivals = {}
+        for journey_index, journey in enumerate(self.journeys):
+            previous_minutes = 0
+            day = 0
+            for hop in journey.hops:
+                if hop.is_set_down():
+                    minutes = _minutes(hop.published_arrival_time)
+                    if minutes < previous_minutes:
+                        day = 1
+                    previous_minutes = minutes
+                    arrivals.setdefault(add_location(hop.location), []).append((minutes, day, journey_index))
+                if hop.is_pick_up():
+                    minutes = _minutes(hop.published_departure_time)
+                    if minutes < previous_minutes:
+                        day = 1
+                    previous_minutes = minutes
+                    departures.setdefault(add_location(hop.location), []).append((minutes, day, journey_index))
+        self.departure_times = self._sorted_arrays(departures)
+        self.arrival_times = self._sorted_arrays(arrivals)
+
+    def _sorted_arrays(self, times):
+        '''Turns lists of (minutes, day, journey index) for each stop into
+        three arrays sorted by time.'''
+        ret = LocationIndex(self.location_ids)
+        for location, entries in times.iteritems():
+            entries.sort()
+            ret[location] = (array.array('H', [ entry[0] for entry in entries ]),
+                             array.array('B', [ entry[1] for entry in entries ]),
+                             array.array('i', [ entry[2] for entry in entries ]))
+        return ret
+
+    def departures(self, location, d, from_time = None, to_time = None, limit = None):
+        '''Returns a list of pairs of departure time and journey, for journeys
+        which pick up at the location between the times (inclusive) on the
+        date. See DepartureBoard for examples.'''
+        return self._query(self.departure_times, location, d, from_time, to_time, limit)
+
+    def arrivals(self, location, d, from_time = None, to_time = None, limit = None):
+        '''Returns a list of pairs of arrival time and journey, for journeys
+        which set down at the location between the times (inclusive) on the
+        date. See DepartureBoard for examples.'''
+        return self._query(self.arrival_times, location, d, from_time, to_time, limit)
+
+    def _query(self, times, location, d, from_time, to_time, limit):
+        ret = []
+        if location not in times:
+            return ret
+        minutes, days, journey_indices = times[location]
+        from_minutes = 0
+        if from_time is not None:
+            from_minutes = _minutes(from_time)
+        to_minutes = 24 * 60 - 1
+        if to_time is not None:
+            to_minutes = _minutes(to_time)
+        previous_date = d - datetime.timedelta(days = 1)
+        i = bisect.bisect_left(minutes, from_minutes)
+        while i < len(minutes) and minutes[i] <= to_minutes:
+            journey = self.journeys[journey_indices[i]]
+            if days[i]:
+                runs = journey.runs_on_date(previous_date)
+            else:
+                runs = journey.runs_on_date(d)
+            if runs:
+                ret.append((_TIME_FROM_MINUTES[minutes[i]], journey))
+                if limit is not None and len(ret) >= limit:
+                    break
+            i += 1
+        return ret
+
+_UNREACHED = 0x7fffffff
+
+class ConnectionScanPlanner(object):
+    '''Finds the earliest arrival from one stop to another on a date, using
+    the Connection Scan Algorithm. The journeys running on the date are
+    flattened into connections, each from one stop of a journey to the next,
+    sorted by departure time, and a query is a single pass along them. Times
+    inside the planner are minutes since the start of the date, so they go past
+    24 * 60 for journeys which cross midnight. Journeys which started the day
+    before and cross midnight are included from midnight onwards.
+
+    If index_nearby_locations has been called on the ATCO object, walking is
+    allowed between nearby stops at walking_speed metres a minute, once after
+    each journey and from the origin.
+
+    >>> atco = ATCO()
+    >>> atco.read_string("""ATCO-CIF0510                       70 - RAIL        ATCORAIL20080124115909
+    ... QSNGW    6B1820070521200712071111100  2B02P10452TRAIN           I
+    ... QO9100MDNHEAD 0549URLT1  
+    ... QI9100FURZEP  05530553B   T1  
+    ... QT9100MARLOW  0612   T1  
+    ... QSNGW    6B1A20070521200712071111100  2B04P10456TRAIN           I
+    ... QO9100FURZEP  0600URLT1  
+    ... QT9100BORNEND 0620   T1  
+    ... QSNGW    6B2020070521200712071111100  2B04P10456TRAIN           I
+    ... QO9100MDNHEAD 2355   T1  
+    ... QI9100FURZEP  23592401B   T1  
+    ... QT9100COOKHAM 2405   T1  
+    ... QLN9100MDNHEAD Maidenhead Rail Station                          RE0043271
+    ... QBN9100MDNHEAD 488700  180900                                                  
+    ... QLN9100FURZEP  Furze Platt Rail Station                         RE0043271
+    ... QBN9100FURZEP  488294  182334                                                  
+    ... QLN9100COOKHAM Cookham Rail Station                             RE0057284
+    ... QBN9100COOKHAM 488690  185060                                                  
+    ... QLN9100BORNEND Bourne End Rail Station                          RE0057284
+    ... QBN9100BORNEND 488690  185860                                                  
+    ... """)
+    >>> atco.index_nearby_locations(1000)
+    >>> monday = datetime.date(2007, 5, 21)
+    >>> planner = ConnectionScanPlanner(atco, monday)
+    >>> planner.earliest_arrival('9100MDNHEAD', '9100BORNEND', datetime.time(5, 30))
+    datetime.datetime(2007, 5, 21, 6, 20)
+    >>> for journey, from_location, departure, to_location, arrival in planner.plan('9100MDNHEAD', '9100BORNEND', datetime.time(5, 30)):
+    ...     print journey and journey.id, from_location, departure, to_location, arrival
+    GW-6B18 9100MDNHEAD 2007-05-21 05:49:00 9100FURZEP 2007-05-21 05:53:00
+    GW-6B1A 9100FURZEP 2007-05-21 06:00:00 9100BORNEND 2007-05-21 06:20:00
+
+    Later in the day, the only way is the journey after midnight, and a walk
+    of 800 metres at the end.
+    >>> for journey, from_location, departure, to_location, arrival in planner.plan('9100MDNHEAD', '9100BORNEND', datetime.time(6, 0)):
+    ...     print journey and journey.id, from_location, departure, to_location, arrival
+    GW-6B20 9100MDNHEAD 2007-05-21 23:55:00 9100COOKHAM 2007-05-22 00:05:00
+    None 9100COOKHAM 2007-05-22 00:05:00 9100BORNEND 2007-05-22 00:15:00
+
+    The next day, the end of the journey which started on Monday is used.
+    >>> ConnectionScanPlanner(atco, datetime.date(2007, 5, 22)).earliest_arrival('9100FURZEP', '9100COOKHAM', datetime.time(0, 0))
+    datetime.datetime(2007, 5, 22, 0, 5)
+    >>> planner.earliest_arrival('9100MARLOW', '9100BORNEND', datetime.time(5, 30)) is None
+    True
+
+    Stops which a journey only passes through have no times, and are left out.
+    >>> atco = ATCO()
+    >>> atco.read_string("""ATCO-CIF0510                       70 - RAIL        ATCORAIL20080124115909
+    ... QSNGW    6B1A20070521200712071111100  2B04P10456TRAIN           I
+    ... QO9100MDNHEAD 0608URLT1  
+    ... QI9100FURZEP  06120612B   T1  
+    ... QI9100COOKHAM 00000000O   T1  
+    ... QT9100BORNEND 0620   T1  
+    ... """)
+    >>> planner = ConnectionScanPlanner(atco, monday)
+    >>> planner.earliest_arrival('9100MDNHEAD', '9100BORNEND', datetime.time(6, 0))
+    datetime.datetime(2007, 5, 21, 6, 20)
+    >>> planner.earliest_arrival('9100MDNHEAD', '9100COOKHAM', datetime.time(6, 0)) is None
+    True
+    '''
+
+    def __init__(self, atco, d, walking_speed = 80.0):
+        self.date = d
+        self.midnight = datetime.datetime.combine(d, datetime.time(0, 0))
+        self.location_ids = atco.location_ids
+        self.journeys = []
+
+        connections = []
+        previous_date = d - datetime.timedelta(days = 1)
+        for journey in atco.journeys:
+            if journey.runs_on_date(d):
+                self._add_connections(connections, journey, 0)
+            if journey.runs_on_date(previous_date) and journey.crosses_midnight():
+                self._add_connections(connections, journey, -24 * 60)
+        connections.sort()
+        self.departure_time = array.array('i', [ connection[0] for connection in connections ])
+        self.arrival_time = array.array('i', [ connection[1] for connection in connections ])
+        self.departure_location = array.array('i', [ connection[2] for connection in connections ])
+        self.arrival_location = array.array('i', [ connection[3] for connection in connections ])
+        self.journey_index = array.array('i', [ connection[4] for connection in connections ])
+        self.flags = array.array('B', [ connection[5] for connection in connections ])
+        del connections
+
+        # walks between nearby stops, in whole minutes rounded up
+        nearby_locations = getattr(atco, 'nearby_locations', None) or {}
+        footpaths = {}
+        for location_id, nearby in dict.iteritems(nearby_locations):
+            footpaths[location_id] = tuple([ (self.location_ids.add(other_location.location), int(math.ceil(dist / walking_speed)))
+                for other_location, dist in nearby.iteritems() ])
+
+        # ids given to locations loaded after this aren't in the planner
+        self.locations = self.location_ids.codes[:]
+        self.footpaths = [ footpaths.get(location_id, ()) for location_id in xrange(len(self.locations)) ]
+
+    def _location_id(self, location):
+        '''Returns the id of the location's short code, or None if it isn't
+        in the planner.'''
+        location_id = self.location_ids.get(location)
+        if location_id is not None and location_id < len(self.locations):
+            return location_id
+        return None
+
+    def _add_connections(self, connections, journey, offset):
+        '''Adds a tuple of (departure time, arrival time, departure location,
+        arrival location, journey index, flags) to connections for each hop
+        of the journey to the next, with times offset by a number of minutes.
+        Connections which would leave before the start of the date are left
+        out. Flag 1 means the journey picks up at the departure, flag 2 that
+        it sets down at the arrival.'''
+        journey_index = len(self.journeys)
+        used = False
+        previous_minutes = 0
+        day = 0
+        departure = None
+        for hop in journey.hops:
+            set_down = hop.is_set_down()
+            pick_up = hop.is_pick_up()
+            if not set_down and not pick_up:
+                # passing through, with times of 0000 which would look like midnight
+                continue
+            location_id = self.location_ids.add(hop.location)
+            if departure is not None:
+                minutes = _minutes(hop.published_arrival_time)
+                if minutes < previous_minutes:
+                    day += 24 * 60
+                previous_minutes = minutes
+                arrival = minutes + day + offset
+                if departure[0] >= 0:
+                    flags = departure[2]
+                    if set_down:
+                        flags |= 2
+                    connections.append((departure[0], arrival, departure[1], location_id, journey_index, flags))
+                    used = True
+            if hop.record_identity == 'QT':
+                break
+            minutes = _minutes(hop.published_departure_time)
+            if minutes < previous_minutes:
+                day += 24 * 60
+            previous_minutes = minutes
+            departure = (minutes + day + offset, location_id, pick_up and 1 or 0)
+        if used:
+            self.journeys.append(journey)
+
+    def _datetime(self, minutes):
+        return self.midnight + datetime.timedelta(minutes = minutes)
+
+    def _scan(self, starts, target = -1, arrival = None, last_departure = None):
+        '''Runs the Connection Scan Algorithm from the (location id, minutes)
+        pairs in starts, walking on from each of them. Stops once nothing can
+        arrive earlier at the target location id (if it isn't -1), or after
+        the connections leaving at last_departure (if it isn't None). Earliest
+        arrivals are kept in arrival, which can be given from a scan with later
+        starts, as those can still be reached. Returns arrays of the earliest
+        arrival at each location (or _UNREACHED), the connection arrived on
+        (or -1) and the location walked from (or -1), and the connection each
+        journey was boarded at.'''
+        location_count = len(self.locations)
+        if arrival is None:
+            arrival = array.array('i', [_UNREACHED]) * location_count
+        in_connection = array.array('i', [-1]) * location_count
+        walked_from = array.array('i', [-1]) * location_count
+        boarded_at = array.array('i', [-1]) * len(self.journeys)
+
+        footpaths = self.footpaths
+        for location_id, start in starts:
+            if start < arrival[location_id]:
+                arrival[location_id] = start
+                walked_from[location_id] = -1
+        for location_id, start in starts:
+            for other_id, walk in footpaths[location_id]:
+                if start + walk < arrival[other_id]:
+                    arrival[other_id] = start + walk
+                    walked_from[other_id] = location_id
+
+        departure_times = self.departure_time
+        arrival_times = self.arrival_time
+        departure_locations = self.departure_location
+        arrival_locations = self.arrival_location
+        journey_indices = self.journey_index
+        flags = self.flags
+        first = bisect.bisect_left(departure_times, min([ start for location_id, start in starts ]))
+        last = len(departure_times)
+        if last_departure is not None:
+            last = bisect.bisect_right(departure_times, last_departure)
+        for c in xrange(first, last):
+            departure = departure_times[c]
+            if target >= 0 and arrival[target] <= departure:
+                break
+            journey_index = journey_indices[c]
+            if boarded_at[journey_index] < 0:
+                if not (flags[c] & 1 and arrival[departure_locations[c]] <= departure):
+                    continue
+                boarded_at[journey_index] = c
+            if flags[c] & 2:
+                location_id = arrival_locations[c]
+                arrived = arrival_times[c]
+                if arrived < arrival[location_id]:
+                    arrival[location_id] = arrived
+                    in_connection[location_id] = c
+                    walked_from[location_id] = -1
+                    for other_id, walk in footpaths[location_id]:
+                        if arrived + walk < arrival[other_id]:
+                            arrival[other_id] = arrived + walk
+                            in_connection[other_id] = -1
+                            walked_from[other_id] = location_id
+        return arrival, in_connection, walked_from, boarded_at
+
+    def earliest_arrival(self, origin, destination, departure_time):
+        '''Returns the earliest datetime at which the destination can be
+        reached, leaving the origin at departure_time on the planner's date,
+        or None if it can't be reached. Locations are short codes.'''
+        origin_id = self._location_id(origin)
+        target = self._location_id(destination)
+        if origin_id is None or target is None:
+            return None
+        arrival = self._scan([ (origin_id, _minutes(departure_time)) ], target)[0]
+        if arrival[target] == _UNREACHED:
+            return None
+        return self._datetime(arrival[target])
+
+    def plan(self, origin, destination, departure_time):
+        '''Returns the legs of the route found by earliest_arrival, as a list
+        of (journey, from location, departure datetime, to location, arrival
+        datetime), where journey is None for walks. Returns None if the
+        destination can't be reached.'''
+        origin_id = self._location_id(origin)
+        location_id = self._location_id(destination)
+        if origin_id is None or location_id is None:
+            return None
+        arrival, in_connection, walked_from, boarded_at = self._scan([ (origin_id, _minutes(departure_time)) ], location_id)
+        if arrival[location_id] == _UNREACHED:
+            return None
+        legs = []
+        while location_id != origin_id:
+            if walked_from[location_id] >= 0:
+                from_id = walked_from[location_id]
+                legs.append((None, self.locations[from_id], self._datetime(arrival[from_id]),
+                    self.locations[location_id], self._datetime(arrival[location_id])))
+            else:
+                c = in_connection[location_id]
+                journey_index = self.journey_index[c]
+                boarded = boarded_at[journey_index]
+                from_id = self.departure_location[boarded]
+                legs.append((self.journeys[journey_index], self.locations[from_id], self._datetime(self.departure_time[boarded]),
+                    self.locations[location_id], self._datetime(self.arrival_time[c])))
+            location_id = from_id
+        legs.reverse()
+        return legs
+
+    def travel_times(self, origins, earliest_departure, latest_departure, max_travel_time = None):
+        '''Returns the shortest travel time in minutes to every location, for
+        journeys leaving between earliest_departure and latest_departure, as
+        an array in the same order as planner.locations (look up the index of
+        a short code in planner.location_ids), with -1 for places that can't be
+        reached. origins is a dictionary from short code of each origin stop to
+        the minutes it takes to get to it, so that an isochrone can start from
+        a place rather than a stop. If max_travel_time is given, longer
+        journeys are left out, which makes it quicker.
+
+        It scans once for each time it is worth leaving, latest first, keeping
+        the earliest arrivals from the later scans, as those can still be
+        reached by leaving earlier.
+
+        >>> atco = ATCO()
+        >>> atco.read_string("""ATCO-CIF0510                       70 - RAIL        ATCORAIL20080124115909
+        ... QSNGW    6B1820070521200712071111100  2B02P10452TRAIN           I
+        ... QO9100MDNHEAD 0549URLT1  
+        ... QI9100FURZEP  05530553B   T1  
+        ... QT9100MARLOW  0612   T1  
+        ... QSNGW    6B1A20070521200712071111100  2B04P10456TRAIN           I
+        ... QO9100FURZEP  0600URLT1  
+        ... QT9100BORNEND 0620   T1  
+        ... QLN9100COOKHAM Cookham Rail Station                             RE0057284
+        ... QBN9100COOKHAM 488690  185060                                                  
+        ... QLN9100BORNEND Bourne End Rail Station                          RE0057284
+        ... QBN9100BORNEND 488690  185860                                                  
+        ... """)
+        >>> atco.index_nearby_locations(1000)
+        >>> planner = ConnectionScanPlanner(atco, datetime.date(2007, 5, 21))
+        >>> def show(travel_times):
+        ...     return sorted(zip(planner.locations, travel_times))
+        >>> show(planner.travel_times({ '9100MDNHEAD' : 0 }, datetime.time(5, 30), datetime.time(6, 0)))
+        [('9100BORNEND', 31), ('9100COOKHAM', 41), ('9100FURZEP', 4), ('9100MARLOW', 23), ('9100MDNHEAD', 0)]
+
+        Starting from somewhere five minutes walk from Maidenhead or Furze
+        Platt, it is quicker to walk to Furze Platt for Bourne End.
+        >>> show(planner.travel_times({ '9100MDNHEAD' : 5, '9100FURZEP' : 5 }, datetime.time(5, 30), datetime.time(6, 0), 30))
+        [('9100BORNEND', 25), ('9100COOKHAM', -1), ('9100FURZEP', 5), ('9100MARLOW', 24), ('9100MDNHEAD', 5)]
+        '''
+        earliest = _minutes(earliest_departure)
+        latest = _minutes(latest_departure)
+        starts = {}
+        for location, walk in origins.iteritems():
+            location_id = self._location_id(location)
+            if location_id is not None and walk < starts.get(location_id, _UNREACHED):
+                starts[location_id] = walk
+        travel_times = array.array('i', [_UNREACHED]) * len(self.locations)
+        if not starts:
+            return array.array('i', [-1]) * len(self.locations)
+
+        # leaving any later than just in time for a connection from an origin
+        # is never quicker, so those are the only times worth scanning from
+        # (plus the end of the window, for walking)
+        departures = set([latest])
+        longest_walk = max(starts.values())
+        for c in xrange(bisect.bisect_left(self.departure_time, earliest),
+                bisect.bisect_right(self.departure_time, latest + longest_walk)):
+            walk = starts.get(self.departure_location[c])
+            if walk is not None and self.flags[c] & 1:
+                departure = self.departure_time[c] - walk
+                if earliest <= departure <= latest:
+                    departures.add(departure)
+
+        arrival = None
+        for departure in sorted(departures, reverse = True):
+            last_departure = None
+            if max_travel_time is not None:
+                last_departure = departure + max_travel_time
+            arrival = self._scan([ (location_id, departure + walk) for location_id, walk in starts.iteritems() ],
+                arrival = arrival, last_departure = last_departure)[0]
+            for location_id in xrange(len(arrival)):
+                if arrival[location_id] - departure < travel_times[location_id]:
+                    travel_times[location_id] = arrival[location_id] - departure
+
+        for location_id in xrange(len(travel_times)):
+            if travel_times[location_id] >= _UNREACHED - 2 * 24 * 60 or \
+                    (max_travel_time is not None and travel_times[location_id] > max_travel_time):
+                travel_times[location_id] = -1
+        return travel_times
+
+    def travel_time_matrix(self, origins, destinations, earliest_departure, latest_departure,
+            max_travel_time = None, processes = 1):
+        '''Returns the shortest travel time in minutes from each origin to
+        each destination, as a list with an array for each origin, in the
+        same order as destinations, with -1 where it can't be done. Origins
+        and destinations are dictionaries from stop short codes to the minutes
+        it takes to walk between the place and the stop. The other arguments
+        are as for travel_times.
+
+        If processes is more than one, origins are shared between that many
+        worker processes. The planner is handed to the pool's initializer, so
+        workers forked from here share its memory rather than being sent a
+        copy; only the origins and the rows of the matrix are pickled. The
+        speed, in origins a second, is logged and left in
+        matrix_origins_per_second.
+
+        >>> atco = ATCO()
+        >>> atco.read_string("""ATCO-CIF0510                       70 - RAIL        ATCORAIL20080124115909
+        ... QSNGW    6B1820070521200712071111100  2B02P10452TRAIN           I
+        ... QO9100MDNHEAD 0549URLT1  
+        ... QI9100FURZEP  05530553B   T1  
+        ... QT9100MARLOW  0612   T1  
+        ... QSNGW    6B1A20070521200712071111100  2B04P10456TRAIN           I
+        ... QO9100FURZEP  0600URLT1  
+        ... QT9100BORNEND 0620   T1  
+        ... """)
+        >>> planner = ConnectionScanPlanner(atco, datetime.date(2007, 5, 21))
+        >>> origins = [ { '9100MDNHEAD' : 2 }, { '9100FURZEP' : 0, '9100MDNHEAD' : 10 }, { '9100MARLOW' : 0 } ]
+        >>> destinations = [ { '9100MARLOW' : 0 }, { '9100BORNEND' : 3 } ]
+        >>> matrix = planner.travel_time_matrix(origins, destinations, datetime.time(5, 30), datetime.time(6, 0), processes = 2)
+        >>> [ list(row) for row in matrix ]
+        [[25, 36], [19, 23], [0, -1]]
+        >>> matrix == planner.travel_time_matrix(origins, destinations, datetime.time(5, 30), datetime.time(6, 0))
+        True
+        '''
+        started = time.time()
+        arguments = (destinations, earliest_departure, latest_departure, max_travel_time)
+        if processes <= 1 or len(origins) <= 1:
+            matrix = [ self._travel_time_row(origin, *arguments) for origin in origins ]
+        else:
+            # workers are forked from here, so get these without pickling
+            pool = multiprocessing.Pool(processes, _start_travel_time_worker, (self, arguments))
+            try:
+                chunk_size = max(1, len(origins) // (processes * 4))
+                matrix = [ array.array('i', row) for row in pool.imap(_travel_time_row_in_worker, origins, chunk_size) ]
+            finally:
+                pool.close()
+                pool.join()
+
+        seconds = time.time() - started
+        self.matrix_origins_per_second = len(origins) / max(seconds, 0.000001)
+        logging.info("travel time matrix of %d origins by %d destinations, %.1f origins/sec" %
+            (len(origins), len(destinations), self.matrix_origins_per_second))
+        return matrix
+
+    def _travel_time_row(self, origin, destinations, earliest_departure, latest_departure, max_travel_time):
+        travel_times = self.travel_times(origin, earliest_departure, latest_departure, max_travel_time)
+        row = array.array('i', [-1]) * len(destinations)
+        for i, destination in enumerate(destinations):
+            for location, walk in destination.iteritems():
+                location_id = self._location_id(location)
+                if location_id is None or travel_times[location_id] < 0:
+                    continue
+                minutes = travel_times[location_id] + walk
+                if (row[i] < 0 or minutes < row[i]) and (max_travel_time is None or minutes <= max_travel_time):
+                    row[i] = minutes
+        return row
+
+class LinkGraph(object):
+    '''The network of direct links between stops, made from the journeys in an
+    ATCO object. There is a link from one stop to another wherever a journey
+    picks up at the first and next sets down at the second (stops which it
+    only passes through don't count), and for each link the
+    minimum and median time it takes in minutes, and how many journeys make
+    it. If a date is given, only journeys which run that day are used, so
+    the counts are of services per day. Reachability, connectivity and
+    exports can then use the links, and not every hop of every journey.
+
+    The links are kept in compressed sparse row arrays, indexed by the
+    location ids of atco.location_ids: the links from the stop with id i are
+    at positions link_starts[i] to link_starts[i + 1] of link_to,
+    min_minutes, median_minutes and services. Of an even number of times,
+    the median is the lower of the two middle ones.
+
+    >>> atco = ATCO()
+    >>> atco.read_string("""ATCO-CIF0510                       70 - RAIL        ATCORAIL20080124115909
+    ... QSNGW    6B1820070521200712071111100  2B02P10452TRAIN           I
+    ... QO9100MDNHEAD 0549URLT1  
+    ... QI9100FURZEP  05530553T   T1  
+    ... QT9100MARLOW  0612   T1  
+    ... QSNGW    6B1A20070521200712071111100  2B04P10456TRAIN           I
+    ... QO9100MDNHEAD 0608URLT1  
+    ... QI9100FURZEP  06140614T   T1  
+    ... QT9100BORNEND 0620   T1  
+    ... QSNGW    6B2020070521200712070000011  2B04P10456TRAIN           I
+    ... QO9100MDNHEAD 2355   T1  
+    ... QT9100FURZEP  2402   T1  
+    ... """)
+    >>> graph = LinkGraph(atco)
+    >>> graph.links('9100MDNHEAD')
+    [('9100FURZEP', 4, 6, 3)]
+    >>> graph.links('9100FURZEP'), graph.links('9100MARLOW')
+    ([('9100MARLOW', 19, 19, 1), ('9100BORNEND', 6, 6, 1)], [])
+    >>> sorted(graph.reachable('9100MDNHEAD').items())
+    [('9100BORNEND', 2), ('9100FURZEP', 1), ('9100MARLOW', 2), ('9100MDNHEAD', 0)]
+    >>> sorted(graph.reachable('9100MDNHEAD', max_links = 1))
+    ['9100FURZEP', '9100MDNHEAD']
+    >>> sorted(graph.statistics().items())
+    [('average_links_per_stop', 0.75), ('component_count', 1), ('largest_component_size', 4), ('link_count', 3), ('stop_count', 4)]
+
+    Journeys which don't run on a date are left out.
+    >>> LinkGraph(atco, datetime.date(2007, 5, 26)).links('9100MDNHEAD')
+    [('9100FURZEP', 7, 7, 1)]
+
+    The links can be written out as CSV, with grid references where the
+    locations are known.
+    >>> import sys
+    >>> graph.export_csv(sys.stdout)
+    from,to,min_minutes,median_minutes,services,from_easting,from_northing,to_easting,to_northing
+    9100MDNHEAD,9100FURZEP,4,6,3,,,,
+    9100FURZEP,9100MARLOW,19,19,1,,,,
+    9100FURZEP,9100BORNEND,6,6,1,,,,
+
+    Stops which a journey only passes through aren't linked to or from.
+    >>> atco = ATCO()
+    >>> atco.read_string("""ATCO-CIF0510                       70 - RAIL        ATCORAIL20080124115909
+    ... QSNGW    6B2220070521200712071111100  2B04P10456TRAIN           I
+    ... QO9100MDNHEAD 0608URLT1  
+    ... QI9100FURZEP  06120612B   T1  
+    ... QI9100COOKHAM 00000000O   T1  
+    ... QT9100BORNEND 0620   T1  
+    ... """)
+    >>> graph = LinkGraph(atco)
+    >>> graph.links('9100FURZEP'), graph.links('9100COOKHAM')
+    ([('9100BORNEND', 8, 8, 1)], [])
+    '''
+
+    def __init__(self, atco, d = None):
+        self.location_ids = atco.location_ids
+        self.location_from_id = getattr(atco, 'location_from_id', None)
+        add_location = self.location_ids.add
+
+        # Each time a journey goes from a stop where it picks up to the next
+        # where it sets down is packed into one number, so that sorting them
+        # gathers the times of each link together, in order.
+        traversals = []
+        for journey in atco.journeys:
+            if d is not None and not journey.runs_on_date(d):
+                continue
+            picked_up = [] # location ids and departures waiting for a stop to set down at
+            for hop in journey.hops:
+                set_down = hop.is_set_down()
+                pick_up = hop.is_pick_up()
+                if not set_down and not pick_up:
+                    continue # passing through, with no times
+                activity, arrival, departure, flags, bay_number = _hop_columns(hop)
+                location_id = add_location(hop.location)
+                if set_down and picked_up:
+                    if arrival == _NO_TIME:
+                        arrival = departure
+                    for previous_id, previous_departure in picked_up:
+                        minutes = (arrival - previous_departure) % (24 * 60)
+                        traversals.append((previous_id << 32 | location_id) << 11 | minutes)
+                    picked_up = []
+                if pick_up:
+                    if departure == _NO_TIME:
+                        departure = arrival
+                    picked_up.append((location_id, departure))
+        traversals.sort()
+
+        location_count = len(self.location_ids.codes)
+        self.link_starts = array.array('i', [0] * (location_count + 1))
+        self.link_to = array.array('i')
+        self.min_minutes = array.array('H')
+        self.median_minutes = array.array('H')
+        self.services = array.array('i')
+        start = 0
+        while start < len(traversals):
+            link = traversals[start] >> 11
+            end = start + 1
+            while end < len(traversals) and traversals[end] >> 11 == link:
+                end += 1
+            self.link_starts[(link >> 32) + 1] += 1
+            self.link_to.append(link & 0xFFFFFFFF)
+            self.min_minutes.append(traversals[start] & 0x7FF)
+            self.median_minutes.append(traversals[(start + end - 1) // 2] & 0x7FF)
+            self.services.append(end - start)
+            start = end
+        for location_id in xrange(location_count):
+            self.link_starts[location_id + 1] += self.link_starts[location_id]
+
+    def _location_id(self, location):
+        '''Returns the id of a short code, or None if there are no links from it.'''
+        location_id = self.location_ids.get(location)
+        if location_id is None or location_id + 1 >= len(self.link_starts):
+            return None
+        return location_id
+
+    def links(self, location):
+        '''Given a location (as a string short code), returns a list of the stops
+        it has links to, as (short code, minimum minutes, median minutes,
+        services).'''
+        location_id = self._location_id(location)
+        if location_id is None:
+            return []
+        codes = self.location_ids.codes
+        return [ (codes[self.link_to[link]], self.min_minutes[link], self.median_minutes[link], self.services[link])
+            for link in xrange(self.link_starts[location_id], self.link_starts[location_id + 1]) ]
+
+    def reachable(self, origin, max_links = None):
+        '''Returns a dictionary from the short code of each stop which can be
+        reached from the origin by following links, to the fewest links it
+        takes, as a breadth first search. This doesn't take account of times,
+        so changes between journeys can take any length of time.'''
+        origin_id = self._location_id(origin)
+        if origin_id is None:
+            return { origin : 0 }
+        links_away = { origin_id : 0 }
+        queue = collections.deque([ origin_id ])
+        link_starts, link_to = self.link_starts, self.link_to
+        while queue:
+            location_id = queue.popleft()
+            distance = links_away[location_id] + 1
+            if max_links is not None and distance > max_links:
+                continue
+            for link in xrange(link_starts[location_id], link_starts[location_id + 1]):
+                to_id = link_to[link]
+                if to_id not in links_away:
+                    links_away[to_id] = distance
+                    queue.append(to_id)
+        codes = self.location_ids.codes
+        return dict([ (codes[location_id], distance) for location_id, distance in links_away.iteritems() ])
+
+    def statistics(self):
+        '''Returns a dictionary of statistics about the network: how many stops
+        have links to or from them, how many links there are, the average
+        number of links from each of those stops, and how many separate
+        groups of stops there are, ignoring the direction of links, with the
+        size of the largest.'''
+        # union find to group the stops connected in either direction
+        parent = {}
+        def find(location_id):
+            root = location_id
+            while parent[root] != root:
+                root = parent[root]
+            while parent[location_id] != root:
+                parent[location_id], location_id = root, parent[location_id]
+            return root
+        for from_id in xrange(len(self.link_starts) - 1):
+            for link in xrange(self.link_starts[from_id], self.link_starts[from_id + 1]):
+                to_id = self.link_to[link]
+                parent.setdefault(from_id, from_id)
+                parent.setdefault(to_id, to_id)
+                parent[find(from_id)] = find(to_id)
+        component_sizes = {}
+        for location_id in parent:
+            root = find(location_id)
+            component_sizes[root] = component_sizes.get(root, 0) + 1
+
+        stats = {}
+        stats['stop_count'] = len(parent)
+        stats['link_count'] = len(self.link_to)
+        stats['average_links_per_stop'] = parent and float(len(self.link_to)) / len(parent) or 0.0
+        stats['component_count'] = len(component_sizes)
+        stats['largest_component_size'] = max(component_sizes.values() or [0])
+        return stats
+
+    def export_csv(self, h):
+        '''Writes the links to the file handle h as CSV, one per row, with the
+        grid references of the stops where their locations have been loaded
+        and indexed.'''
+        writer = csv.writer(h, lineterminator = '\n')
+        writer.writerow(['from', 'to', 'min_minutes', 'median_minutes', 'services',
+            'from_easting', 'from_northing', 'to_easting', 'to_northing'])
+        codes = self.location_ids.codes
+        for from_id in xrange(len(self.link_starts) - 1):
+            for link in xrange(self.link_starts[from_id], self.link_starts[from_id + 1]):
+                from_code, to_code = codes[from_id], codes[self.link_to[link]]
+                writer.writerow([ from_code, to_code, self.min_minutes[link], self.median_minutes[link], self.services[link] ]
+                    + self._grid_reference(from_code) + self._grid_reference(to_code))
+
+    def _grid_reference(self, code):
+        location = self.location_from_id is not None and self.location_from_id.get(code)
+        if location and location.additional is not None:
+            return [ location.additional.grid_reference_easting, location.additional.grid_reference_northing ]
+        return ['', '']
+
+# Set in each worker process of a travel_time_matrix pool when it starts.
+_matrix_planner = None
+_matrix_arguments = None
+
+def _start_travel_time_worker(planner, arguments):
+    global _matrix_planner, _matrix_arguments
+    _matrix_planner = planner
+    _matrix_arguments = arguments
+
+def _travel_time_row_in_worker(origin):
+    return _matrix_planner._travel_time_row(origin, *_matrix_arguments).tolist()
+
+###########################################################
+# Statistics while loading
+
+class LoadStatistics(object):
+    '''Counts what an ATCO object loads as each item goes through item_loaded,
+    so that a summary is ready as soon as loading finishes, without another
+    pass over the data or any of the indexes which ATCO.statistics needs.
+    Made by ATCO(collect_statistics = True).
+
+    Counted are the records kept of each type, the journeys of each operator
+    and vehicle code, the number of hops of each journey, and the distinct
+    pairs of stops which journeys go straight between. The last is estimated
+    with a HyperLogLog sketch, so it takes a fixed, small amount of memory
+    however many there are. The hops of journeys loaded by read_lazily are
+    not parsed, so they are only counted as lazily_loaded_journeys.
+
+    >>> atco = ATCO(collect_statistics = True)
+    >>> atco.read_string("""ATCO-CIF0510                       70 - RAIL        ATCORAIL20080124115909
+    ... QSNGW    6B1820070521200712071111100  2B02P10452TRAIN           I
+    ... QO9100MDNHEAD 0549URLT1  
+    ... QI9100FURZEP  05530553T   T1  
+    ... QT9100MARLOW  0612   T1  
+    ... QSNGW    6B1A20070521200712071111100  2B04P10456TRAIN           I
+    ... QE20071225200712250
+    ... QO9100MDNHEAD 0608URLT1  
+    ... QT9100FURZEP  0614   T1  
+    ... QLN9100MARLOW  Marlow Rail Station                              RE0057285
+    ... QBN9100MARLOW  485100  186500                                                  
+    ... QVNTRAIN   Heavy Rail              
+    ... """)
+    >>> summary = atco.load_statistics.summary()
+    >>> sorted(summary['records_by_type'].items())
+    [('QB', 1), ('QE', 1), ('QI', 1), ('QL', 1), ('QO', 2), ('QS', 2), ('QT', 2), ('QV', 1)]
+    >>> summary['journeys_by_operator'], summary['journeys_by_vehicle_code']
+    ({'GW': 2}, {'T': 2})
+    >>> sorted(summary['hops_per_journey'].items())
+    [('max', 3), ('mean', 2.5), ('median', 2), ('min', 2)]
+    >>> summary['distinct_stop_pairs']
+    2
+    '''
+
+    def __init__(self, vehicle_type_to_code = None):
+        # as in ATCO, by file_loading_number, as that is needed to find codes
+        if vehicle_type_to_code is None:
+            vehicle_type_to_code = {}
+        self.vehicle_type_to_code = vehicle_type_to_code
+        self.records_by_type = {}
+        self.journeys_by_operator = {}
+        # by (file_loading_number, vehicle_type), as vehicle type records
+        # can come after the journeys which use them
+        self.journeys_by_vehicle_type = {}
+        self.journeys_by_hop_count = {}
+        self.lazily_loaded_journeys = 0
+        self.stop_pairs = HyperLogLog()
+        self._location_hashes = {}
+        self._stop_sequences_seen = set() # by hash, which is plenty for an estimate
+
+    def item_loaded(self, item):
+        '''Adds one JourneyHeader, Location or VehicleType to the counts.'''
+        records_by_type = self.records_by_type
+        if isinstance(item, JourneyHeader):
+            records_by_type['QS'] = records_by_type.get('QS', 0) + 1
+            if item.date_running_exceptions:
+                records_by_type['QE'] = records_by_type.get('QE', 0) + len(item.date_running_exceptions)
+            self.journeys_by_operator[item.operator] = self.journeys_by_operator.get(item.operator, 0) + 1
+            vehicle_type = (item.file_loading_number, item.vehicle_type)
+            self.journeys_by_vehicle_type[vehicle_type] = self.journeys_by_vehicle_type.get(vehicle_type, 0) + 1
+            if 'lazy_hops' in item.__dict__:
+                self.lazily_loaded_journeys += 1
+                return
+            self._hops_loaded(item.hops)
+        elif isinstance(item, Location):
+            records_by_type['QL'] = records_by_type.get('QL', 0) + 1
+            if item.additional is not None:
+                records_by_type['QB'] = records_by_type.get('QB', 0) + 1
+        elif isinstance(item, VehicleType):
+            records_by_type['QV'] = records_by_type.get('QV', 0) + 1
+        else:
+            assert False
+
+    def _hops_loaded(self, hops):
+        records_by_type = self.records_by_type
+        self.journeys_by_hop_count[len(hops)] = self.journeys_by_hop_count.get(len(hops), 0) + 1
+        record_identities = [ hop.record_identity for hop in hops ]
+        for record_identity in ('QO', 'QI', 'QT'):
+            count = record_identities.count(record_identity)
+            if count:
+                records_by_type[record_identity] = records_by_type.get(record_identity, 0) + count
+
+        # Most journeys follow a sequence of stops that an earlier one did,
+        # whose pairs are already in the sketch
+        locations = tuple([ hop.location for hop in hops ])
+        if hash(locations) in self._stop_sequences_seen:
+            return
+        self._stop_sequences_seen.add(hash(locations))
+        location_hashes = self._location_hashes
+        add_hash = self.stop_pairs.add_hash
+        previous_hash = None
+        for location in locations:
+            location_hash = location_hashes.get(location)
+            if location_hash is None:
+                location_hash = location_hashes[location] = _hash64(location)
+            if previous_hash is not None:
+                # mixing the two hashes is much quicker than hashing the codes again
+                add_hash(_mix64(previous_hash ^ ((location_hash * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF)))
+            previous_hash = location_hash
+
+    def journeys_by_vehicle_code(self):
+        '''Returns a dictionary from the single character vehicle code (see
+        JourneyHeader.vehicle_code) to the number of journeys using it.
+        Journeys whose vehicle type had no QV record are under None.'''
+        ret = {}
+        for (file_loading_number, vehicle_type), count in self.journeys_by_vehicle_type.iteritems():
+            code = self.vehicle_type_to_code.get(file_loading_number, {}).get(vehicle_type)
+            ret[code] = ret.get(code, 0) + count
+        return ret
+
+    def hops_per_journey(self):
+        '''Returns the minimum, maximum, mean and median number of hops of a
+        journey, as a dictionary. Of an even number of journeys, the median is
+        the lower of the two middle ones.'''
+        counts = sorted(self.journeys_by_hop_count.iteritems())
+        journeys = sum(count for hops, count in counts)
+        if journeys == 0:
+            return { 'min' : None, 'max' : None, 'mean' : None, 'median' : None }
+        middle = (journeys - 1) // 2
+        seen = 0
+        for hops, count in counts:
+            seen += count
+            if seen > middle:
+                median = hops
+                break
+        return { 'min' : counts[0][0], 'max' : counts[-1][0],
+                 'mean' : float(sum(hops * count for hops, count in counts)) / journeys,
+                 'median' : median }
+
+    def summary(self):
+        '''Returns all the counts as a dictionary.'''
+        return { 'records_by_type' : dict(self.records_by_type),
+                 'journey_count' : self.records_by_type.get('QS', 0),
+                 'location_count' : self.records_by_type.get('QL', 0),
+                 'journeys_by_operator' : dict(self.journeys_by_operator),
+                 'journeys_by_vehicle_code' : self.journeys_by_vehicle_code(),
+                 'hops_per_journey' : self.hops_per_journey(),
+                 'distinct_stop_pairs' : self.stop_pairs.count(),
+                 'lazily_loaded_journeys' : self.lazily_loaded_journeys }
+
+class HyperLogLog(object):
+    '''Estimates how many distinct values have been added, using 2 ** precision
+    bytes however many there are. With the default precision of 14, the
+    estimate is typically within 1% (the standard error is 1.04 / sqrt(2 **
+    precision)). Small counts are exact or nearly so.
+
+    >>> sketch = HyperLogLog()
+    >>> for n in xrange(100000):
+    ...     sketch.add(str(n % 50000))
+    >>> abs(sketch.count() - 50000) < 1000
+    True
+    >>> other = HyperLogLog()
+    >>> for n in xrange(25000, 75000):
+    ...     other.add(str(n))
+    >>> sketch.merge(other)
+    >>> abs(sketch.count() - 75000) < 1500
+    True
+    '''
+
+    def __init__(self, precision = 14):
+        if not 4 <= precision <= 18:
+            raise Exception("HyperLogLog precision must be from 4 to 18, not " + str(precision))
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value):
+        '''Adds a string.'''
+        self.add_hash(_hash64(value))
+
+    def add_hash(self, value_hash):
+        '''Adds a value by its well mixed 64 bit hash.'''
+        precision = self.precision
+        index = value_hash >> (64 - precision)
+        rest = (value_hash << precision) & 0xFFFFFFFFFFFFFFFF
+        # position of the first 1 bit of the rest of the hash
+        rank = 65 - rest.bit_length() if rest else 65 - precision
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        '''Adds everything which has been added to another HyperLogLog of the
+        same precision, e.g. one filled in a different process.'''
+        if other.precision != self.precision:
+            raise Exception("Can't merge HyperLogLogs of different precisions " + str(self.precision) + " and " + str(other.precision))
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+
+    def count(self):
+        '''Returns the estimated number of distinct values added.'''
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -rank for rank in self.registers)
+        zeros = self.registers.count("\0")
+        if estimate <= 2.5 * m and zeros:
+            # linear counting is better for small numbers
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+def _hash64(s):
+    return struct.unpack('<Q', hashlib.md5(s).digest()[:8])[0]
+
+def _mix64(x):
+    # the finaliser of splitmix64, spreading every bit of x over the result
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    return x ^ (x >> 31)
+
+class LoadProfile(object):
+    '''Where the time goes while loading ATCO-CIF files, made by
+    ATCO.register_load_profile. For each type of record, it has how many
+    there were, and the seconds spent parsing their lines into records and,
+    for hops, date running exceptions and additional location records,
+    adding them to their journey or location (which is where duplicate hops
+    and inconsistent date ranges are checked for). It also has the seconds
+    spent reading lines (including decompression, lines of journeys rejected
+    by journey_filter, and the overhead of measuring), in callbacks (item_loaded, or whatever
+    else uses the items as they are loaded, and the filters), and in total.
+
+    >>> profile = LoadProfile()
+    >>> profile.start_file()
+    >>> profile.record_parsed('QO', 1.0, 1.5, 2.0, 0.25)
+    >>> profile.bytes, profile.lines = 1000, 20
+    >>> profile.finish_file()
+    >>> profile.records_by_type, profile.parse_seconds_by_type, profile.add_seconds_by_type
+    ({'QO': 1}, {'QO': 0.25}, {'QO': 0.5})
+    >>> profile.seconds = 2.0
+    >>> report = profile.report()
+    >>> report['bytes_per_second'], report['lines_per_second'], report['files']
+    (500.0, 10.0, 1)
+    '''
+
+    def __init__(self):
+        self.records_by_type = {}
+        self.parse_seconds_by_type = {}
+        self.add_seconds_by_type = {}
+        self.read_seconds = 0.0
+        self.callback_seconds = 0.0
+        self.seconds = 0.0
+        self.lines = 0
+        self.bytes = 0
+        self.files = 0
+        self.callback = None
+        self.interval = None
+        self.ticked = None
+        self.next_callback = None
+
+    def start_file(self, callback = None, interval = None):
+        self.files += 1
+        self.callback = callback
+        self.interval = interval
+        self.ticked = time.time()
+        if callback is not None:
+            self.next_callback = self.ticked + interval
+
+    def record_parsed(self, record_identity, started, parsed, finished, callback_seconds):
+        '''Adds one record, which took from started until finished, minus
+        callback_seconds spent in callbacks meanwhile. If parsed is not None,
+        the time after it was spent adding the record to its item.'''
+        self.lines += 1
+        self.records_by_type[record_identity] = self.records_by_type.get(record_identity, 0) + 1
+        if parsed is None:
+            parsed = finished
+        else:
+            self.add_seconds_by_type[record_identity] = self.add_seconds_by_type.get(record_identity, 0.0) + finished - parsed
+        self.parse_seconds_by_type[record_identity] = self.parse_seconds_by_type.get(record_identity, 0.0) + parsed - started - callback_seconds
+
+    def progress(self):
+        '''Updates the total time, and calls the callback if it is due.'''
+        now = time.time()
+        self.seconds += now - self.ticked
+        self.ticked = now
+        if self.callback is not None and now >= self.next_callback:
+            self.next_callback = now + self.interval
+            self.callback(self)
+
+    def finish_file(self):
+        self.progress()
+        if self.callback is not None:
+            if self.next_callback != self.ticked + self.interval:
+                self.callback(self) # the final figures, unless just called
+            self.callback = None
+
+    def time_callbacks(self, items):
+        '''Generator yielding items, adding the time spent by whatever uses
+        each to callback_seconds.'''
+        for item in items:
+            started = time.time()
+            yield item
+            self.callback_seconds += time.time() - started
+
+    def timed_callback(self, function):
+        '''Returns a function which calls function, adding the time it takes
+        to callback_seconds.'''
+        def timed(*args):
+            started = time.time()
+            try:
+                return function(*args)
+            finally:
+                self.callback_seconds += time.time() - started
+        return timed
+
+    def report(self):
+        '''Returns the measurements as a dictionary.'''
+        parse_seconds = sum(self.parse_seconds_by_type.itervalues())
+        add_seconds = sum(self.add_seconds_by_type.itervalues())
+        return { 'records_by_type' : dict(self.records_by_type),
+                 'parse_seconds_by_type' : dict(self.parse_seconds_by_type),
+                 'add_seconds_by_type' : dict(self.add_seconds_by_type),
+                 'read_seconds' : self.read_seconds,
+                 'parse_seconds' : parse_seconds,
+                 'add_seconds' : add_seconds,
+                 'callback_seconds' : self.callback_seconds,
+                 'seconds' : self.seconds,
+                 'files' : self.files,
+                 'lines' : self.lines,
+                 'bytes' : self.bytes,
+                 'lines_per_second' : self.seconds and self.lines / self.seconds,
+                 'bytes_per_second' : self.seconds and self.bytes / self.seconds }
+
+###########################################################
+# Quarantine of records which can't be loaded
+
+class Quarantine(object):
+    '''Where records go which can't be loaded, made by ATCO.register_quarantine,
+    so that loading can carry on without them. Each rejection is written to
+    the file handle h as a comment line giving the file loading number, line
+    number and reason, followed by the line number and text of each record
+    rejected, separated by a space. The records are counted by type, and the
+    rejections by reason, ignoring anything after the first colon or comma of
+    the exception's message, which is usually the line itself.
+
+    >>> h = StringIO.StringIO()
+    >>> quarantine = Quarantine(h)
+    >>> quarantine.reject(1, 3, Exception("Journey origin line incorrectly formatted: QO9100"), [ (2, "QSN"), (3, "QO9100") ], 'QS')
+    >>> quarantine.add_record(4, "QT9100")
+    >>> print h.getvalue(),
+    # file 1, line 3: Exception: Journey origin line incorrectly formatted: QO9100
+    2 QSN
+    3 QO9100
+    4 QT9100
+    >>> summary = quarantine.summary()
+    >>> summary['reasons'], summary['rejected_journeys'], summary['rejected_records']
+    ({'Exception: Journey origin line incorrectly formatted': 1}, 1, 3)
+    '''
+
+    def __init__(self, h):
+        self.h = h
+        self.records_by_type = {}
+        self.items_by_type = {} # by the record identity of the item's first record
+        self.reasons = {}
+
+    def reject(self, file_loading_number, line_number, exception, lines, item_record_identity):
+        '''Puts the records in lines, a list of line numbers and lines, in
+        quarantine, because of exception raised reading line line_number. If
+        they are an item, item_record_identity is that of its first record.'''
+        reason = exception.__class__.__name__
+        if str(exception):
+            reason += ": " + str(exception)
+        self.h.write("# file %d, line %d: %s\n" % (file_loading_number, line_number, reason))
+        reason = re.split('[:,]', reason, 2)
+        reason = reason[0] + (len(reason) > 1 and ":" + reason[1] or "")
+        self.reasons[reason] = self.reasons.get(reason, 0) + 1
+        if item_record_identity is not None:
+            self.items_by_type[item_record_identity] = self.items_by_type.get(item_record_identity, 0) + 1
+        for line_number, line in lines:
+            self.add_record(line_number, line)
+
+    def add_record(self, line_number, line):
+        '''Puts one more record of the last item rejected in quarantine.'''
+        self.h.write("%d %s\n" % (line_number, line))
+        self.records_by_type[line[0:2]] = self.records_by_type.get(line[0:2], 0) + 1
+
+    def summary(self):
+        '''Returns the numbers of records, journeys, locations and vehicle
+        types put in quarantine, and of rejections for each reason, as a
+        dictionary.'''
+        return { 'rejected_records' : sum(self.records_by_type.itervalues()),
+                 'rejected_records_by_type' : dict(self.records_by_type),
+                 'rejected_journeys' : self.items_by_type.get('QS', 0),
+                 'rejected_locations' : self.items_by_type.get('QL', 0),
+                 'rejected_vehicle_types' : self.items_by_type.get('QV', 0),
+                 'reasons' : dict(self.reasons) }
+
+###########################################################
+# Bulk decoding into NumPy arrays
+
+class CIFArrays(object):
+    '''Records of ATCO-CIF files decoded into NumPy structured arrays, made by
+    ATCO.read_arrays. There is an array for each kind of record - journeys
+    (QS), date_running_exceptions (QE), hops (QO, QI and QT together),
+    locations (QL), location_additionals (QB) and vehicle_types (QV) - with
+    a field for each attribute that the record class has.
+
+    Times are in minutes past midnight, with _NO_TIME (65535) where a hop
+    has no arrival or departure time. Dates are day numbers, as from
+    datetime.date.toordinal. operates_on_day_of_week is a bit mask, Monday
+    in the lowest bit. Flags are small integers, with -1 for a fare stage
+    indicator that isn't given and for a missing grid reference. Other
+    fields are strings, converted as the record classes do.
+
+    Hops and date running exceptions have a journey field, the index in
+    journeys of the journey they belong to. The hops of each journey are
+    together, in order; hops_of returns them. Hops also have their
+    record_identity, and an activity_flag of '<' and '>' for origins and
+    destinations, as for HopStore. Journeys have the number of the file,
+    from 1, which they came from.
+    '''
+
+    _kinds = ( ('journeys', ('QS',)), ('date_running_exceptions', ('QE',)), ('hops', ('QO', 'QI', 'QT')),
+        ('locations', ('QL',)), ('location_additionals', ('QB',)), ('vehicle_types', ('QV',)) )
+
+    def __init__(self, journeys, date_running_exceptions, hops, locations, location_additionals, vehicle_types):
+        self.journeys = journeys
+        self.date_running_exceptions = date_running_exceptions
+        self.hops = hops
+        self.locations = locations
+        self.location_additionals = location_additionals
+        self.vehicle_types = vehicle_types
+        # hops of journey j are hops[hop_starts[j]:hop_starts[j + 1]]
+        self.hop_starts = numpy.searchsorted(hops['journey'], numpy.arange(len(journeys) + 1))
+
+    def hops_of(self, journey):
+        '''Returns the hops of the journey with that index in journeys.'''
+        return self.hops[self.hop_starts[journey]:self.hop_starts[journey + 1]]
+
+    @staticmethod
+    def decode(data, locations_to_ignore = ()):
+        '''Decodes the contents of one ATCO-CIF file.'''
+        buffer = numpy.frombuffer(data, numpy.uint8)
+        line_ends = numpy.flatnonzero(buffer == ord("\n"))
+        if len(buffer) and buffer[-1] != ord("\n"):
+            line_ends = numpy.append(line_ends, len(buffer))
+        line_starts = numpy.concatenate(([0], line_ends[:-1] + 1)).astype(numpy.intp)
+        # leave out carriage returns, and pad with a space so short lines can be read
+        carriage_returns = (line_ends > line_starts) & (buffer[numpy.maximum(line_ends - 1, 0)] == ord("\r"))
+        line_ends = line_ends - carriage_returns
+        buffer = numpy.append(buffer, numpy.uint8(ord(" ")))
+
+        # lines are classified by the two bytes of their record identity
+        identities = numpy.where(line_ends - line_starts >= 2,
+            buffer[line_starts].astype(numpy.int32) << 8 | buffer[numpy.minimum(line_starts + 1, len(buffer) - 1)], 0)
+        journey_lines = numpy.flatnonzero(identities == _identity_number('QS'))
+
+        arrays = {}
+        for name, record_identities in CIFArrays._kinds:
+            lines = numpy.flatnonzero(numpy.in1d(identities, [ _identity_number(identity) for identity in record_identities ]))
+            columns = collections.OrderedDict() # fields in the order of the layouts
+            for record_identity in record_identities:
+                record_class = _ARRAY_RECORD_CLASSES[record_identity]
+                selected = identities[lines] == _identity_number(record_identity)
+                selected_lines = lines[selected]
+                reader = _ColumnReader(buffer, line_starts[selected_lines], line_ends[selected_lines], data, record_class)
+                if len(record_identities) > 1:
+                    _array_column(columns, 'record_identity', len(lines), 'S2')[selected] = record_identity
+                for field_name, start, end, converter in record_class.layout.fields:
+                    values = reader.decode(field_name, start, end, converter)
+                    column = _array_column(columns, field_name, len(lines), values.dtype)
+                    column[selected] = values
+                if record_identity in _ACTIVITY_FROM_RECORD_IDENTITY:
+                    _array_column(columns, 'activity_flag', len(lines), 'S1')[selected] = _ACTIVITY_FROM_RECORD_IDENTITY[record_identity]
+            if name == 'hops':
+                for field_name in ('published_arrival_time', 'published_departure_time'):
+                    _array_column(columns, field_name, len(lines), numpy.uint16)
+            if record_identities[0] in ('QE', 'QO'):
+                # the journey is the last one started before the line
+                columns['journey'] = (numpy.searchsorted(journey_lines, lines) - 1).astype(numpy.int32)
+            if name == 'journeys':
+                columns['file'] = numpy.ones(len(lines), numpy.int32)
+            array = _structured_array(columns, len(lines))
+            if locations_to_ignore and 'location' in columns:
+                array = array[~numpy.in1d(array['location'], list(locations_to_ignore))]
+            arrays[name] = array
+        return CIFArrays(**arrays)
+
+    @staticmethod
+    def concatenate(arrays):
+        '''Joins the arrays from several files together, renumbering the journey
+        and file fields to follow on.'''
+        if len(arrays) == 1:
+            return arrays[0]
+        joined = {}
+        for name, record_identities in CIFArrays._kinds:
+            parts = []
+            journey_offset = 0
+            for file_number, file_arrays in enumerate(arrays):
+                part = getattr(file_arrays, name).copy()
+                if 'journey' in part.dtype.names:
+                    part['journey'] += journey_offset
+                if 'file' in part.dtype.names:
+                    part['file'] = file_number + 1
+                journey_offset += len(file_arrays.journeys)
+                parts.append(part)
+            # strings may be of different widths in each file
+            dtype = numpy.dtype([ (field_name, _widest([ part.dtype[field_name] for part in parts ]))
+                for field_name in parts[0].dtype.names ])
+            joined[name] = numpy.concatenate([ part.astype(dtype) for part in parts ])
+        return CIFArrays(**joined)
+
+# The record classes whose layouts CIFArrays decodes, by record identity
+_ARRAY_RECORD_CLASSES = { 'QS' : JourneyHeader, 'QE' : JourneyDateRunning, 'QO' : JourneyOrigin,
+    'QI' : JourneyIntermediate, 'QT' : JourneyDestination, 'QL' : Location, 'QB' : LocationAdditional,
+    'QV' : VehicleType }
+
+def _identity_number(record_identity):
+    return ord(record_identity[0]) << 8 | ord(record_identity[1])
+
+def _array_column(columns, field_name, length, dtype):
+    if field_name not in columns:
+        if dtype == numpy.uint16:
+            columns[field_name] = numpy.empty(length, dtype)
+            columns[field_name].fill(_NO_TIME)
+        else:
+            columns[field_name] = numpy.zeros(length, dtype)
+    column = columns[field_name]
+    if column.dtype.kind == 'S' and numpy.dtype(dtype).itemsize > column.dtype.itemsize:
+        column = columns[field_name] = column.astype(dtype)
+    return column
+
+def _structured_array(columns, length):
+    names = [ name for name in _ARRAY_FIELD_ORDER if name in columns ]
+    names += [ name for name in columns if name not in _ARRAY_FIELD_ORDER ]
+    array = numpy.zeros(length, [ (name, columns[name].dtype) for name in names ])
+    for name in names:
+        array[name] = columns[name]
+    return array
+
+_ARRAY_FIELD_ORDER = ('journey', 'file', 'record_identity')
+
+def _widest(dtypes):
+    return max(dtypes, key = lambda dtype: dtype.itemsize)
+
+class _ColumnReader(object):
+    '''Decodes fixed-width columns from lines of one record type in a buffer.'''
+
+    def __init__(self, buffer, line_starts, line_ends, data, record_class):
+        self.buffer = buffer
+        self.line_starts = line_starts
+        self.line_ends = line_ends
+        self.data = data
+        self.record_class = record_class
+
+    def bytes(self, start, end):
+        '''Returns the bytes of a column as a two dimensional array, with spaces
+        past the end of short lines.'''
+        offsets = self.line_starts[:, None] + numpy.arange(start, end)
+        past_end = offsets >= self.line_ends[:, None]
+        offsets[past_end] = len(self.buffer) - 1
+        return self.buffer[offsets]
+
+    def digits(self, field_bytes, allow_blank = False):
+        digits = field_bytes.astype(numpy.int32) - ord('0')
+        bad = ((digits < 0) | (digits > 9)).any(axis = 1)
+        if allow_blank:
+            bad &= ~(field_bytes == ord(' ')).all(axis = 1)
+        self.check(bad)
+        return digits
+
+    def check(self, bad):
+        bad = numpy.flatnonzero(bad)
+        if len(bad):
+            line = self.data[self.line_starts[bad[0]]:self.line_ends[bad[0]]]
+            raise Exception("%s line incorrectly formatted: %s" % (self.record_class.__name__, line))
+
+    def decode(self, field_name, start, end, converter):
+        kind = _ARRAY_FIELD_KINDS.get(field_name)
+        field_bytes = self.bytes(start, end)
+        if kind == 'time':
+            digits = self.digits(field_bytes)
+            hours = digits[:, 0] * 10 + digits[:, 1]
+            minutes = digits[:, 2] * 10 + digits[:, 3]
+            self.check((hours >= 28) | (minutes >= 60))
+            # 24 to 27 wrap round to 0, as in parse_time
+            return ((hours % 24) * 60 + minutes).astype(numpy.uint16)
+        elif kind == 'date':
+            # blank or 99999999 mean the end of time, as in parse_date
+            end_of_time = (field_bytes == ord(' ')).all(axis = 1) | (field_bytes == ord('9')).all(axis = 1)
+            digits = self.digits(field_bytes, allow_blank = True)
+            digits[end_of_time] = numpy.array([ int(digit) for digit in '99991231' ])
+            years = numpy.dot(digits[:, 0:4], [1000, 100, 10, 1])
+            months = digits[:, 4] * 10 + digits[:, 5]
+            days = digits[:, 6] * 10 + digits[:, 7]
+            self.check((years < 1) | (months < 1) | (months > 12) | (days < 1) | (days > 31))
+            dates = (years - 1970).astype('M8[Y]').astype('M8[M]') + (months - 1) # count from 1970
+            dates = dates.astype('M8[D]') + (days - 1)
+            return (dates.astype(numpy.int64) + datetime.date(1970, 1, 1).toordinal()).astype(numpy.int32)
+        elif kind == 'days_of_week':
+            digits = self.digits(field_bytes)
+            self.check((digits > 1).any(axis = 1))
+            return numpy.dot(digits, 1 << numpy.arange(7)).astype(numpy.uint8)
+        elif kind == 'flag':
+            self.check(~numpy.in1d(field_bytes[:, 0], [ord('0'), ord('1')]))
+            return (field_bytes[:, 0] - ord('0')).astype(numpy.uint8)
+        elif kind == 'timing_point':
+            self.check((field_bytes[:, 0] != ord('T')) | ~numpy.in1d(field_bytes[:, 1], [ord('0'), ord('1')]))
+            return (field_bytes[:, 1] - ord('0')).astype(numpy.uint8)
+        elif kind == 'fare_stage':
+            blank = (field_bytes == ord(' ')).all(axis = 1)
+            self.check(~blank & ((field_bytes[:, 0] != ord('F')) | ~numpy.in1d(field_bytes[:, 1], [ord('0'), ord('1')])))
+            return numpy.where(blank, -1, field_bytes[:, 1].astype(numpy.int8) - ord('0')).astype(numpy.int8)
+        elif kind == 'grid_reference':
+            # digits, perhaps with spaces around them
+            is_digit = (field_bytes >= ord('0')) & (field_bytes <= ord('9'))
+            self.check(~(is_digit | (field_bytes == ord(' '))).all(axis = 1))
+            values = numpy.zeros(len(field_bytes), numpy.int64)
+            for column in range(field_bytes.shape[1]):
+                values = numpy.where(is_digit[:, column], values * 10 + field_bytes[:, column] - ord('0'), values)
+            return numpy.where(is_digit.any(axis = 1), values, -1).astype(numpy.int32)
+        else:
+            # Strings repeat a great deal, so convert each different one once
+            # with the same converter as the record class uses
+            width = end - start
+            raw = numpy.ascontiguousarray(field_bytes).view('S%d' % width).ravel()
+            if converter is None:
+                return raw
+            values, inverse = numpy.unique(raw, return_inverse = True)
+            # NumPy drops trailing NULs, not spaces, so pad back to the width
+            values = [ converter(value.ljust(width)) for value in values ]
+            return numpy.array(values + [''], 'S')[:-1][inverse] if len(values) else numpy.zeros(0, 'S1')
+
+# How CIFArrays decodes the fields which aren't kept as strings
+_ARRAY_FIELD_KINDS = {
+    'first_date_of_operation' : 'date', 'last_date_of_operation' : 'date',
+    'start_of_exceptional_period' : 'date', 'end_of_exceptional_period' : 'date',
+    'published_arrival_time' : 'time', 'published_departure_time' : 'time',
+    'operates_on_day_of_week' : 'days_of_week', 'operation_code' : 'flag',
+    'timing_point_indicator' : 'timing_point', 'fare_stage_indicator' : 'fare_stage',
+    'grid_reference_easting' : 'grid_reference', 'grid_reference_northing' : 'grid_reference' }
+
+###########################################################
+# Freezing for forked worker processes
+
+class FrozenATCO(object):
+    '''Journeys, hops, locations and the indexes made by index_by_short_codes,
+    copied into one block of anonymous shared memory, made by ATCO.freeze.
+
+    Forked worker processes can read ordinary Python objects made by their
+    parent, but changing their reference counts writes to every page they are
+    on, so soon each worker has its own copy of all of them. FrozenATCO keeps
+    everything in flat arrays, which are read in place without changing
+    anything, and the memory is shared with the workers rather than copied.
+    Small view objects are made to look at each journey, hop and location
+    as they are needed, with the same attributes as the records they came
+    from. unique_set_size tells how much memory a process has to itself.
+
+    >>> atco = ATCO()
+    >>> atco.read_string("""ATCO-CIF0510                       70 - RAIL        ATCORAIL20080124115909
+    ... QSNGW    6B1820070521200712071111100  2B02P10452TRAIN           I
+    ... QE20070523200705230
+    ... QO9100MDNHEAD 0549URLT1  
+    ... QI9100FURZEP  05530553T3  T1  
+    ... QT9100MARLOW  0612   T1  
+    ... QSNGW    6B1A20070521200712071111100  2B04P10456TRAIN           I
+    ... QO9100MDNHEAD 0608URLT1  
+    ... QT9100BORNEND 0620   T1  
+    ... QLN9100MARLOW  Marlow Rail Station                              RE0057285
+    ... QBN9100MARLOW  485100  186500  Wycombe                 Marlow                  
+    ... """)
+    >>> frozen = atco.freeze()
+    >>> journey = frozen.journey_from_id['GW-6B18']
+    >>> journey.id, journey.vehicle_type, journey.last_date_of_operation
+    ('GW-6B18', 'TRAIN', datetime.date(2007, 12, 7))
+    >>> [ (hop.location, hop.bay_number) for hop in journey.hops ]
+    [('9100MDNHEAD', 'URL'), ('9100FURZEP', '3'), ('9100MARLOW', '')]
+    >>> journey.hops[1].published_arrival_time, journey.hops[-1].record_identity
+    (datetime.time(5, 53), 'QT')
+    >>> journey.is_valid_on_date(datetime.date(2007, 5, 23)), journey.is_valid_on_date(datetime.date(2007, 5, 24))
+    (BoolWithReason(False, '2007-05-23 not in range of exceptional date records'), BoolWithReason(True, 'OK'))
+    >>> sorted([ journey.id for journey in frozen.journeys_visiting_location['9100MDNHEAD'] ])
+    ['GW-6B18', 'GW-6B1A']
+    >>> frozen.location_from_id['9100MARLOW'].long_description()
+    'Marlow Rail Station, Marlow, Wycombe'
+    >>> frozen.location_from_id['9100MARLOW'].additional.grid_reference_easting
+    485100
+    >>> 'GW-XXXX' in frozen.journey_from_id, frozen.journeys_visiting_location.get('9100XXXX', [])
+    (False, [])
+    '''
+
+    def __init__(self, atco):
+        journeys = atco.journeys
+        locations = atco.locations
+        arrays, string_columns = _journey_arrays(journeys, atco.location_ids.add)
+        location_arrays, location_string_columns = _location_arrays(locations)
+        arrays.update(location_arrays)
+        string_columns.update(location_string_columns)
+
+        # all the location ids have been given out now
+        strings = _StringTable(atco.location_ids.codes)
+        for name, values in string_columns.iteritems():
+            arrays[name] = array.array('i', [ strings.add(value) for value in values ])
+        del string_columns, location_string_columns
+        arrays['journey_order'] = array.array('i', sorted(range(len(journeys)), key = lambda index: journeys[index].id))
+        arrays['location_order'] = array.array('i', sorted(range(len(locations)), key = lambda index: locations[index].location))
+
+        # journeys visiting each location, as a list for each location id in turn
+        location_count = len(atco.location_ids.codes)
+        journeys_visiting_location = [ [] for location_id in xrange(location_count) ]
+        hop_location_id = arrays['hop_location_id']
+        hop_starts = arrays['hop_starts']
+        for journey_index in xrange(len(journeys)):
+            for location_id in hop_location_id[hop_starts[journey_index]:hop_starts[journey_index + 1]]:
+                visiting = journeys_visiting_location[location_id]
+                if not visiting or visiting[-1] != journey_index:
+                    visiting.append(journey_index)
+        visiting_starts = array.array('i', [0])
+        visiting_journeys = array.array('i')
+        for visiting in journeys_visiting_location:
+            visiting_journeys.extend(visiting)
+            visiting_starts.append(len(visiting_journeys))
+        arrays.update({ 'visiting_starts' : visiting_starts, 'visiting_journeys' : visiting_journeys })
+        arrays['code_order'] = array.array('i', sorted(range(location_count), key = atco.location_ids.codes.__getitem__))
+        arrays['string_starts'], arrays['string_data'] = strings.arrays()
+        del strings, journeys_visiting_location
+
+        self.buffers = _FlatBuffers(arrays)
+        for name in arrays:
+            setattr(self, name, getattr(self.buffers, name))
+        self.strings = _FrozenStrings(self.string_starts, self.string_data)
+        self.location_count = location_count
+        self.hop_columns = _FrozenHopColumns(self)
+        self.journeys = _FrozenSequence(FrozenJourney, self, len(self.journey_order))
+        self.locations = _FrozenSequence(FrozenLocation, self, len(self.location_order))
+        self.journey_from_id = _FrozenIndex(self._journey_from_id)
+        self.location_from_id = _FrozenIndex(self._location_from_id)
+        self.journeys_visiting_location = _FrozenIndex(self._journeys_visiting_location)
+
+    def _find(self, order, key, name):
+        '''Binary search for the last item in order (an array of indexes sorted
+        by their name) with that name, returning its index or None.'''
+        low, high = 0, len(order)
+        while low < high:
+            middle = (low + high) // 2
+            if key < name(order[middle]):
+                high = middle
+            else:
+                low = middle + 1
+        if low > 0 and name(order[low - 1]) == key:
+            return order[low - 1]
+        return None
+
+    def _journey_from_id(self, id):
+        strings, journey_id = self.strings, self.journey_id
+        index = self._find(self.journey_order, id, lambda index: strings[journey_id[index]])
+        return index is not None and self.journeys[index] or None
+
+    def _location_from_id(self, code):
+        strings, location_location = self.strings, self.location_location
+        index = self._find(self.location_order, code, lambda index: strings[location_location[index]])
+        return index is not None and self.locations[index] or None
+
+    def location_id(self, code):
+        '''Returns the location id of a short code, or None if no hop or location has it.'''
+        return self._find(self.code_order, code, self.strings.__getitem__)
+
+    def _journeys_visiting_location(self, code):
+        location_id = self.location_id(code)
+        if location_id is None:
+            return None
+        return [ self.journeys[self.visiting_journeys[index]]
+            for index in xrange(self.visiting_starts[location_id], self.visiting_starts[location_id + 1]) ]
+
+# Fields of records which FrozenATCO keeps as strings
+_FROZEN_JOURNEY_STRINGS = ('id', 'transaction_type', 'operator', 'unique_journey_identifier', 'school_term_time',
+    'bank_holidays', 'route_number', 'running_board', 'vehicle_type', 'registration_number', 'route_direction')
+_FROZEN_LOCATION_STRINGS = ('transaction_type', 'location', 'full_location', 'gazetteer_code', 'point_type',
+    'national_gazetteer_id')
+_FROZEN_LOCATION_ADDITIONAL_STRINGS = ('district_name', 'town_name')
+
+def _journey_arrays(journeys, location_number, lines = False):
+    '''Returns the flat columns which FrozenATCO and snapshots keep of the
+    journeys, their hops and their date running exceptions: a dictionary of
+    arrays by name, and a dictionary of lists of strings by name, for the
+    caller to number in its _StringTable. location_number gives the number
+    kept for the location of each hop. With lines, the line of each record
+    is kept too, so that the records can be made again.'''
+    # hops and date running exceptions are kept together for each journey
+    hop_location_id = array.array('i')
+    hop_activity = array.array('c')
+    hop_arrival = array.array('H')
+    hop_departure = array.array('H')
+    hop_flags = array.array('B')
+    hop_starts = array.array('i', [0])
+    bay_hops = array.array('i')
+    bay_numbers = []
+    hop_lines = []
+    exception_starts = array.array('i', [0])
+    exception_start = array.array('i')
+    exception_end = array.array('i')
+    exception_operation_code = array.array('B')
+    exception_lines = []
+    for journey in journeys:
+        for hop in journey.hops:
+            activity, arrival, departure, flags, bay_number = _hop_columns(hop)
+            if bay_number:
+                bay_hops.append(len(hop_location_id))
+                bay_numbers.append(bay_number)
+            if lines:
+                if isinstance(hop, HopView):
+                    hop = hop.to_record()
+                hop_lines.append(hop.line)
+            hop_location_id.append(location_number(hop.location))
+            hop_activity.append(activity)
+            hop_arrival.append(arrival)
+            hop_departure.append(departure)
+            hop_flags.append(flags)
+        hop_starts.append(len(hop_location_id))
+        for exception in journey.date_running_exceptions:
+            exception_start.append(exception.start_of_exceptional_period.toordinal())
+            exception_end.append(exception.end_of_exceptional_period.toordinal())
+            exception_operation_code.append(exception.operation_code)
+            if lines:
+                exception_lines.append(exception.line)
+        exception_starts.append(len(exception_start))
+    arrays = { 'hop_location_id' : hop_location_id, 'hop_activity' : hop_activity,
+        'hop_arrival' : hop_arrival, 'hop_departure' : hop_departure, 'hop_flags' : hop_flags,
+        'hop_starts' : hop_starts, 'bay_hops' : bay_hops, 'exception_starts' : exception_starts,
+        'exception_start' : exception_start, 'exception_end' : exception_end,
+        'exception_operation_code' : exception_operation_code }
+    string_columns = { 'bay_numbers' : bay_numbers }
+
+    string_names = _FROZEN_JOURNEY_STRINGS
+    if lines:
+        string_columns.update({ 'hop_line' : hop_lines, 'exception_line' : exception_lines })
+        string_names = ('line',) + string_names
+    for name in string_names:
+        string_columns['journey_' + name] = [ getattr(journey, name) for journey in journeys ]
+    arrays['journey_first_date_of_operation'] = array.array('i', [ journey.first_date_of_operation.toordinal() for journey in journeys ])
+    arrays['journey_last_date_of_operation'] = array.array('i', [ journey.last_date_of_operation.toordinal() for journey in journeys ])
+    arrays['journey_operates_on_day_of_week'] = array.array('B', [ sum([ 1 << day for day in range(8) if journey.operates_on_day_of_week[day] ])
+        for journey in journeys ])
+    arrays['journey_file_loading_number'] = array.array('i', [ journey.file_loading_number for journey in journeys ])
+    arrays['journey_assume_no_holidays'] = array.array('B', [ journey.assume_no_holidays for journey in journeys ])
+    return arrays, string_columns
+
+def _location_arrays(locations, lines = False):
+    '''Returns the flat columns which FrozenATCO and snapshots keep of the
+    locations and their LocationAdditional records, as for _journey_arrays.
+    Locations without one have empty strings and zeros in its columns.'''
+    additionals = [ location.additional for location in locations ]
+    arrays = { 'location_has_additional' : array.array('B', [ additional is not None for additional in additionals ]) }
+    for name in ('grid_reference_easting', 'grid_reference_northing'):
+        arrays['location_' + name] = array.array('i', [ additional and getattr(additional, name) or 0 for additional in additionals ])
+    location_names = _FROZEN_LOCATION_STRINGS
+    additional_names = [ (name, 'location_' + name) for name in _FROZEN_LOCATION_ADDITIONAL_STRINGS ]
+    if lines:
+        location_names = ('line',) + location_names
+        additional_names += [ (name, 'location_additional_' + name) for name in ('line', 'transaction_type', 'location') ]
+    string_columns = {}
+    for name in location_names:
+        string_columns['location_' + name] = [ getattr(location, name) for location in locations ]
+    for name, column in additional_names:
+        string_columns[column] = [ additional and getattr(additional, name) or '' for additional in additionals ]
+    return arrays, string_columns
+
+_CTYPE_FROM_TYPECODE = { 'c' : ctypes.c_char, 'B' : ctypes.c_uint8, 'H' : ctypes.c_uint16, 'i' : ctypes.c_int32 }
+
+class _FlatBuffers(object):
+    '''Copies arrays into one block of anonymous shared memory, and makes an
+    attribute for each which reads its part of the block in place.'''
+
+    def __init__(self, arrays):
+        offsets, size = _flat_offsets(arrays)
+        self.mapped = mmap.mmap(-1, max(size, 1))
+        for name, values in arrays.items():
+            data = values.tostring()
+            self.mapped[offsets[name]:offsets[name] + len(data)] = data
+            setattr(self, name, _flat_column(self.mapped, values.typecode, offsets[name], len(values)))
+
+def _flat_offsets(arrays, start = 0):
+    '''Lays out arrays one after another from start, each aligned to 8 bytes,
+    returning the offset of each by name and where the last one ends.'''
+    offsets = {}
+    size = start
+    for name, values in sorted(arrays.items()):
+        assert values.itemsize == ctypes.sizeof(_CTYPE_FROM_TYPECODE[values.typecode])
+        size = (size + 7) & ~7
+        offsets[name] = size
+        size += len(values) * values.itemsize
+    return offsets, size
+
+def _flat_column(mapped, typecode, offset, length):
+    '''Returns a ctypes array which reads length values from mapped in place.'''
+    return (_CTYPE_FROM_TYPECODE[typecode] * length).from_buffer(mapped, offset)
+
+class _StringTable(object):
+    '''Strings stored once each, numbered in order. The location codes come
+    first, so that a location id is also the number of its code.'''
+
+    def __init__(self, codes):
+        self.strings = list(codes)
+        self.numbers = dict([ (code, number) for number, code in enumerate(codes) ])
+
+    def add(self, string):
+        number = self.numbers.get(string)
+        if number is None:
+            number = self.numbers[string] = len(self.strings)
+            self.strings.append(string)
+        return number
+
+    def arrays(self):
+        starts = array.array('i', [0])
+        for string in self.strings:
+            starts.append(starts[-1] + len(string))
+        return starts, array.array('c', ''.join(self.strings))
+
+class _FrozenStrings(object):
+    '''The strings of a _StringTable, read from flat buffers.'''
+
+    def __init__(self, starts, data):
+        self.starts = starts
+        self.data = data
+
+    def __len__(self):
+        return len(self.starts) - 1
+
+    def __getitem__(self, number):
+        return self.data[self.starts[number]:self.starts[number + 1]]
+
+class _FrozenSequence(object):
+    '''The journeys or locations of a FrozenATCO, made into views as they are used.'''
+
+    def __init__(self, view_class, frozen, length):
+        self.view_class = view_class
+        self.frozen = frozen
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.length
+        if index < 0 or index >= self.length:
+            raise IndexError("index out of range")
+        return self.view_class(self.frozen, index)
+
+    def __iter__(self):
+        for index in xrange(self.length):
+            yield self.view_class(self.frozen, index)
+
+class _FrozenIndex(object):
+    '''Looks things up with a function which returns None for missing keys,
+    and behaves like a read only dictionary.'''
+
+    def __init__(self, find):
+        self.find = find
+
+    def __getitem__(self, key):
+        value = self.find(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default = None):
+        value = self.find(key)
+        if value is None:
+            return default
+        return value
+
+    def __contains__(self, key):
+        return self.find(key) is not None
+    has_key = __contains__
+
+class _FrozenHopColumns(object):
+    '''Has the same columns as a HopStore, reading the hops of a FrozenATCO,
+    so that HopSequence and HopView can be used to look at them.'''
+
+    def __init__(self, frozen):
+        self.location_codes = frozen.strings
+        self.location_id = frozen.hop_location_id
+        self.activity = frozen.hop_activity
+        self.arrival = frozen.hop_arrival
+        self.departure = frozen.hop_departure
+        self.flags = frozen.hop_flags
+        self.bay_numbers = _FrozenBayNumbers(frozen)
+
+    def __len__(self):
+        return len(self.location_id)
+
+class _FrozenBayNumbers(object):
+    '''The bay numbers of the few hops which have them, by hop index.'''
+
+    def __init__(self, frozen):
+        self.hops = frozen.bay_hops
+        self.numbers = frozen.bay_numbers
+        self.strings = frozen.strings
+
+    def get(self, hop, default = None):
+        position = bisect.bisect_left(self.hops, hop)
+        if position < len(self.hops) and self.hops[position] == hop:
+            return self.strings[self.numbers[position]]
+        return default
+
+def _frozen_field(column, convert = None):
+    '''Makes a property for a view which reads its value from a column of
+    the FrozenATCO, converting it if need be.'''
+    def get(self):
+        value = getattr(self.frozen, column)[self.index]
+        if convert is not None:
+            value = convert(self.frozen, value)
+        return value
+    return property(get)
+
+def _frozen_string(frozen, number):
+    return frozen.strings[number]
+
+def _frozen_date(frozen, ordinal):
+    return datetime.date.fromordinal(ordinal)
+
+class FrozenJourney(object):
+    '''A view of one journey in a FrozenATCO, with the same fields as the
+    JourneyHeader it was made from, and its hops as a HopSequence. See
+    FrozenATCO for examples.'''
+
+    __slots__ = ('frozen', 'index')
+
+    def __init__(self, frozen, index):
+        self.frozen = frozen
+        self.index = index
+
+    def __eq__(self, other):
+        return isinstance(other, FrozenJourney) and self.frozen is other.frozen and self.index == other.index
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.index)
+
+    def __repr__(self):
+        return "FrozenJourney(" + repr(self.id) + ")"
+
+    first_date_of_operation = _frozen_field('journey_first_date_of_operation', _frozen_date)
+    last_date_of_operation = _frozen_field('journey_last_date_of_operation', _frozen_date)
+    file_loading_number = _frozen_field('journey_file_loading_number')
+    assume_no_holidays = _frozen_field('journey_assume_no_holidays', lambda frozen, value: bool(value))
+
+    def _get_operates_on_day_of_week(self):
+        bits = self.frozen.journey_operates_on_day_of_week[self.index]
+        return [ bool(bits & (1 << day)) for day in range(8) ]
+    operates_on_day_of_week = property(_get_operates_on_day_of_week)
+
+    def _get_hops(self):
+        hop_starts = self.frozen.hop_starts
+        return HopSequence(self.frozen.hop_columns, hop_starts[self.index], hop_starts[self.index + 1])
+    hops = property(_get_hops)
+
+    def is_valid_on_date(self, d):
+        '''As for JourneyHeader.is_valid_on_date.'''
+        frozen = self.frozen
+        ordinal = d.toordinal()
+        excepted_state = None
+        for exception in xrange(frozen.exception_starts[self.index], frozen.exception_starts[self.index + 1]):
+            if frozen.exception_start[exception] <= ordinal and ordinal <= frozen.exception_end[exception]:
+                excepted_state = bool(frozen.exception_operation_code[exception])
+        if excepted_state == False:
+            return BoolWithReason(False, "%s not in range of exceptional date records" % (str(d)))
+        if excepted_state == None:
+            # the same test as JourneyHeader makes
+            if not frozen.journey_first_date_of_operation[self.index] <= ordinal and ordinal <= frozen.journey_last_date_of_operation[self.index]:
+                return BoolWithReason(False, "%s not in range of date of operation %s - %s" % (str(d), str(self.first_date_of_operation), str(self.last_date_of_operation)))
+
+        # check runs on this day of week
+        if not frozen.journey_operates_on_day_of_week[self.index] & (1 << d.isoweekday()):
+            return BoolWithReason(False, "journey doesn't operate on a " + d.strftime('%A'))
+
+        if not self.assume_no_holidays:
+            assert self.school_term_time == " ", "fancy school term related journey not implemented " + self.school_term_time + ", perhaps set assume_no_holidays"
+            assert self.bank_holidays == " ", "fancy bank holiday related journey not implemented " + self.bank_holidays + ", perhaps set assume_no_holidays"
+
+        return BoolWithReason(True, "OK")
+
+    def runs_on_date(self, d):
+        return bool(self.is_valid_on_date(d))
+
+for name in _FROZEN_JOURNEY_STRINGS:
+    setattr(FrozenJourney, name, _frozen_field('journey_' + name, _frozen_string))
+
+class FrozenLocation(object):
+    '''A view of one location in a FrozenATCO, with the same fields as the
+    Location it was made from. See FrozenATCO for examples.'''
+
+    __slots__ = ('frozen', 'index')
+
+    def __init__(self, frozen, index):
+        self.frozen = frozen
+        self.index = index
+
+    def __eq__(self, other):
+        return isinstance(other, FrozenLocation) and self.frozen is other.frozen and self.index == other.index
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.index)
+
+    def __repr__(self):
+        return "FrozenLocation('" + self.location + "')"
+
+    def _get_additional(self):
+        if not self.frozen.location_has_additional[self.index]:
+            return None
+        return _FrozenLocationAdditional(self.frozen, self.index)
+    additional = property(_get_additional)
+
+    def long_description(self):
+        ret = self.full_location
+        additional = self.additional
+        if additional:
+            if len(additional.town_name) > 0:
+                ret += ", " + additional.town_name
+            if len(additional.district_name) > 0:
+                ret += ", " + additional.district_name
+        return ret
+
+class _FrozenLocationAdditional(object):
+    '''A view of the LocationAdditional of a FrozenLocation.'''
+
+    __slots__ = ('frozen', 'index')
+
+    def __init__(self, frozen, index):
+        self.frozen = frozen
+        self.index = index
+
+    grid_reference_easting = _frozen_field('location_grid_reference_easting')
+    grid_reference_northing = _frozen_field('location_grid_reference_northing')
+
+for name in _FROZEN_LOCATION_STRINGS:
+    setattr(FrozenLocation, name, _frozen_field('location_' + name, _frozen_string))
+for name in _FROZEN_LOCATION_ADDITIONAL_STRINGS:
+    setattr(_FrozenLocationAdditional, name, _frozen_field('location_' + name, _frozen_string))
+del name
+
+def unique_set_size(pid = 'self'):
+    '''Returns the unique set size of a process in bytes - the memory which
+    only it is using, and which would be freed if it stopped - or None if
+    it can't be found out. It is read from /proc, so only works on Linux.'''
+    for name in ('smaps_rollup', 'smaps'):
+        try:
+            h = open('/proc/%s/%s' % (pid, name))
+        except IOError:
+            continue
+        try:
+            kilobytes = 0
+            for line in h:
+                if line.startswith('Private_Clean:') or line.startswith('Private_Dirty:'):
+                    kilobytes += int(line.split()[1])
+            return kilobytes * 1024
+        finally:
+            h.close()
+    return None
+
 ###########################################################
 
 # Run tests if this module is executed directly. Recommended you use nosetests